@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Compare receipts/sec of the single file upload route against the batch
+route. Both are driven through the Flask test client, so the numbers
+exclude network overhead and measure hashing, disk and database work.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import io
+import logging
+import os
+import tempfile
+import time
+
+import receipts_api
+import storage
+from db import dbengine
+
+
+def fresh_env(workdir: str, name: str):
+    upload_dir = os.path.join(workdir, f"uploads_{name}")
+    receipts_api.receipt_storage = storage.LocalStorage(upload_dir)
+    receipts_api.dbeng = dbengine.DbEngine(logging,
+                                           os.path.join(workdir, f"{name}.db"))
+    return receipts_api.app.test_client()
+
+def payload(i: int) -> bytes:
+    return f"receipt-{i}-".encode() + os.urandom(1024)
+
+def bench_single(client, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        data = {"file": (io.BytesIO(payload(i)), f"{i}.png"),
+                "tags": f"shop_{i % 50} groceries 2019-01-12 1_year"}
+        resp = client.post("/", data=data)
+        assert resp.status_code == 200, resp.data
+    return count / (time.perf_counter() - start)
+
+def bench_batch(client, count: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        n = min(batch_size, count - offset)
+        data = {"file": [(io.BytesIO(payload(offset + i)), f"{offset + i}.png")
+                         for i in range(n)],
+                "tags": [f"shop_{(offset + i) % 50} groceries 2019-01-12 1_year"
+                         for i in range(n)]}
+        resp = client.post("/batch", data=data)
+        assert resp.status_code == 200, resp.data
+    return count / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=2000, help="Receipts")
+    argparser.add_argument("-b", type=int, default=200, help="Batch size")
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        single = bench_single(fresh_env(workdir, "single"), args.n)
+        batch = bench_batch(fresh_env(workdir, "batch"), args.n, args.b)
+
+    print(f"single: {single:10.1f} receipts/sec")
+    print(f"batch:  {batch:10.1f} receipts/sec (batch size {args.b})")
+    print(f"speedup: {batch / single:.1f}x")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Search latency as the receipt table grows. A synthetic database is grown
+in steps up to 1M receipts and the first and a later page of a common,
+a rare and a prefix query are timed at every step.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from db import dbengine
+
+WORDS = ["milk", "bread", "cheese", "coffee", "total", "vat", "cash", "card",
+         "laptop", "warranty", "receipt", "thank", "you", "welcome", "store",
+         "discount", "bananas", "apples", "pasta", "tomatoes", "butter"]
+QUERIES = {"common": "total", "rare": "rareword", "prefix": "warr*"}
+
+
+def grow(db_path: str, start: int, end: int) -> None:
+    rng = random.Random(start)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF;")
+
+    def rows():
+        for i in range(start, end):
+            text = " ".join(rng.choice(WORDS) for _ in range(12))
+            if i % 10000 == 0:
+                text += " rareword"
+            yield (f"{i:064x}.jpg", "2019-12-01", text, f"{i:064x}")
+
+    conn.executemany("INSERT INTO receipt (filename, purchase_date, ocr_text, "
+                     + "content_sha256) VALUES (?, ?, ?, ?);", rows())
+    conn.commit()
+    conn.close()
+
+def time_query(dbeng, query: str, repeat: int) -> tuple:
+    first = []
+    second = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        page = dbeng.search_receipts(query, 20)
+        first.append(time.perf_counter() - start)
+        if len(page) > 0:
+            start = time.perf_counter()
+            dbeng.search_receipts(query, 20, page[-1]["id"])
+            second.append(time.perf_counter() - start)
+    return statistics.median(first), \
+           statistics.median(second) if len(second) > 0 else 0.0
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--sizes", type=str, default="10000,100000,1000000",
+                           help="Comma separated table sizes")
+    argparser.add_argument("-r", type=int, default=20, help="Repeats")
+    args = argparser.parse_args()
+    sizes = [int(i) for i in args.sizes.split(",")]
+
+    print(f"{'rows':>9} {'query':<8} {'page 1 ms':>10} {'page 2 ms':>10}")
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "fts.db")
+        dbengine.DbEngine(logging, db_path).close()
+        current = 0
+        for size in sizes:
+            grow(db_path, current, size)
+            current = size
+            dbeng = dbengine.DbEngine(logging, db_path, recent_hashes=0)
+            for name, query in QUERIES.items():
+                first, second = time_query(dbeng, query, args.r)
+                print(f"{size:>9} {name:<8} {first * 1000:>10.3f} "
+                      + f"{second * 1000:>10.3f}")
+            dbeng.close()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Requests/sec and latency percentiles of the upload route with concurrent
+clients, against the development server and gunicorn. Both servers are
+started on a fresh database in a temporary directory. gunicorn is skipped
+if it isn't installed. Use --url to test a server which is already
+running instead.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+
+API_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+config_template = """
+[db]
+database_file = {workdir}/receipts.db
+pool_size = 4
+
+[storage]
+upload_dir = {workdir}/uploads
+
+[server]
+bind = 127.0.0.1:{port}
+workers = {workers}
+threads = 4
+"""
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def wait_until_up(url: str, timeout: float=30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url + "ocr/status", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server at {url} didn't start")
+
+def start_server(mode: str, workdir: str, port: int, workers: int):
+    config_path = os.path.join(workdir, "receipts.cfg")
+    with open(config_path, "w") as f:
+        f.write(config_template.format(workdir=workdir, port=port,
+                                       workers=workers))
+    if mode == "dev":
+        cmd = [sys.executable, "receipts_api.py", "-c", config_path,
+               "-p", str(port)]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+               "wsgi:app"]
+    env = dict(os.environ, RECEIPTS_CONFIG=config_path)
+    return subprocess.Popen(cmd, cwd=API_DIR, env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+def run_clients(url: str, clients: int, requests_per_client: int,
+                size: int) -> tuple:
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(client_no: int):
+        session = requests.Session()
+        for i in range(requests_per_client):
+            content = f"{client_no}-{i}-{time.time()}-".encode() \
+                      + os.urandom(size)
+            files = {"file": (f"{client_no}_{i}.jpg", content)}
+            start = time.perf_counter()
+            resp = session.post(url, files=files,
+                                data={"tags": f"shop_{i % 20} 2019-01-12"})
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if resp.status_code != 200:
+                    errors.append(resp.status_code)
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    start = time.perf_counter()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return time.perf_counter() - start, latencies, errors
+
+def report(name: str, elapsed: float, latencies: list, errors: list) -> None:
+    print(f"{name:<10} {len(latencies) / elapsed:>8.1f} "
+          + f"{percentile(latencies, 50) * 1000:>8.1f} "
+          + f"{percentile(latencies, 95) * 1000:>8.1f} "
+          + f"{percentile(latencies, 99) * 1000:>8.1f} {len(errors):>7}")
+
+def gunicorn_available() -> bool:
+    import importlib.util
+    return importlib.util.find_spec("gunicorn") is not None
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-c", type=int, default=16, help="Clients")
+    argparser.add_argument("-n", type=int, default=50,
+                           help="Requests per client")
+    argparser.add_argument("-s", type=int, default=100 * 1024,
+                           help="Upload size in bytes")
+    argparser.add_argument("-w", type=int, default=4, help="gunicorn workers")
+    argparser.add_argument("--port", type=int, default=5599)
+    argparser.add_argument("--url", type=str, default=None,
+                           help="Test a running server instead")
+    args = argparser.parse_args()
+
+    print(f"{'server':<10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          + f"{'p99 ms':>8} {'errors':>7}")
+    if args.url is not None:
+        report("external", *run_clients(args.url, args.c, args.n, args.s))
+        sys.exit(0)
+
+    modes = ["dev"]
+    if gunicorn_available():
+        modes.append("gunicorn")
+    else:
+        print("gunicorn isn't installed, skipping the production mode")
+    for mode in modes:
+        workdir = tempfile.mkdtemp()
+        server = start_server(mode, workdir, args.port, args.w)
+        url = f"http://127.0.0.1:{args.port}/"
+        try:
+            wait_until_up(url)
+            report(mode, *run_clients(url, args.c, args.n, args.s))
+        finally:
+            server.terminate()
+            server.wait(60)
+            shutil.rmtree(workdir, ignore_errors=True)
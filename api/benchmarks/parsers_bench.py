@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+pytest-benchmark suite of the tag parsers with typical, large and
+pathological tag strings. Run from this directory with
+
+    python -m pytest parsers_bench.py
+"""
+import sys
+sys.path.append("..")
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import receipts_api
+
+TAG_STRINGS = {
+    "typical": "shop food 2019-01-12 2_years",
+    # Thousands of tags with a date and an expiry period among them
+    "large": " ".join([f"tag_{i}" for i in range(5000)]
+                      + ["2019-01-12", "6_months"]),
+    # Every tag looks special up to its last character
+    "near_miss": " ".join([f"{i:04}-01-1x" for i in range(2000)]
+                          + [f"{i}_dayz" for i in range(2000)]),
+    "many_dates": " ".join(f"{2000 + i % 20}-{i % 12 + 1}-{i % 28 + 1}"
+                           for i in range(2000)),
+    "whitespace": "\t \n ".join(f"tag_{i}" for i in range(2000)) + "   " * 1000,
+    "long_tag": "1" * 100000 + "_days",
+}
+
+
+@pytest.fixture(params=sorted(TAG_STRINGS))
+def tag_string(request):
+    return TAG_STRINGS[request.param]
+
+def test_parse_tags(benchmark, tag_string):
+    benchmark(receipts_api.parse_tags, tag_string)
+
+def test_classify_tags(benchmark, tag_string):
+    tags = receipts_api.parse_tags(tag_string)
+    benchmark(receipts_api.classify_tags, tags)
+
+def test_parse_wrappers(benchmark, tag_string):
+    tags = receipts_api.parse_tags(tag_string)
+
+    def parse():
+        remaining = list(tags)
+        purchase_date = receipts_api.parse_purchase_date(remaining)
+        receipts_api.parse_expiry_date(purchase_date, remaining)
+
+    benchmark(parse)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for DbEngine. Every client thread performs the
+database part of an upload (receipt, tags and tag association inserts)
+and the p50/p99 latency of those is reported for the shared connection
+and the connection pool modes at 1, 8 and 32 concurrent clients.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from db import dbengine
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def run(dbeng, clients: int, per_client: int) -> list:
+    latencies = []
+    latencies_lock = threading.Lock()
+    barrier = threading.Barrier(clients)
+
+    def client(client_no):
+        own = []
+        barrier.wait()
+        for i in range(per_client):
+            tags = ["groceries", f"shop_{i % 20}"]
+            start = time.perf_counter()
+            receipt_id = dbeng.insert_receipt(
+                    {"filename": f"{clients}_{client_no}_{i}.jpg",
+                     "purchase_date": "2019-12-01",
+                     "ocr_text": "",
+                     "expiry_date": None})
+            dbeng.insert_receipt_tags_association(receipt_id, tags)
+            own.append(time.perf_counter() - start)
+        with latencies_lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return latencies
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=100,
+                           help="Inserts per client")
+    argparser.add_argument("-p", type=int, default=8, help="Pool size")
+    argparser.add_argument("--synchronous", type=str, default="NORMAL")
+    args = argparser.parse_args()
+
+    print(f"{'mode':<8} {'clients':>7} {'p50 ms':>9} {'p99 ms':>9} "
+          + f"{'inserts/s':>10}")
+    for mode, pool_size in (("shared", 0), ("pool", args.p)):
+        with tempfile.TemporaryDirectory() as workdir:
+            dbeng = dbengine.DbEngine(logging,
+                                      os.path.join(workdir, "stress.db"),
+                                      pool_size=pool_size,
+                                      synchronous=args.synchronous)
+            for clients in (1, 8, 32):
+                start = time.perf_counter()
+                latencies = run(dbeng, clients, args.n)
+                elapsed = time.perf_counter() - start
+                print(f"{mode:<8} {clients:>7} "
+                      + f"{statistics.median(latencies) * 1000:>9.2f} "
+                      + f"{percentile(latencies, 99) * 1000:>9.2f} "
+                      + f"{len(latencies) / elapsed:>10.1f}")
+            dbeng.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Cost of looking up receipt files in the flat and the sharded upload
+layouts. Both layouts are filled with -n empty files, then random existing
+and missing names are stat'ed and a new file is linked in the way uploads
+do. Listing a directory is timed too, which is what backups and ls do.
+Use --dir to run on the filesystem the uploads live on; page cache effects
+aren't excluded.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import hashlib
+import io
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import storage
+
+
+def fill(layout: storage.LocalStorage, hashes: list) -> float:
+    start = time.perf_counter()
+    for content_hash in hashes:
+        path = layout.path_for(content_hash, "jpg")
+        try:
+            open(path, "wb").close()
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "wb").close()
+    return time.perf_counter() - start
+
+def time_stats(layout: storage.LocalStorage, hashes: list) -> float:
+    timings = []
+    for content_hash in hashes:
+        path = layout.path_for(content_hash, "jpg")
+        start = time.perf_counter()
+        os.path.exists(path)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def time_store(layout: storage.LocalStorage, count: int) -> float:
+    timings = []
+    for i in range(count):
+        payload = io.BytesIO(f"new-{i}-{layout.layout}".encode())
+        start = time.perf_counter()
+        layout.store(payload, "jpg")
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def time_listdir(path: str) -> float:
+    start = time.perf_counter()
+    os.listdir(path)
+    return time.perf_counter() - start
+
+def make_hashes(count: int, seed: int) -> list:
+    return [hashlib.sha256(f"{seed}-{i}".encode()).hexdigest()
+            for i in range(count)]
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=500000, help="Files")
+    argparser.add_argument("-l", type=int, default=2000, help="Lookups")
+    argparser.add_argument("--dir", type=str, default=None,
+                           help="Directory to create the layouts in")
+    args = argparser.parse_args()
+
+    hashes = make_hashes(args.n, 0)
+    missing = make_hashes(args.l, 1)
+    print(f"{'layout':<8} {'fill s':>8} {'hit us':>8} {'miss us':>8} "
+          + f"{'store us':>9} {'listdir ms':>11}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        for name in storage.LAYOUTS:
+            layout = storage.LocalStorage(os.path.join(workdir, name), name)
+            filled = fill(layout, hashes)
+            hit = time_stats(layout, random.sample(hashes, args.l))
+            miss = time_stats(layout, missing)
+            stored = time_store(layout, args.l)
+            listed = time_listdir(os.path.dirname(
+                    layout.path_for(hashes[0], "jpg")))
+            print(f"{name:<8} {filled:>8.1f} {hit * 1e6:>8.2f} "
+                  + f"{miss * 1e6:>8.2f} {stored * 1e6:>9.1f} "
+                  + f"{listed * 1000:>11.2f}")
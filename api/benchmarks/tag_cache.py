@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Receipts/sec of the database part of an upload with the tag cache and
+with the previous tag handling, which inserted the tags in a transaction
+of their own and looked their IDs up again for the associations. The tag
+vocabulary is small, like in real use, so nearly every tag is cached.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from db import dbengine, pool
+
+
+def uncached_tags(conn, receipt_id: int, tags: list) -> None:
+    uniq_tags = list(set(tags))
+    conn.executemany("INSERT OR IGNORE INTO tag (tag) VALUES (?);",
+                     [(i,) for i in uniq_tags])
+    conn.commit()
+    qmarks = ", ".join("?" * len(uniq_tags))
+    tag_ids = [row["id"] for row in conn.execute(
+            f"SELECT id FROM tag WHERE tag IN ({qmarks});", uniq_tags)]
+    conn.executemany("INSERT OR IGNORE INTO receipt_tag_association "
+                     + "(receipt_id, tag_id) VALUES (?, ?);",
+                     [(receipt_id, i) for i in tag_ids])
+    conn.commit()
+
+def run(db_path: str, count: int, cached: bool, synchronous: str) -> float:
+    dbeng = dbengine.DbEngine(logging, db_path, synchronous=synchronous,
+                              recent_hashes=0)
+    conn = pool.connect(db_path, synchronous=synchronous)
+    start = time.perf_counter()
+    for i in range(count):
+        tags = ["groceries", f"shop_{i % 50}", f"city_{i % 10}", "card"]
+        receipt_id = dbeng.insert_receipt({"filename": f"{i}.jpg",
+                                           "purchase_date": "2019-12-01",
+                                           "ocr_text": "",
+                                           "expiry_date": None})
+        if cached:
+            dbeng.insert_receipt_tags_association(receipt_id, tags)
+        else:
+            uncached_tags(conn, receipt_id, tags)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    dbeng.close()
+    return count / elapsed
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=5000, help="Receipts")
+    argparser.add_argument("--synchronous", type=str, default="NORMAL")
+    args = argparser.parse_args()
+
+    print(f"{'tags':<9} {'receipts/s':>11}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, cached in (("uncached", False), ("cached", True)):
+            db_path = os.path.join(workdir, f"{name}.db")
+            rate = run(db_path, args.n, cached, args.synchronous)
+            print(f"{name:<9} {rate:>11.0f}")
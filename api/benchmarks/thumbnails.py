@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Latency of thumbnail requests which render the thumbnail compared with
+ones served from the cache. Synthetic receipt scans are rendered with
+Pillow when it's installed, otherwise a render taking --render-ms is
+simulated.
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import thumbs
+
+
+def sleeping_render(delay: float):
+    def render(src, dest, width, fmt):
+        time.sleep(delay)
+        shutil.copyfile(src, dest)
+    return render
+
+def make_scans(workdir: str, count: int, pillow: bool) -> list:
+    paths = []
+    for i in range(count):
+        path = os.path.join(workdir, f"scan{i}.jpg")
+        if pillow:
+            from PIL import Image, ImageDraw
+            image = Image.new("RGB", (2480, 3508), "white")
+            draw = ImageDraw.Draw(image)
+            for y in range(100, 3400, 60):
+                draw.text((200, y), f"Item {i} {y} .... 12.34 EUR", fill="black")
+            image.save(path, "JPEG", quality=90)
+        else:
+            with open(path, "wb") as f:
+                f.write(os.urandom(20000))
+        paths.append(path)
+    return paths
+
+def time_gets(cache, scans: list, width: int) -> list:
+    timings = []
+    for i, path in enumerate(scans):
+        start = time.perf_counter()
+        cache.get(path, f"{i:064x}", width, "jpeg")
+        timings.append(time.perf_counter() - start)
+    return timings
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=20, help="Receipts")
+    argparser.add_argument("-w", type=int, default=256, help="Width")
+    argparser.add_argument("--render-ms", type=float, default=150.0,
+                           help="Simulated render time without Pillow")
+    args = argparser.parse_args()
+
+    pillow = thumbs.pillow_available()
+    render = thumbs.render_thumbnail if pillow \
+             else sleeping_render(args.render_ms / 1000)
+    print(f"Renderer: {'Pillow' if pillow else 'simulated'}")
+    with tempfile.TemporaryDirectory() as workdir:
+        scans = make_scans(workdir, args.n, pillow)
+        cache = thumbs.ThumbnailCache(os.path.join(workdir, "cache"),
+                                      1024 ** 3, render=render)
+        misses = time_gets(cache, scans, args.w)
+        hits = time_gets(cache, scans, args.w)
+        cache.close()
+
+    print(f"{'':<6} {'median ms':>10} {'max ms':>10}")
+    for name, timings in (("miss", misses), ("hit", hits)):
+        print(f"{name:<6} {statistics.median(timings) * 1000:>10.3f} "
+              + f"{max(timings) * 1000:>10.3f}")
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
+import functools
 import os.path
+import re
 import sqlite3
 import threading
 from typing import List
 
+from . import pool
+from .lru import LruSet
+from .tagcache import TagCache
+
 TagList = List[str]
 TagResults = List[int]
 db_name = "receipts.db"
@@ -17,8 +23,10 @@ CREATE TABLE receipt (
         purchase_date DATE,
         expiry_date DATE,
         ocr_text VARCHAR,
+        content_sha256 VARCHAR,
         UNIQUE (filename)
 );
+CREATE UNIQUE INDEX receipt_content_sha256 ON receipt (content_sha256);
 CREATE TABLE tag (
         id INTEGER PRIMARY KEY,
         tag VARCHAR,
@@ -30,52 +38,450 @@ CREATE TABLE receipt_tag_association (
         tag_id INTEGER,
         FOREIGN KEY(receipt_id) REFERENCES receipt (id),
         FOREIGN KEY(tag_id) REFERENCES tag (id)
-);"""
+);
+"""
 
+# Indexes for the tag and date range queries. The association indexes cover
+# the lookups in both directions.
+query_index_statements = [
+"""CREATE UNIQUE INDEX receipt_tag_association_receipt_tag
+        ON receipt_tag_association (receipt_id, tag_id);""",
+"""CREATE INDEX receipt_tag_association_tag_receipt
+        ON receipt_tag_association (tag_id, receipt_id);""",
+"""CREATE INDEX receipt_purchase_date ON receipt (purchase_date);""",
+"""CREATE INDEX receipt_expiry_date ON receipt (expiry_date);"""]
 
-def got_mandatory_receipt_params(params: list) -> None:
-    must_params = ["filename", "purchase_date", "expiry_date", "ocr_text"]
-    must_params.sort()
+schema_script += "\n".join(query_index_statements)
+
+# Receipts whose expiry has been notified about
+expiry_alert_statements = [
+"""CREATE TABLE expiry_alert (
+        receipt_id INTEGER PRIMARY KEY,
+        notified_at TIMESTAMP,
+        FOREIGN KEY(receipt_id) REFERENCES receipt (id)
+);"""]
+
+schema_script += "\n".join(expiry_alert_statements)
+
+# OCR job queue. A job is created for every receipt inserted without text.
+ocr_job_statements = [
+"""CREATE TABLE ocr_job (
+        receipt_id INTEGER PRIMARY KEY,
+        state VARCHAR NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        last_error VARCHAR,
+        FOREIGN KEY(receipt_id) REFERENCES receipt (id)
+);""",
+"""CREATE INDEX ocr_job_state ON ocr_job (state, next_attempt);""",
+"""CREATE TRIGGER receipt_ocr_job AFTER INSERT ON receipt
+WHEN new.ocr_text IS NULL OR new.ocr_text = ''
+BEGIN
+        INSERT OR IGNORE INTO ocr_job (receipt_id) VALUES (new.id);
+END;"""]
+
+schema_script += "\n".join(ocr_job_statements)
+
+# Full-text index over the OCR text and tags, rowid is the receipt ID.
+# Tags are appended as associations are inserted. The prefix indexes keep
+# short prefix queries from merging the doclists of every matching term.
+receipt_fts_statements = [
+"""CREATE VIRTUAL TABLE receipt_fts USING fts5(ocr_text, tags, prefix='2 3 4');""",
+"""CREATE TRIGGER receipt_fts_insert AFTER INSERT ON receipt
+BEGIN
+        INSERT INTO receipt_fts (rowid, ocr_text, tags)
+                VALUES (new.id, coalesce(new.ocr_text, ''), '');
+END;""",
+"""CREATE TRIGGER receipt_fts_update AFTER UPDATE OF ocr_text ON receipt
+BEGIN
+        UPDATE receipt_fts SET ocr_text = coalesce(new.ocr_text, '')
+                WHERE rowid = new.id;
+END;""",
+"""CREATE TRIGGER receipt_fts_delete AFTER DELETE ON receipt
+BEGIN
+        DELETE FROM receipt_fts WHERE rowid = old.id;
+END;""",
+"""CREATE TRIGGER receipt_fts_tag_insert AFTER INSERT ON receipt_tag_association
+BEGIN
+        UPDATE receipt_fts
+                SET tags = CASE WHEN tags = '' THEN '' ELSE tags || ' ' END
+                || (SELECT tag FROM tag WHERE id = new.tag_id)
+                WHERE rowid = new.receipt_id;
+END;""",
+"""CREATE TRIGGER receipt_fts_tag_delete AFTER DELETE ON receipt_tag_association
+BEGIN
+        UPDATE receipt_fts SET tags = coalesce((SELECT group_concat(t.tag, ' ')
+                FROM receipt_tag_association a JOIN tag t ON t.id = a.tag_id
+                WHERE a.receipt_id = old.receipt_id), '')
+                WHERE rowid = old.receipt_id;
+END;"""]
+
+schema_script += "\n".join(receipt_fts_statements)
+
+# Bumped whenever a tag is deleted or renamed, which invalidates the tag
+# caches of every process. New tags don't invalidate anything.
+tag_version_statements = [
+"""CREATE TABLE tag_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+);""",
+"""INSERT INTO tag_version (id, version) VALUES (1, 0);""",
+"""CREATE TRIGGER tag_version_delete AFTER DELETE ON tag
+BEGIN
+        UPDATE tag_version SET version = version + 1;
+END;""",
+"""CREATE TRIGGER tag_version_update AFTER UPDATE ON tag
+WHEN old.tag IS NOT new.tag OR old.id IS NOT new.id
+BEGIN
+        UPDATE tag_version SET version = version + 1;
+END;"""]
+
+schema_script += "\n".join(tag_version_statements)
+
+
+def migrate_content_sha256(cur) -> None:
+    """
+    Add the content hash column. Stored files are named by their hash, so
+    existing rows are filled in from the file names.
+    """
+    cur.execute("ALTER TABLE receipt ADD COLUMN content_sha256 VARCHAR;")
+    hash_pat = re.compile(r"^[0-9a-f]{64}$")
+    seen = set()
+    updates = []
+    for row in cur.execute("SELECT id, filename FROM receipt ORDER BY id;") \
+                  .fetchall():
+        name = os.path.splitext(os.path.basename(row["filename"]))[0]
+        if hash_pat.match(name) and name not in seen:
+            seen.add(name)
+            updates.append((name, row["id"]))
+    cur.executemany("UPDATE receipt SET content_sha256 = ? WHERE id = ?;",
+                    updates)
+    cur.execute("CREATE UNIQUE INDEX receipt_content_sha256 "
+                + "ON receipt (content_sha256);")
+
+def migrate_ocr_job(cur) -> None:
+    for statement in ocr_job_statements:
+        cur.execute(statement)
+    cur.execute("INSERT INTO ocr_job (receipt_id) SELECT id FROM receipt "
+                + "WHERE ocr_text IS NULL OR ocr_text = '';")
+
+def migrate_receipt_fts(cur) -> None:
+    for statement in receipt_fts_statements:
+        cur.execute(statement)
+    cur.execute("INSERT INTO receipt_fts (rowid, ocr_text, tags) "
+                + "SELECT r.id, coalesce(r.ocr_text, ''), "
+                + "coalesce(group_concat(t.tag, ' '), '') FROM receipt r "
+                + "LEFT JOIN receipt_tag_association a ON a.receipt_id = r.id "
+                + "LEFT JOIN tag t ON t.id = a.tag_id GROUP BY r.id;")
+
+def migrate_fts_tag_separator(cur) -> None:
+    """
+    The first tag used to be appended after a space.
+    """
+    cur.execute("DROP TRIGGER receipt_fts_tag_insert;")
+    cur.execute(next(i for i in receipt_fts_statements
+                     if "receipt_fts_tag_insert" in i))
+    cur.execute("UPDATE receipt_fts SET tags = ltrim(tags, ' ') "
+                + "WHERE tags LIKE ' %';")
+
+def migrate_query_indexes(cur) -> None:
+    """
+    INSERT OR IGNORE had nothing to ignore without a unique index, so
+    duplicate associations have to be removed before adding it.
+    """
+    cur.execute("DELETE FROM receipt_tag_association WHERE id NOT IN "
+                + "(SELECT min(id) FROM receipt_tag_association "
+                + "GROUP BY receipt_id, tag_id);")
+    for statement in query_index_statements:
+        cur.execute(statement)
+
+def migrate_expiry_alert(cur) -> None:
+    for statement in expiry_alert_statements:
+        cur.execute(statement)
+
+def migrate_tag_version(cur) -> None:
+    for statement in tag_version_statements:
+        cur.execute(statement)
+
+# Migration N upgrades a database from PRAGMA user_version N to N + 1.
+# schema_script always describes the latest version.
+migrations = [migrate_content_sha256,
+              migrate_ocr_job,
+              migrate_receipt_fts,
+              migrate_query_indexes,
+              migrate_expiry_alert,
+              migrate_tag_version,
+              migrate_fts_tag_separator]
+schema_version = len(migrations)
 
-    params.sort()
+tag_version_q = "SELECT version FROM tag_version WHERE id = 1;"
+# DO UPDATE instead of DO NOTHING so that existing tags return their ID
+upsert_tag_q = "INSERT INTO tag (tag) VALUES (?) ON CONFLICT (tag) " \
+                   + "DO UPDATE SET tag = excluded.tag RETURNING id;"
 
-    if all(k1 == k2 for k1, k2 in zip(must_params, params)):
+def fts_query(query: str) -> str:
+    """
+    Turn free text into an FTS5 query matching all of the words. Words are
+    quoted so that user input can't contain query syntax, a trailing *
+    is kept as a prefix search.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word == "":
+            continue
+        quoted = '"' + word.replace('"', '""') + '"'
+        terms.append(quoted + "*" if prefix else quoted)
+    return " ".join(terms)
+
+def receipts_query(tag_ids: list=None, match_all: bool=True,
+                   date_from: str=None, date_to: str=None,
+                   before_id: int=None, limit: int=20) -> tuple:
+    """
+    Build the query for receipts, newest first, with all (or any) of
+    tag_ids and a purchase date in [date_from, date_to). Returns the SQL
+    and its parameters.
+    """
+    conds = []
+    params = []
+    if tag_ids:
+        qmarks = ", ".join("?" * len(tag_ids))
+        if match_all:
+            conds.append("r.id IN (SELECT receipt_id FROM "
+                         + "receipt_tag_association WHERE tag_id IN "
+                         + f"({qmarks}) GROUP BY receipt_id "
+                         + "HAVING count(*) = ?)")
+            params.extend(tag_ids)
+            params.append(len(tag_ids))
+        else:
+            conds.append("r.id IN (SELECT receipt_id FROM "
+                         + f"receipt_tag_association WHERE tag_id IN ({qmarks}))")
+            params.extend(tag_ids)
+    if date_from is not None:
+        conds.append("r.purchase_date >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conds.append("r.purchase_date < ?")
+        params.append(date_to)
+    if before_id is not None:
+        conds.append("r.id < ?")
+        params.append(before_id)
+
+    where = "WHERE " + " AND ".join(conds) if len(conds) > 0 else ""
+    q = "SELECT r.id, r.filename, r.purchase_date, r.expiry_date, " \
+            + "(SELECT group_concat(t.tag, ' ') FROM " \
+            + "receipt_tag_association a JOIN tag t ON t.id = a.tag_id " \
+            + "WHERE a.receipt_id = r.id) AS tags " \
+            + f"FROM receipt r {where} ORDER BY r.id DESC LIMIT ?;"
+    params.append(limit)
+    return q, params
+
+def export_conditions(tag_ids: list=None, match_all: bool=True,
+                      date_from: str=None, date_to: str=None) -> tuple:
+    """
+    WHERE conditions and parameters of an export, like receipts_query but
+    with the tags checked per receipt so that a chunk of receipts costs the
+    same however many receipts match the tags.
+    """
+    conds = []
+    params = []
+    if tag_ids:
+        qmarks = ", ".join("?" * len(tag_ids))
+        tagged = "FROM receipt_tag_association a WHERE a.receipt_id = r.id " \
+                     + f"AND a.tag_id IN ({qmarks})"
+        if match_all:
+            conds.append(f"(SELECT count(*) {tagged}) = ?")
+            params.extend(tag_ids)
+            params.append(len(tag_ids))
+        else:
+            conds.append(f"EXISTS (SELECT 1 {tagged})")
+            params.extend(tag_ids)
+    if date_from is not None:
+        conds.append("r.purchase_date >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conds.append("r.purchase_date < ?")
+        params.append(date_to)
+    return conds, params
+
+# Receipt counts per group of an export
+export_groups = {
+    "tag": ("t.tag", "JOIN receipt_tag_association g ON g.receipt_id = r.id "
+                     + "JOIN tag t ON t.id = g.tag_id"),
+    "month": ("substr(r.purchase_date, 1, 7)", ""),
+}
+
+mandatory_receipt_params = ["filename", "purchase_date", "expiry_date",
+                            "ocr_text"]
+optional_receipt_params = ["content_sha256"]
+
+def got_mandatory_receipt_params(params: list) -> None:
+    must_params = mandatory_receipt_params
+    known_params = must_params + optional_receipt_params
+
+    if all(k in params for k in must_params) \
+            and all(k in known_params for k in params):
         return True
     return False
 
+def timed(method):
+    """
+    Observe the duration of a DbEngine method in its query_seconds
+    histogram, if there's one.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.query_seconds is None:
+            return method(self, *args, **kwargs)
+        with self.query_seconds.labels(name).time():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class DbEngine(object):
-    def __init__(self, logger, db_path:str=db_name):
+    def __init__(self, logger, db_path:str=db_name, pool_size:int=0,
+                 synchronous:str=None, busy_timeout:int=None,
+                 recent_hashes:int=10000, metrics=None):
+        """
+        With pool_size 0 all threads share one connection behind a lock.
+        Otherwise the database is opened in WAL mode with pool_size read
+        connections and a dedicated writer thread, see pool.ConnectionPool.
+
+        The recent_hashes most recently seen content hashes are kept in
+        memory so that duplicate uploads are detected without a query. Tag
+        IDs are cached too, so only unseen tags are looked up.
+
+        With a metrics.Registry as metrics, the time spent in each method
+        is observed in a histogram labeled by the method name.
+        """
         self.conn = None
         self.cur = None
+        self.pool = None
         self.db_path = db_path
         self.lock = threading.Lock()
         self.logger = logger
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.recent_hashes = LruSet(recent_hashes)
+        self.tag_cache = TagCache()
+        self.query_seconds = None
+        if metrics is not None:
+            self.query_seconds = metrics.histogram(
+                    "receipts_db_seconds", "Time spent in DbEngine methods",
+                    ["method"])
 
-        if not os.path.exists(self.db_path):
-            self.__init_connection()
-            self.__init_schema()
+        self.__init_schema()
+
+        if pool_size > 0:
+            self.pool = pool.ConnectionPool(self.db_path, pool_size,
+                                            synchronous=synchronous,
+                                            busy_timeout=busy_timeout)
         else:
             self.__init_connection()
+        self.__warm_recent_hashes()
+        self.__warm_tag_cache()
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         if self.cur is not None:
             self.cur.close()
+            self.cur = None
         if self.conn is not None:
             self.conn.close()
+            self.conn = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def __init_schema(self):
-        schemas = ""
-        #with open(schema_file, "r") as f:
-        #    schemas = f.read()
-        with self.lock:
-            res = self.cur.executescript(schema_script)
-            self.conn.commit()
+        """
+        Create the schema for a new database or run the migrations which
+        haven't been applied to an existing one yet.
+        """
+        conn = pool.connect(self.db_path, isolation_level=None)
+        try:
+            cur = conn.cursor()
+            version = cur.execute("PRAGMA user_version;").fetchone()[0]
+            tables = cur.execute("SELECT count(*) FROM sqlite_master WHERE "
+                                 + "type = 'table' AND name = 'receipt';") \
+                        .fetchone()[0]
+            if tables == 0:
+                cur.executescript(f"BEGIN; {schema_script} "
+                                  + f"PRAGMA user_version = {schema_version}; "
+                                  + "COMMIT;")
+                return
+
+            for i in range(version, schema_version):
+                self.logger.info(f"Migrating {self.db_path} to schema version {i + 1}")
+                cur.execute("BEGIN;")
+                try:
+                    migrations[i](cur)
+                    cur.execute(f"PRAGMA user_version = {i + 1};")
+                    cur.execute("COMMIT;")
+                except sqlite3.Error:
+                    cur.execute("ROLLBACK;")
+                    raise
+        finally:
+            conn.close()
+
+    def __warm_recent_hashes(self):
+        q = "SELECT content_sha256 FROM receipt WHERE content_sha256 " \
+                + "IS NOT NULL ORDER BY id DESC LIMIT ?;"
+        rows = self.__read(lambda cur: cur.execute(
+                q, (self.recent_hashes.capacity,)).fetchall())
+        for row in reversed(rows):
+            self.recent_hashes.add(row["content_sha256"])
+
+    def __warm_tag_cache(self):
+        def load(cur):
+            version = cur.execute(tag_version_q).fetchone()[0]
+            ids = {row["tag"]: row["id"] for row in
+                   cur.execute("SELECT id, tag FROM tag;")}
+            return version, ids
+        version, ids = self.__read(load)
+        self.tag_cache.check(version)
+        self.tag_cache.add(ids, version)
 
     def __init_connection(self):
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = pool.connect(self.db_path, synchronous=self.synchronous,
+                                 busy_timeout=self.busy_timeout,
+                                 check_same_thread=False)
         self.cur = self.conn.cursor()
 
+    def __write(self, fn):
+        """
+        Run fn(cursor) in a write transaction and return its result.
+        """
+        if self.pool is not None:
+            return self.pool.write(fn)
+        with self.lock:
+            try:
+                result = fn(self.cur)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            return result
+
+    def __read(self, fn):
+        """
+        Run fn(cursor) for reading and return its result.
+        """
+        if self.pool is not None:
+            with self.pool.reader() as conn:
+                cur = conn.cursor()
+                try:
+                    return fn(cur)
+                finally:
+                    cur.close()
+        with self.lock:
+            return fn(self.cur)
+
+    @timed
     def insert_receipt(self, receipt: dict) -> int:
         inserted_row_id = -1
         receipt_keys = [k for k in receipt.keys()]
@@ -84,39 +490,394 @@ class DbEngine(object):
             placeholders = ":" + ", :".join(receipt.keys())
             insert_q = f"INSERT OR IGNORE INTO receipt({cols}) " \
                                + f"VALUES ({placeholders});"
-            with self.lock:
-                self.cur.execute(insert_q, receipt)
-                self.conn.commit()
-                inserted_row_id = self.cur.lastrowid
+            def insert(cur):
+                cur.execute(insert_q, receipt)
+                # Ignored due to an existing filename or content hash
+                if cur.rowcount == 0:
+                    return -1
+                return cur.lastrowid
+            inserted_row_id = self.__write(insert)
+            if inserted_row_id != -1 and receipt.get("content_sha256"):
+                self.recent_hashes.add(receipt["content_sha256"])
         else:
             self.logger.info(f"Won't insert {receipt} due missing mandatory parameters")
         return inserted_row_id
 
+    @timed
+    def has_content(self, content_sha256: str) -> bool:
+        """
+        Whether a receipt with the given content hash exists.
+        """
+        if content_sha256 in self.recent_hashes:
+            return True
+        q = "SELECT 1 FROM receipt WHERE content_sha256 = ?;"
+        found = self.__read(lambda cur: cur.execute(
+                q, (content_sha256,)).fetchone()) is not None
+        if found:
+            self.recent_hashes.add(content_sha256)
+        return found
+
+    @timed
+    def has_filename(self, filename: str) -> bool:
+        q = "SELECT 1 FROM receipt WHERE filename = ?;"
+        return self.__read(lambda cur: cur.execute(
+                q, (filename,)).fetchone()) is not None
+
+    @timed
+    def get_receipt(self, receipt_id: int):
+        """
+        The receipt row with the given ID, or None.
+        """
+        q = "SELECT * FROM receipt WHERE id = ?;"
+        row = self.__read(lambda cur: cur.execute(q, (receipt_id,)).fetchone())
+        return dict(row) if row is not None else None
+
+    @timed
+    def list_receipt_files(self, after_id: int, limit: int) -> list:
+        """
+        IDs, file names and content hashes of up to limit receipts after
+        after_id, in ID order.
+        """
+        q = "SELECT id, filename, content_sha256 FROM receipt " \
+                + "WHERE id > ? ORDER BY id LIMIT ?;"
+        return self.__read(lambda cur: [dict(i) for i in
+                                        cur.execute(q, (after_id, limit))])
+
+    @timed
+    def update_receipt_filenames(self, updates: list) -> None:
+        """
+        Set the file names of receipts in one transaction. updates is a
+        list of (receipt_id, filename).
+        """
+        q = "UPDATE receipt SET filename = ? WHERE id = ?;"
+        rows = [(filename, receipt_id) for receipt_id, filename in updates]
+        self.__write(lambda cur: cur.executemany(q, rows))
+
+    @timed
+    def claim_ocr_jobs(self, limit: int, now: float) -> list:
+        """
+        Mark up to limit due OCR jobs as running and return them with the
+        receipt file names, oldest first.
+        """
+        select_q = "SELECT j.receipt_id, j.attempts, r.filename " \
+                       + "FROM ocr_job j JOIN receipt r ON r.id = j.receipt_id " \
+                       + "WHERE j.state = 'pending' AND j.next_attempt <= ? " \
+                       + "ORDER BY j.next_attempt, j.receipt_id LIMIT ?;"
+        update_q = "UPDATE ocr_job SET state = 'running' WHERE receipt_id = ?;"
+        def claim(cur):
+            jobs = [dict(i) for i in cur.execute(select_q, (now, limit))]
+            cur.executemany(update_q, [(i["receipt_id"],) for i in jobs])
+            return jobs
+        return self.__write(claim)
+
+    @timed
+    def reset_ocr_jobs(self, receipt_ids: list=None) -> int:
+        """
+        Return jobs left running by a previous process to the queue, or
+        only those of receipt_ids, e.g. claimed jobs which couldn't be run.
+        """
+        q = "UPDATE ocr_job SET state = 'pending' WHERE state = 'running'"
+        def reset(cur):
+            if receipt_ids is None:
+                cur.execute(q + ";")
+                return cur.rowcount
+            cur.executemany(q + " AND receipt_id = ?;",
+                            [(i,) for i in receipt_ids])
+            return cur.rowcount
+        return self.__write(reset)
+
+    @timed
+    def complete_ocr_job(self, receipt_id: int, ocr_text: str) -> None:
+        def complete(cur):
+            cur.execute("UPDATE receipt SET ocr_text = ? WHERE id = ?;",
+                        (ocr_text, receipt_id))
+            cur.execute("UPDATE ocr_job SET state = 'done', "
+                        + "attempts = attempts + 1, last_error = NULL "
+                        + "WHERE receipt_id = ?;", (receipt_id,))
+        self.__write(complete)
+
+    @timed
+    def fail_ocr_job(self, receipt_id: int, error: str,
+                     next_attempt: float=None) -> None:
+        """
+        Record a failed attempt. The job is retried at next_attempt, or
+        given up on when it's None.
+        """
+        if next_attempt is None:
+            q = "UPDATE ocr_job SET state = 'failed', " \
+                    + "attempts = attempts + 1, last_error = ? " \
+                    + "WHERE receipt_id = ?;"
+            params = (error, receipt_id)
+        else:
+            q = "UPDATE ocr_job SET state = 'pending', " \
+                    + "attempts = attempts + 1, last_error = ?, " \
+                    + "next_attempt = ? WHERE receipt_id = ?;"
+            params = (error, next_attempt, receipt_id)
+        self.__write(lambda cur: cur.execute(q, params))
+
+    @timed
+    def count_ocr_jobs(self) -> dict:
+        """
+        Number of OCR jobs in each state.
+        """
+        q = "SELECT state, count(*) AS jobs FROM ocr_job GROUP BY state;"
+        rows = self.__read(lambda cur: cur.execute(q).fetchall())
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update({i["state"]: i["jobs"] for i in rows})
+        return counts
+
+    @timed
+    def search_receipts(self, query: str, limit: int=20,
+                        before_id: int=None) -> list:
+        """
+        Full-text search over the OCR text and tags, newest first. Pages
+        are fetched with keyset pagination: pass the last returned ID as
+        before_id to get the next page.
+        """
+        match = fts_query(query)
+        if match == "":
+            return []
+        q = "SELECT r.id, r.filename, r.purchase_date, r.expiry_date, " \
+                + "f.tags, snippet(receipt_fts, 0, '[', ']', '...', 10) " \
+                + "AS snippet FROM receipt_fts f " \
+                + "JOIN receipt r ON r.id = f.rowid " \
+                + "WHERE receipt_fts MATCH ? AND f.rowid < ? " \
+                + "ORDER BY f.rowid DESC LIMIT ?;"
+        params = (match, before_id if before_id is not None else 2 ** 63 - 1,
+                  limit)
+        return self.__read(lambda cur: [dict(i) for i in
+                                        cur.execute(q, params).fetchall()])
+
+    @timed
+    def query_receipts(self, tags: TagList=None, match_all: bool=True,
+                       date_from: str=None, date_to: str=None,
+                       before_id: int=None, limit: int=20) -> list:
+        """
+        Receipts with all (or any) of the tags, purchased within
+        [date_from, date_to), newest first. Pass the last returned ID as
+        before_id to get the next page.
+        """
+        def query(cur):
+            tag_ids = None
+            if tags:
+                tag_ids = self.__tag_ids(cur, tags)
+                if len(tag_ids) == 0 \
+                        or (match_all and len(tag_ids) < len(set(tags))):
+                    return []
+            q, params = receipts_query(tag_ids, match_all, date_from,
+                                       date_to, before_id, limit)
+            return [dict(i) for i in cur.execute(q, params).fetchall()]
+        return self.__read(query)
+
+    def export_receipts(self, tags: TagList=None, match_all: bool=True,
+                        date_from: str=None, date_to: str=None,
+                        chunk_size: int=1000):
+        """
+        Generate the receipts with all (or any) of the tags, purchased
+        within [date_from, date_to), oldest first. Rows are read chunk_size
+        at a time after the last ID of the previous chunk, each chunk in a
+        read of its own, so a slow consumer holds neither memory nor a
+        connection.
+        """
+        tag_ids = None
+        if tags:
+            tag_ids = self.__read(lambda cur: self.__tag_ids(cur, tags))
+            if len(tag_ids) == 0 \
+                    or (match_all and len(tag_ids) < len(set(tags))):
+                return
+        conds, params = export_conditions(tag_ids, match_all, date_from,
+                                          date_to)
+        conds.append("r.id > ?")
+        q = "SELECT r.id, r.filename, r.purchase_date, r.expiry_date, " \
+                + "r.content_sha256, (SELECT group_concat(t.tag, ' ') FROM " \
+                + "receipt_tag_association a JOIN tag t ON t.id = a.tag_id " \
+                + "WHERE a.receipt_id = r.id) AS tags FROM receipt r " \
+                + f"WHERE {' AND '.join(conds)} ORDER BY r.id LIMIT ?;"
+
+        after_id = 0
+        while True:
+            rows = self.__read(lambda cur: [dict(i) for i in cur.execute(
+                    q, params + [after_id, chunk_size])])
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            after_id = rows[-1]["id"]
+
+    @timed
+    def export_counts(self, group: str, tags: TagList=None,
+                      match_all: bool=True, date_from: str=None,
+                      date_to: str=None) -> list:
+        """
+        Number of receipts and of those with an expiry date per tag or
+        purchase month (group), filtered like export_receipts.
+        """
+        key, join = export_groups[group]
+        def query(cur):
+            tag_ids = None
+            if tags:
+                tag_ids = self.__tag_ids(cur, tags)
+                if len(tag_ids) == 0 \
+                        or (match_all and len(tag_ids) < len(set(tags))):
+                    return []
+            conds, params = export_conditions(tag_ids, match_all, date_from,
+                                              date_to)
+            where = "WHERE " + " AND ".join(conds) if len(conds) > 0 else ""
+            q = f"SELECT {key} AS {group}, count(*) AS receipts, " \
+                    + "count(r.expiry_date) AS with_expiry " \
+                    + f"FROM receipt r {join} {where} " \
+                    + f"GROUP BY {key} ORDER BY {key};"
+            return [dict(i) for i in cur.execute(q, params).fetchall()]
+        return self.__read(query)
+
+    @timed
+    def upcoming_expiries(self, after_id: int=0) -> list:
+        """
+        Receipts with an expiry date which haven't been notified about, also
+        those which already expired, in expiry order. With after_id only
+        the receipts inserted after it.
+        """
+        q = "SELECT r.id, r.filename, r.expiry_date FROM receipt r " \
+                + "WHERE r.expiry_date IS NOT NULL AND r.id > ? AND NOT EXISTS " \
+                + "(SELECT 1 FROM expiry_alert e WHERE e.receipt_id = r.id) " \
+                + "ORDER BY r.expiry_date;"
+        return self.__read(lambda cur: [dict(i) for i in
+                                        cur.execute(q, (after_id,)).fetchall()])
+
+    @timed
+    def mark_expiry_notified(self, receipt_ids: list, notified_at) -> None:
+        q = "INSERT OR IGNORE INTO expiry_alert (receipt_id, notified_at) " \
+                + "VALUES (?, ?);"
+        rows = [(i, notified_at) for i in receipt_ids]
+        self.__write(lambda cur: cur.executemany(q, rows))
+
+    @timed
     def insert_tags(self, tags: list) -> int:
-        rows_inserted = 0
-        insert_q = f"INSERT OR IGNORE INTO tag (tag) VALUES (?);"
-        # Generate row factor format and remove duplicates
-        row_tags = [(i,) for i in set(tags)]
-        with self.lock:
-            self.cur.executemany(insert_q, row_tags)
-            self.conn.commit()
-            rows_inserted = self.cur.rowcount
-        return rows_inserted
+        """
+        Create the tags which don't exist yet. Returns the number of tags
+        which weren't cached.
+        """
+        def insert(cur):
+            return self.__resolve_tags(cur, tags, create=True)
+        _, version, new = self.__write(insert)
+        self.tag_cache.add(new, version)
+        return len(new)
 
+    @timed
     def get_tag_ids(self, tags: TagList) -> TagResults:
-        uniq_tags = [t for t in set(tags)]
-        qmarks = "{}".format(", ".join("?" * len(tags)))
-        q = f"SELECT id FROM tag WHERE tag in ({qmarks});"
-        result = self.cur.execute(q, uniq_tags)
-        return [i["id"] for i in result.fetchall()]
+        return self.__read(lambda cur: self.__tag_ids(cur, tags))
 
-    def insert_receipt_tags_association(self, receipt_id: int, tags: TagList):
-        tag_ids = self.get_tag_ids(tags)
-        rows = [(receipt_id, tag_id) for tag_id in tag_ids]
+    def __tag_ids(self, cur, tags: TagList) -> TagResults:
+        ids, version, new = self.__resolve_tags(cur, tags, create=False)
+        self.tag_cache.add(new, version)
+        return list(ids.values())
 
+    def __resolve_tags(self, cur, tags: TagList, create: bool) -> tuple:
+        """
+        IDs of the existing tags, from the cache where possible. With
+        create, missing tags are inserted. Returns the IDs by tag, the tag
+        version they're valid for and the IDs which weren't cached. New
+        IDs mustn't be cached before the transaction has been committed.
+        """
+        version = cur.execute(tag_version_q).fetchone()[0]
+        self.tag_cache.check(version)
+        ids, missing = self.tag_cache.lookup(set(tags))
+        if create:
+            new = {tag: cur.execute(upsert_tag_q, (tag,)).fetchone()[0]
+                   for tag in missing}
+        else:
+            new = {row["tag"]: row["id"] for row in self.__select_in(
+                    cur, "SELECT id, tag FROM tag WHERE tag IN ({});",
+                    missing)}
+        ids.update(new)
+        return ids, version, new
+
+    @timed
+    def insert_receipt_tags_association(self, receipt_id: int, tags: TagList):
+        """
+        Associate the receipt with tags, creating the tags if needed.
+        """
         insert_q = "INSERT OR IGNORE INTO receipt_tag_association " \
                        + "(receipt_id, tag_id) VALUES (?, ?);"
-        with self.lock:
-            self.cur.executemany(insert_q, rows)
-            self.conn.commit()
+        def insert(cur):
+            ids, version, new = self.__resolve_tags(cur, tags, create=True)
+            rows = [(receipt_id, tag_id) for tag_id in ids.values()]
+            cur.executemany(insert_q, rows)
+            return version, new
+        version, new = self.__write(insert)
+        self.tag_cache.add(new, version)
+
+    @timed
+    def insert_receipts(self, items: list) -> list:
+        """
+        Insert many receipts and their tags in a single transaction.
+        items is a list of (receipt, tags) tuples. Returns the receipt IDs
+        in the same order, -1 for the receipts which weren't inserted.
+        """
+        receipt_ids = [-1] * len(items)
+        valid = [(pos, r, t) for pos, (r, t) in enumerate(items)
+                 if got_mandatory_receipt_params([k for k in r.keys()])]
+        if len(valid) < len(items):
+            self.logger.info(f"Won't insert {len(items) - len(valid)} "
+                             + "receipts due missing mandatory parameters")
+        if len(valid) == 0:
+            return receipt_ids
+
+        columns = mandatory_receipt_params + optional_receipt_params
+        valid = [(pos, {c: r.get(c) for c in columns}, t)
+                 for pos, r, t in valid]
+        cols = ", ".join(columns)
+        placeholders = ":" + ", :".join(columns)
+        insert_receipt_q = f"INSERT OR IGNORE INTO receipt({cols}) " \
+                               + f"VALUES ({placeholders});"
+        insert_assoc_q = "INSERT OR IGNORE INTO receipt_tag_association " \
+                             + "(receipt_id, tag_id) VALUES (?, ?);"
+
+        def insert(cur):
+            filenames = [r["filename"] for _, r, _ in valid]
+            existing = set(row["filename"] for row in
+                           self.__select_in(cur, "SELECT filename FROM receipt "
+                                            + "WHERE filename IN ({})",
+                                            filenames))
+            new = [(pos, r, t) for pos, r, t in valid
+                   if r["filename"] not in existing]
+
+            cur.executemany(insert_receipt_q, [r for _, r, _ in new])
+            all_tags = set(tag for _, _, t in new for tag in t)
+            ids_by_tag, version, new_tags = self.__resolve_tags(cur, all_tags,
+                                                                create=True)
+
+            ids_by_filename = {row["filename"]: row["id"] for row in
+                self.__select_in(cur, "SELECT id, filename FROM receipt "
+                                 + "WHERE filename IN ({})",
+                                 [r["filename"] for _, r, _ in new])}
+
+            rows = []
+            for pos, r, t in new:
+                # Missing when ignored due to an existing content hash
+                receipt_id = ids_by_filename.get(r["filename"], -1)
+                if receipt_id == -1:
+                    continue
+                receipt_ids[pos] = receipt_id
+                rows.extend((receipt_id, ids_by_tag[tag]) for tag in set(t))
+            cur.executemany(insert_assoc_q, rows)
+            return version, new_tags
+
+        version, new_tags = self.__write(insert)
+        self.tag_cache.add(new_tags, version)
+        for (pos, r, _) in valid:
+            if receipt_ids[pos] != -1 and r["content_sha256"]:
+                self.recent_hashes.add(r["content_sha256"])
+        return receipt_ids
 
+    def __select_in(self, cur, q: str, values: list,
+                    chunk_size: int=500) -> list:
+        """
+        Run a SELECT with an IN (...) clause in chunks so that long value
+        lists don't hit the SQLite host parameter limit.
+        """
+        rows = []
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            qmarks = ", ".join("?" * len(chunk))
+            rows.extend(cur.execute(q.format(qmarks), chunk).fetchall())
+        return rows
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import OrderedDict
+
+
+class LruSet(object):
+    """
+    Thread safe set which holds at most capacity items, evicting the least
+    recently used one first.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, item) -> bool:
+        with self.lock:
+            if item not in self.items:
+                return False
+            self.items.move_to_end(item)
+            return True
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, item) -> None:
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.items[item] = None
+            self.items.move_to_end(item)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def discard(self, item) -> None:
+        with self.lock:
+            self.items.pop(item, None)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import contextlib
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+def connect(db_path: str, synchronous: str=None, busy_timeout: int=None,
+            wal: bool=False, **kwargs) -> sqlite3.Connection:
+    """
+    Open a connection and apply the configured pragmas.
+    """
+    conn = sqlite3.connect(db_path, **kwargs)
+    conn.row_factory = sqlite3.Row
+    if wal:
+        conn.execute("PRAGMA journal_mode=WAL;")
+    if synchronous is not None:
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode: {synchronous}")
+        conn.execute(f"PRAGMA synchronous={synchronous.upper()};")
+    if busy_timeout is not None:
+        conn.execute(f"PRAGMA busy_timeout={int(busy_timeout)};")
+    return conn
+
+
+class ConnectionPool(object):
+    """
+    WAL mode connections for one database: a bounded set of read
+    connections which are checked out per thread for the duration of a
+    query, and one writer connection owned by a dedicated thread.
+
+    Write jobs are callables taking a cursor. The writer runs every job
+    queued at the same time in one transaction, each inside its own
+    savepoint, so concurrent writers share a single commit.
+    """
+    max_group_size = 256
+
+    def __init__(self, db_path: str, size: int, synchronous: str=None,
+                 busy_timeout: int=None):
+        self.db_path = db_path
+        self.size = size
+        self.synchronous = synchronous if synchronous is not None else "NORMAL"
+        self.busy_timeout = busy_timeout
+        self.readers = queue.LifoQueue()
+        self.readers_created = 0
+        self.readers_lock = threading.Lock()
+        self.readers_available = threading.Semaphore(size)
+        self.jobs = queue.Queue()
+
+        self.writer_conn = self.__connect(isolation_level=None)
+        self.writer = threading.Thread(target=self.__write_loop,
+                                       name="DbEngineWriter", daemon=True)
+        self.writer.start()
+
+    def __connect(self, **kwargs) -> sqlite3.Connection:
+        return connect(self.db_path, synchronous=self.synchronous,
+                       busy_timeout=self.busy_timeout, wal=True,
+                       check_same_thread=False, **kwargs)
+
+    @contextlib.contextmanager
+    def reader(self):
+        """
+        Check out a read connection, blocking when all of them are in use.
+        """
+        self.readers_available.acquire()
+        try:
+            try:
+                conn = self.readers.get_nowait()
+            except queue.Empty:
+                conn = self.__connect()
+                with self.readers_lock:
+                    self.readers_created += 1
+            try:
+                yield conn
+            finally:
+                # Don't keep a read transaction open between checkouts
+                conn.rollback()
+                self.readers.put(conn)
+        finally:
+            self.readers_available.release()
+
+    def write(self, fn):
+        """
+        Queue fn(cursor) for the writer and wait for its result.
+        """
+        future = Future()
+        self.jobs.put((fn, future))
+        return future.result()
+
+    def close(self) -> None:
+        if self.writer.is_alive():
+            self.jobs.put(None)
+            self.writer.join()
+        self.writer_conn.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __write_loop(self) -> None:
+        cur = self.writer_conn.cursor()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            group = [job]
+            while len(group) < self.max_group_size:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                group.append(job)
+            self.__run_group(cur, group)
+        cur.close()
+
+    def __run_group(self, cur, group: list) -> None:
+        results = []
+        try:
+            cur.execute("BEGIN;")
+            for fn, future in group:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cur.execute("SAVEPOINT job;")
+                try:
+                    results.append((future, True, fn(cur)))
+                    cur.execute("RELEASE job;")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO job;")
+                    cur.execute("RELEASE job;")
+                    results.append((future, False, e))
+            cur.execute("COMMIT;")
+        except Exception as e:
+            if self.writer_conn.in_transaction:
+                cur.execute("ROLLBACK;")
+            for fn, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, ok, value in results:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
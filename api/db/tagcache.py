@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import threading
+
+
+class TagCache(object):
+    """
+    Thread safe tag to ID mapping. version is the tag_version counter of
+    the database when the mapping was valid. The counter is bumped when a
+    tag is deleted or renamed, possibly by another process, and the
+    mapping is dropped when it's seen to change. New tags don't bump it
+    since they can't make cached IDs wrong.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def check(self, version: int) -> None:
+        with self.lock:
+            if version != self.version:
+                self.ids = {}
+                self.version = version
+
+    def lookup(self, tags) -> tuple:
+        """
+        Returns a dict of the cached tags and a list of the missing ones.
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for tag in tags:
+                tag_id = self.ids.get(tag)
+                if tag_id is None:
+                    missing.append(tag)
+                else:
+                    found[tag] = tag_id
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def add(self, ids: dict, version: int) -> None:
+        """
+        Cache IDs read at version, unless the mapping has moved on since.
+        """
+        with self.lock:
+            if version == self.version:
+                self.ids.update(ids)
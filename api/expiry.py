@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import datetime
+import heapq
+import json
+import logging
+import threading
+import urllib.request
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_date(value) -> datetime.datetime:
+    """
+    Dates are stored either as %Y-%m-%d or with a time.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+class NotificationSink(object):
+    """
+    Receives a notification for every receipt which is about to expire.
+    """
+    def notify(self, alert: dict) -> None:
+        raise NotImplementedError
+
+class FileSink(NotificationSink):
+    """
+    Appends the notifications to a file, one JSON object per line.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def notify(self, alert: dict) -> None:
+        with open(self.path, "a") as f:
+            f.write(json.dumps(alert) + "\n")
+
+class WebhookSink(NotificationSink):
+    """
+    POSTs the notifications as JSON to a URL.
+    """
+    def __init__(self, url: str, timeout: float=10.0):
+        self.url = url
+        self.timeout = timeout
+
+    def notify(self, alert: dict) -> None:
+        req = urllib.request.Request(self.url,
+                                     data=json.dumps(alert).encode(),
+                                     headers={"Content-Type":
+                                              "application/json"},
+                                     method="POST")
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            resp.read()
+
+
+class ExpiryScheduler(object):
+    """
+    Notifies about receipts expiring within lead_time. Upcoming expiries
+    are loaded once from the expiry_date index into a min-heap and new
+    receipts are pushed to it as they're inserted, so finding what expires
+    next never scans the table. Notified receipts are recorded in the
+    database and aren't loaded again, while receipts which expired
+    without a notification, e.g. while the service was down, are notified
+    about as expired. Receipts inserted by other processes aren't pushed
+    to the heap, so with poll_inserts set the receipts added since the
+    last load are read before every check.
+    """
+    def __init__(self, dbeng, sink: NotificationSink,
+                 lead_time: datetime.timedelta=datetime.timedelta(days=30),
+                 check_interval: float=3600.0, clock=datetime.datetime.now,
+                 poll_inserts: bool=False):
+        self.dbeng = dbeng
+        self.sink = sink
+        self.lead_time = lead_time
+        self.check_interval = check_interval
+        self.clock = clock
+        self.poll_inserts = poll_inserts
+        self.heap = []
+        # Receipts in the heap, so that polled ones aren't pushed twice
+        self.queued = set()
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def load(self) -> int:
+        rows = self.dbeng.upcoming_expiries()
+        # Rows are already in expiry order, which is a valid heap
+        with self.lock:
+            self.heap = [(parse_date(i["expiry_date"]), i["id"], i["filename"])
+                         for i in rows]
+            heapq.heapify(self.heap)
+            self.queued = set(i["id"] for i in rows)
+            self.last_id = max(self.queued, default=0)
+        logging.info(f"Expiry: Loaded {len(rows)} upcoming expiries")
+        return len(rows)
+
+    def poll(self) -> int:
+        """
+        Push the receipts inserted since the last load or poll. Returns
+        the number of receipts which weren't in the heap yet.
+        """
+        rows = self.dbeng.upcoming_expiries(after_id=self.last_id)
+        added = 0
+        with self.lock:
+            for i in rows:
+                self.last_id = max(self.last_id, i["id"])
+                if i["id"] not in self.queued:
+                    heapq.heappush(self.heap, (parse_date(i["expiry_date"]),
+                                               i["id"], i["filename"]))
+                    self.queued.add(i["id"])
+                    added += 1
+        return added
+
+    def add(self, receipt_id: int, filename: str, expiry_date) -> None:
+        if expiry_date is None:
+            return
+        with self.lock:
+            if receipt_id in self.queued:
+                return
+            heapq.heappush(self.heap,
+                           (parse_date(expiry_date), receipt_id, filename))
+            self.queued.add(receipt_id)
+        self.wakeup.set()
+
+    def next_expiry(self):
+        """
+        The next (expiry_date, receipt_id, filename) or None.
+        """
+        with self.lock:
+            return self.heap[0] if len(self.heap) > 0 else None
+
+    def check(self) -> list:
+        """
+        Notify about every receipt expiring within lead_time from now.
+        Returns the notifications which were sent.
+        """
+        now = self.clock()
+        horizon = now + self.lead_time
+        due = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= horizon:
+                due.append(heapq.heappop(self.heap))
+
+        sent = []
+        for pos, (expiry_date, receipt_id, filename) in enumerate(due):
+            alert = {"receipt_id": receipt_id,
+                     "filename": filename,
+                     "expiry_date": expiry_date.strftime(DATE_FORMAT),
+                     "days_left": (expiry_date - now).days,
+                     "expired": expiry_date <= now}
+            try:
+                self.sink.notify(alert)
+                sent.append(alert)
+            except Exception as e:
+                # Try the rest again on the next check
+                logging.error(f"Expiry: Notifying about {receipt_id} failed: {e}")
+                with self.lock:
+                    for entry in due[pos:]:
+                        heapq.heappush(self.heap, entry)
+                break
+        if len(sent) > 0:
+            self.dbeng.mark_expiry_notified([i["receipt_id"] for i in sent],
+                                            now.strftime(DATE_FORMAT))
+            with self.lock:
+                self.queued.difference_update(i["receipt_id"] for i in sent)
+        return sent
+
+    def start(self) -> None:
+        self.load()
+        self.thread = threading.Thread(target=self.__run,
+                                       name="ExpiryScheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __run(self) -> None:
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                if self.poll_inserts:
+                    self.poll()
+                self.check()
+            except Exception as e:
+                logging.error(f"Expiry: Check failed: {e}")
+            timeout = self.check_interval
+            upcoming = self.next_expiry()
+            if upcoming is not None:
+                due_in = (upcoming[0] - self.lead_time
+                          - self.clock()).total_seconds()
+                timeout = max(1.0, min(timeout, due_in))
+            self.wakeup.wait(timeout)
@@ -0,0 +1,30 @@
+"""
+gunicorn settings, read from the [server] section of the configuration
+file given in RECEIPTS_CONFIG. See wsgi.py.
+"""
+
+import configparser
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from receipts_api import server_workers
+
+receipts_config = configparser.ConfigParser()
+receipts_config.read(os.environ.get("RECEIPTS_CONFIG", "receipts.cfg"))
+
+bind = receipts_config.get("server", "bind", fallback="127.0.0.1:5555")
+workers = server_workers(receipts_config)
+threads = receipts_config.getint("server", "threads", fallback=4)
+worker_class = "gthread"
+timeout = receipts_config.getint("server", "timeout", fallback=60)
+# On SIGTERM workers stop accepting and finish their requests this long
+graceful_timeout = receipts_config.getint("server", "graceful_timeout",
+                                          fallback=30)
+# The app must be loaded after forking, database connections can't be
+# shared between processes
+preload_app = False
+
+def worker_exit(server, worker):
+    import receipts_api
+    receipts_api.shutdown(graceful_timeout)
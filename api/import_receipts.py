@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Import a directory tree of receipt scans, such as YYYY/MM/shop_tags.jpg,
+straight to the database and storage of the API. Files are hashed in a
+pool of processes, files whose content is already stored are skipped and
+the rest are inserted batch_size receipts per transaction. The last
+imported file is written to a checkpoint after every batch, so an
+interrupted import continues from where it stopped when run again.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import receipts_api
+
+HASH_CHUNK_SIZE = 1024 * 1024
+YEAR_PAT = re.compile(r"^[0-9]{4}$")
+MONTH_PAT = re.compile(r"^(0?[1-9]|1[0-2])$")
+EXPIRY_UNIT_PAT = re.compile(r"^(day|month|year)s?$", re.IGNORECASE)
+
+
+def hash_file(path: str) -> tuple:
+    """
+    The path, content hash and size of a file, None for the hash if it
+    can't be read.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                size += len(chunk)
+    except OSError as e:
+        logging.warning(f"Import: Can't read {path}: {e}")
+        return path, None, 0
+    return path, hasher.hexdigest(), size
+
+def find_files(root: str) -> list:
+    """
+    Paths of the receipt files under root relative to it, in a stable
+    order.
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if receipts_api.is_allowed_file(filename):
+                found.append(os.path.relpath(os.path.join(dirpath, filename),
+                                             root))
+    return found
+
+def path_tags(relpath: str) -> str:
+    """
+    The tag string of the file at relpath. The directories and the parts of
+    the file name separated by underscores are tags, except for expiry
+    periods such as 2_years. A YYYY/MM directory pair is the purchase date
+    YYYY-MM-01, unless the file name has a date of its own.
+    """
+    dirs = [d for d in os.path.dirname(relpath).split(os.sep) if d != ""]
+    stem = os.path.splitext(os.path.basename(relpath))[0]
+
+    names = []
+    for part in stem.split("_"):
+        if len(names) > 0 and names[-1].isdigit() \
+                and EXPIRY_UNIT_PAT.match(part):
+            names[-1] += "_" + part
+        else:
+            names.append(part)
+    has_date = any(receipts_api.DATE_TAG_PAT.match(n) for n in names)
+
+    tags = []
+    i = 0
+    while i < len(dirs):
+        if YEAR_PAT.match(dirs[i]) and i + 1 < len(dirs) \
+                and MONTH_PAT.match(dirs[i + 1]):
+            if not has_date:
+                tags.append(f"{dirs[i]}-{dirs[i + 1]}-01")
+            i += 2
+            continue
+        tags.append(dirs[i])
+        i += 1
+    return " ".join(tags + names)
+
+def load_checkpoint(checkpoint: str, root: str):
+    """
+    The last imported file of an earlier import of root, or None.
+    """
+    try:
+        with open(checkpoint) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get("root") != root:
+        return None
+    return state.get("last")
+
+def save_checkpoint(checkpoint: str, root: str, last: str) -> None:
+    tmp = f"{checkpoint}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"root": root, "last": last}, f)
+    os.replace(tmp, checkpoint)
+
+
+class Importer(object):
+    """
+    Imports the files under root with dbeng to receipt_storage.
+    """
+    def __init__(self, dbeng, receipt_storage, root: str, checkpoint: str,
+                 workers: int=None, batch_size: int=1000, out=sys.stdout):
+        self.dbeng = dbeng
+        self.receipt_storage = receipt_storage
+        self.root = os.path.abspath(root)
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.batch_size = batch_size
+        self.out = out
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start_time = None
+
+    def run(self) -> int:
+        """
+        Import every file after the checkpoint. Returns the number of
+        receipts imported.
+        """
+        files = find_files(self.root)
+        last = load_checkpoint(self.checkpoint, self.root)
+        if last is not None:
+            if last in files:
+                files = files[files.index(last) + 1:]
+            else:
+                print(f"Checkpoint {last} isn't in {self.root}, "
+                      + "importing everything", file=self.out)
+        print(f"Importing {len(files)} files from {self.root}", file=self.out)
+
+        self.start_time = time.perf_counter()
+        paths = [os.path.join(self.root, f) for f in files]
+        seen = set()
+        batch = []
+        with ProcessPoolExecutor(self.workers) as pool:
+            hashed = pool.map(hash_file, paths, chunksize=16)
+            for relpath, (path, content_hash, size) in zip(files, hashed):
+                self.bytes += size
+                if content_hash is None:
+                    self.failed += 1
+                elif content_hash in seen \
+                        or self.dbeng.has_content(content_hash):
+                    self.skipped += 1
+                else:
+                    seen.add(content_hash)
+                    batch.append((relpath, path, content_hash))
+                if len(batch) >= self.batch_size:
+                    self.__insert(batch, relpath)
+                    seen.clear()
+                    batch = []
+        if len(files) > 0:
+            self.__insert(batch, files[-1])
+        return self.imported
+
+    def __insert(self, batch: list, last: str) -> None:
+        items = []
+        for relpath, path, content_hash in batch:
+            ext = os.path.splitext(path)[1].strip(".").lower()
+            name = self.receipt_storage.store_file(path, content_hash, ext)
+            parsed = receipts_api.classify_tags(
+                    receipts_api.parse_tags(path_tags(relpath)))
+            items.append((receipts_api.build_receipt(name, content_hash,
+                                                     parsed),
+                          parsed.tags))
+
+        receipt_ids = self.dbeng.insert_receipts(items)
+        for (receipt, _), receipt_id in zip(items, receipt_ids):
+            if receipt_id != -1:
+                self.imported += 1
+                continue
+            self.skipped += 1
+            # Same content was stored by someone else meanwhile
+            if not self.dbeng.has_filename(receipt["filename"]):
+                self.receipt_storage.remove(receipt["filename"])
+        save_checkpoint(self.checkpoint, self.root, last)
+        self.report()
+
+    def report(self) -> None:
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        done = self.imported + self.skipped + self.failed
+        print(f"{done} files, {self.imported} imported, {self.skipped} "
+              + f"skipped, {self.failed} failed, {done / elapsed:.1f} "
+              + f"files/s, {self.bytes / elapsed / (1024 * 1024):.1f} MB/s",
+              file=self.out)
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description=__doc__.strip())
+    argparser.add_argument("root", type=str, help="Directory to import")
+    argparser.add_argument("-c", type=str, default="receipts.cfg",
+                           help="Configuration file")
+    argparser.add_argument("-w", type=int, default=None,
+                           help="Hashing processes, CPU count by default")
+    argparser.add_argument("-b", type=int, default=1000,
+                           help="Receipts per transaction")
+    argparser.add_argument("-d", help="Debug logging to the terminal",
+                           action="store_true")
+    argparser.add_argument("--checkpoint", type=str, default=None,
+                           help="Checkpoint file, by default next to "
+                                + "the database")
+    args = argparser.parse_args()
+
+    root = os.path.abspath(args.root)
+    checkpoint = args.checkpoint
+    if checkpoint is not None:
+        checkpoint = os.path.abspath(checkpoint)
+    receipts_config = receipts_api.load_config(args.c)
+    receipts_api.setup_logging(args.d)
+    db_location = receipts_config['db']['database_file']
+    checkpoint = checkpoint or f"{db_location}.import.checkpoint"
+
+    dbeng = receipts_api.init_db(receipts_config, db_location)
+    receipts_api.dbeng = dbeng
+    receipt_storage, _ = receipts_api.init_storage(receipts_config,
+                                                   migrate=False)
+    try:
+        Importer(dbeng, receipt_storage, root, checkpoint, workers=args.w,
+                 batch_size=args.b).run()
+    finally:
+        dbeng.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import bisect
+import os
+import threading
+import time
+
+# Seconds, from a fast cache hit to a slow upload
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+                     .replace('"', '\\"')
+
+def format_labels(names: tuple, values: tuple, extra: str="") -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Timer(object):
+    """
+    Context manager observing the time spent in it.
+    """
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+null_timer = NullTimer()
+
+
+class Counter(object):
+    def __init__(self, registry):
+        self.registry = registry
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float=1.0) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labelnames: tuple, values: tuple) -> list:
+        return [f"{name}{format_labels(labelnames, values)} "
+                + format_value(self.value)]
+
+
+class Histogram(object):
+    def __init__(self, registry, buckets: tuple):
+        self.registry = registry
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if not self.registry.enabled:
+            return
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[pos] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        Context manager observing the seconds spent in it.
+        """
+        if not self.registry.enabled:
+            return null_timer
+        return Timer(self)
+
+    def samples(self, name: str, labelnames: tuple, values: tuple) -> list:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else format_value(bound)
+            lines.append(f"{name}_bucket"
+                         + format_labels(labelnames, values, f'le="{le}"')
+                         + f" {cumulative}")
+        labels = format_labels(labelnames, values)
+        lines.append(f"{name}_sum{labels} {format_value(total)}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Family(object):
+    """
+    A metric with one child per combination of label values.
+    """
+    def __init__(self, registry, kind: str, name: str, documentation: str,
+                 labelnames: tuple, create):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.create = create
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.create())
+        return child
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class Registry(object):
+    """
+    Counters and histograms in the Prometheus text format. Updates are
+    dropped while the registry isn't enabled, so instrumented code costs
+    little more than a flag check when metrics are off.
+    """
+    def __init__(self, enabled: bool=False):
+        self.enabled = enabled
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str,
+                labelnames: tuple=()) -> Family:
+        return self.__family("counter", name, documentation, labelnames,
+                             lambda: Counter(self))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple=(),
+                  buckets: tuple=DEFAULT_BUCKETS) -> Family:
+        return self.__family("histogram", name, documentation, labelnames,
+                             lambda: Histogram(self, tuple(buckets)))
+
+    def __family(self, kind: str, name: str, documentation: str,
+                 labelnames: tuple, create) -> Family:
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = Family(self, kind, name, documentation, labelnames,
+                                create)
+                self.families[name] = family
+            elif family.kind != kind:
+                raise ValueError(f"{name} is already a {family.kind}")
+            return family
+
+    def expose(self) -> str:
+        with self.lock:
+            families = sorted(self.families.items())
+        lines = []
+        for _, family in families:
+            lines.extend(family.expose())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Write the metrics for the node_exporter textfile collector. The
+        file is replaced atomically so that it's never read half written.
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.expose())
+        os.replace(tmp, path)
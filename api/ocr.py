@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import collections
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class OcrEngine(object):
+    """
+    Reads the text from a receipt image. Engines are pickled to the worker
+    processes, so they should only hold plain configuration.
+    """
+    def extract_text(self, path: str) -> str:
+        raise NotImplementedError
+
+class StubEngine(OcrEngine):
+    """
+    Returns a fixed text without looking at the image.
+    """
+    def __init__(self, text: str="stub ocr text"):
+        self.text = text
+
+    def extract_text(self, path: str) -> str:
+        return self.text
+
+class TesseractEngine(OcrEngine):
+    """
+    Tesseract via pytesseract and Pillow, which are optional dependencies.
+    """
+    def __init__(self, lang: str="eng"):
+        self.lang = lang
+
+    def extract_text(self, path: str) -> str:
+        import pytesseract
+        from PIL import Image
+
+        with Image.open(path) as image:
+            return pytesseract.image_to_string(image, lang=self.lang)
+
+engines = {"stub": StubEngine,
+           "tesseract": TesseractEngine}
+
+def run_ocr(engine: OcrEngine, path: str, storage=None) -> tuple:
+    """
+    Executed in a worker process. Returns the text and the time it took.
+    The file is read through storage if given.
+    """
+    start = time.perf_counter()
+    if storage is None:
+        text = engine.extract_text(path)
+    else:
+        with storage.local_copy(path) as local_path:
+            text = engine.extract_text(local_path)
+    return text, time.perf_counter() - start
+
+def percentile(values: list, pct: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class OcrWorkerPool(object):
+    """
+    Fills in the OCR text of receipts in the background. A dispatcher
+    thread claims due jobs from the ocr_job table and runs them in a
+    process pool. Failed jobs are retried with exponential backoff until
+    max_attempts is reached. Receipt files are read through storage when
+    they aren't local files.
+    """
+    def __init__(self, dbeng, engine: OcrEngine, workers: int=0,
+                 max_attempts: int=5, retry_backoff: float=30.0,
+                 poll_interval: float=5.0, max_backoff: float=3600.0,
+                 storage=None):
+        self.dbeng = dbeng
+        self.engine = engine
+        self.storage = storage
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+
+        self.executor = None
+        self.dispatcher = None
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        reset = self.dbeng.reset_ocr_jobs()
+        if reset > 0:
+            logging.info(f"OCR: Requeued {reset} interrupted jobs")
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.dispatcher = threading.Thread(target=self.__dispatch,
+                                           name="OcrDispatcher", daemon=True)
+        self.dispatcher.start()
+        logging.info(f"OCR: Started {self.workers} workers")
+
+    def stop(self, wait: bool=True) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def notify(self) -> None:
+        """
+        Wake up the dispatcher, e.g. after a receipt has been inserted.
+        """
+        self.wakeup.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {"workers": self.workers,
+                     "in_flight": self.in_flight,
+                     "completed": self.completed,
+                     "failed": self.failed}
+        stats["queue"] = self.dbeng.count_ocr_jobs()
+        stats["latency_p50"] = percentile(latencies, 50)
+        stats["latency_p99"] = percentile(latencies, 99)
+        return stats
+
+    def __dispatch(self) -> None:
+        # Keep a few jobs queued per worker so the processes stay busy
+        max_in_flight = self.workers * 2
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            with self.lock:
+                free = max_in_flight - self.in_flight
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = self.dbeng.claim_ocr_jobs(free, time.time())
+                except Exception as e:
+                    logging.error(f"OCR: Claiming jobs failed: {e}")
+            for i, job in enumerate(jobs):
+                try:
+                    future = self.executor.submit(run_ocr, self.engine,
+                                                  job["filename"],
+                                                  self.storage)
+                except BrokenProcessPool as e:
+                    # A worker process died, e.g. killed by the OOM killer
+                    logging.error(f"OCR: Worker pool broken, restarting: {e}")
+                    self.__restart_executor()
+                    self.__release(jobs[i:])
+                    self.stopping.wait(self.poll_interval)
+                    break
+                with self.lock:
+                    self.in_flight += 1
+                future.add_done_callback(
+                        lambda f, job=job: self.__finish(job, f))
+            if len(jobs) == 0:
+                self.wakeup.wait(self.poll_interval)
+
+    def __restart_executor(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def __release(self, jobs: list) -> None:
+        """
+        Return claimed jobs which weren't run to the queue without counting
+        an attempt.
+        """
+        try:
+            self.dbeng.reset_ocr_jobs([job["receipt_id"] for job in jobs])
+        except Exception as e:
+            # Requeued by reset_ocr_jobs on the next start at the latest
+            logging.error(f"OCR: Releasing jobs failed: {e}")
+
+    def __finish(self, job: dict, future) -> None:
+        receipt_id = job["receipt_id"]
+        try:
+            text, elapsed = future.result()
+            self.dbeng.complete_ocr_job(receipt_id, text)
+            with self.lock:
+                self.latencies.append(elapsed)
+                self.completed += 1
+            logging.info(f"OCR: Receipt {receipt_id} done in {elapsed:.2f}s")
+        except Exception as e:
+            attempts = job["attempts"] + 1
+            if attempts >= self.max_attempts:
+                next_attempt = None
+                logging.error(f"OCR: Receipt {receipt_id} failed {attempts} "
+                              + f"times, giving up: {e}")
+            else:
+                delay = min(self.max_backoff,
+                            self.retry_backoff * 2 ** (attempts - 1))
+                next_attempt = time.time() + delay
+                logging.warning(f"OCR: Receipt {receipt_id} failed, retrying "
+                                + f"in {delay:.0f}s: {e}")
+            try:
+                self.dbeng.fail_ocr_job(receipt_id, str(e), next_attempt)
+            except Exception as db_e:
+                logging.error(f"OCR: Recording failure failed: {db_e}")
+            if next_attempt is None:
+                with self.lock:
+                    self.failed += 1
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.wakeup.set()
@@ -1,174 +1,885 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import configparser
+import csv
 import datetime
-import hashlib
+import fcntl
+import io
+import json
 import logging
 import os
 import os.path
 import re
+import signal
 import sys
+import threading
+import time
 
 from dateutil.relativedelta import relativedelta
-from flask import Flask, request
+from flask import Flask, Response, g, jsonify, request, send_file
 from werkzeug.utils import secure_filename
 
+import expiry
+import metrics
+import ocr
+import storage
+import thumbs
 from db import dbengine
 
 UPLOAD_DIRECTORY = "uploads"
 ALLOWED_EXTENSIONS = set(['gif', 'jpg', 'jpeg', 'png', 'tiff'])
+UPLOAD_CHUNK_SIZE = 64 * 1024
+SHA256_PAT = re.compile(r"^[0-9a-f]{64}$")
+WHITESPACE_PAT = re.compile(r"\s")
+DATE_TAG_PAT = re.compile(r"^[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}$")
+EXPIRY_TAG_PAT = re.compile(r"^([0-9]{1,9})_(day|month|year)s?$")
+EXPIRY_UNITS = {"day": "days", "month": "months", "year": "years"}
+
+EXPORT_FORMATS = {"csv": ("text/csv", "csv"),
+                  "jsonl": ("application/x-ndjson", "jsonl")}
+EXPORT_COLUMNS = ["id", "filename", "purchase_date", "expiry_date",
+                  "content_sha256", "tags"]
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Seconds a request waits for a thumbnail to be rendered before it's told
+# to retry, so that slow renders don't hold the request threads
+THUMBNAIL_WAIT = 0.5
+
+# Metrics of this process, served by /metrics when enabled
+registry = metrics.Registry()
+request_seconds = registry.histogram(
+        "receipts_request_seconds", "Time to respond to a request",
+        ["endpoint", "method", "status"])
+upload_stage_seconds = registry.histogram(
+        "receipts_upload_stage_seconds", "Time spent in each stage of an upload",
+        ["stage"])
+
+ParsedTags = collections.namedtuple("ParsedTags",
+                                    ["tags", "purchase_date", "expiry"])
 
 app = Flask(__name__)
-app.config['UPLOAD_DIRECTORY'] = UPLOAD_DIRECTORY
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
 dbeng = None
+ocr_pool = None
+expiry_scheduler = None
+thumbnails = None
+receipt_storage = None
+layout_migrator = None
+services_lock = None
+
+# Uploads being processed, waited for on shutdown
+draining = threading.Event()
+uploads_idle = threading.Condition()
+uploads_in_flight = 0
 
 def is_allowed_file(filename):
     return '.' in filename \
             and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def parse_tags(tags):
-    normalized = re.sub("\s", " ", tags)
+    normalized = WHITESPACE_PAT.sub(" ", tags)
     splitted = normalized.lower().split(" ")
     dups_removed = list(set(splitted))
     dups_removed.sort()
     return dups_removed
 
-def parse_purchase_date(tags):
-    purchase_date_pat = re.compile(r"^[0-9]{4}\-[0-9]{1,2}\-[0-9]{1,2}$")
-    dates = list(filter(lambda i: re.search(purchase_date_pat, i), tags))
-
-    # Remove purchase date(s) from tags
-    [tags.remove(d) for d in dates if d in tags]
+def classify_tags(tags) -> ParsedTags:
+    """
+    Split parsed tags into plain tags, the purchase date and the expiry
+    period in one pass. Of several dates or periods the first in sort order
+    is used. Dates which don't exist and empty tags aren't special, the
+    former are kept as plain tags.
+    """
+    plain = []
+    date_tag = None
+    purchase_date = None
+    expiry_tag = None
+    expiry = None
+    for tag in tags:
+        # Only special tags start with a digit
+        if tag[:1].isdigit():
+            if DATE_TAG_PAT.match(tag):
+                try:
+                    tag_date = datetime.datetime.strptime(tag, "%Y-%m-%d")
+                except ValueError:
+                    plain.append(tag)
+                    continue
+                if date_tag is None or tag < date_tag:
+                    date_tag = tag
+                    purchase_date = tag_date
+                continue
+            match = EXPIRY_TAG_PAT.match(tag)
+            if match is not None:
+                if expiry_tag is None or tag < expiry_tag:
+                    expiry_tag = tag
+                    unit = EXPIRY_UNITS[match.group(2)]
+                    expiry = relativedelta(**{unit: int(match.group(1))})
+                continue
+        if tag != "":
+            plain.append(tag)
+    return ParsedTags(plain, purchase_date, expiry)
+
+def expiry_from(start_date, expiry):
+    """
+    The date expiry after start_date, or None if there's no expiry or the
+    result is out of range.
+    """
+    if expiry is None:
+        return None
+    try:
+        return start_date + expiry
+    except (ValueError, OverflowError):
+        logging.warning(f"Expiry {expiry} from {start_date} is out of range")
+        return None
+
+def today():
+    return datetime.datetime.combine(datetime.date.today(),
+                                     datetime.time())
 
-    if len(dates) > 0:
-        dates.sort()
-        return datetime.datetime.strptime(dates[0], "%Y-%m-%d")
-    return datetime.datetime.now().strftime("%Y-%m-%d")
+def parse_purchase_date(tags):
+    """
+    Parse the purchase date from tags, today if there's none. Removes the
+    dates from tags, except for those which don't exist and are kept as
+    plain tags by classify_tags.
+    """
+    parsed = classify_tags(tags)
+    plain = set(parsed.tags)
+    tags[:] = [t for t in tags if t in plain or not DATE_TAG_PAT.match(t)]
+    return parsed.purchase_date or today()
 
 def parse_expiry_date(start_date, tags):
     """
     Parse expiry date from tags starting from start_date.
     """
-    exp_pat = re.compile(r"^[0-9]+_(day|month|year)s?$")
-    exp = list(filter(lambda i: re.search(exp_pat, i), tags))
-
-    # Remove expiration date(s) from tags
-    [tags.remove(e) for e in exp if e in tags]
+    parsed = classify_tags(tags)
+    tags[:] = [t for t in tags if not EXPIRY_TAG_PAT.match(t)]
+    return expiry_from(start_date, parsed.expiry)
 
-    if len(exp) > 0:
-        exp.sort()
-        expiration = exp[0]
+def parse_page_args(args):
+    """
+    Parse 'limit' and 'cursor' of a paginated route. Returns None when
+    they're invalid.
+    """
+    try:
+        limit = min(int(args.get('limit', 20)), 100)
+        cursor = args.get('cursor')
+        cursor = int(cursor) if cursor is not None else None
+    except ValueError:
+        return None
+    if limit < 1:
+        return None
+    return limit, cursor
+
+def parse_date_args(args):
+    """
+    Parse the inclusive 'from' and 'to' dates of a route to the bounds of
+    a [from, to) range. Returns None when they're invalid.
+    """
+    try:
+        date_from = args.get('from')
+        if date_from is not None:
+            date_from = datetime.datetime.strptime(date_from, "%Y-%m-%d") \
+                            .strftime("%Y-%m-%d")
+        date_to = args.get('to')
+        if date_to is not None:
+            # Dates may be stored with a time, so compare to the next day
+            date_to = (datetime.datetime.strptime(date_to, "%Y-%m-%d")
+                       + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+    return date_from, date_to
+
+def upload_stage(stage: str):
+    """
+    Context manager timing a stage of an upload.
+    """
+    return upload_stage_seconds.labels(stage).time()
 
-        number_val = int(re.search(r"^[0-9]+", expiration).group())
+def page_of(results: list, limit: int) -> dict:
+    """
+    Results are fetched with limit + 1 rows, the extra row tells whether
+    there's a next page. The cursor is the last receipt ID of the page.
+    """
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = results[-1]["id"]
+    return {"results": results, "next_cursor": next_cursor}
 
-        if re.search("days?$", expiration):
-            return start_date  + relativedelta(days=number_val)
-        elif re.search("months?$", expiration):
-            return start_date  + relativedelta(months=number_val)
-        elif re.search("years?$", expiration):
-            return start_date  + relativedelta(years=number_val)
-    return None
+@app.before_request
+def start_request_timer():
+    if registry.enabled:
+        g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.labels(endpoint, request.method,
+                               str(response.status_code)) \
+                       .observe(time.perf_counter() - start)
+    return response
 
 @app.before_request
 def log_request():
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
     remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
     headers = [": ".join(i) for i in request.headers]
-    logging.info(f"Incoming connection from {remote_ip} with params: {headers}")
+    logging.debug(f"Incoming connection from {remote_ip} with params: {headers}")
+
+@app.before_request
+def track_upload():
+    """
+    Count the uploads in flight. New uploads are refused once the server
+    is shutting down.
+    """
+    global uploads_in_flight
+
+    if request.method != 'POST':
+        return None
+    if draining.is_set():
+        return "ERROR: Shutting down\r\n", 503
+    with uploads_idle:
+        uploads_in_flight += 1
+    g.upload_tracked = True
+    return None
+
+@app.teardown_request
+def untrack_upload(exc):
+    global uploads_in_flight
+
+    if g.pop('upload_tracked', False):
+        with uploads_idle:
+            uploads_in_flight -= 1
+            uploads_idle.notify_all()
 
 @app.route('/', methods=['POST'])
 def upload_file():
     if request.method != "POST":
         return "ERROR: Only POST allowed", 405
 
-    if 'file' not in request.files \
-              or request.files['file'] is None \
-              or request.files['file'].filename == '':
+    # The body is read when the form is parsed
+    with upload_stage("receive"):
+        files = request.files
+    if 'file' not in files \
+              or files['file'] is None \
+              or files['file'].filename == '':
         return "ERROR: Missing parameter: 'file'\r\n", 422
 
-    received_file = request.files['file']
+    received_file = files['file']
     if not received_file or not is_allowed_file(received_file.filename):
         return "Extension type not allowed\r\n", 415
 
     if "tags" not in request.form.keys() or \
             request.form['tags'] == "":
         return "ERROR: Missing parameter: 'tags'\r\n", 422
-    tags = parse_tags(request.form['tags'])
-
-    # File hash and saving
-    filename = secure_filename(received_file.filename)
-    file_binary = received_file.stream.read()
-    filename_hash = hashlib.sha256(file_binary).hexdigest()
-    ext = os.path.splitext(filename)[-1].strip(".").lower()
-    outfile = os.path.join(app.config['UPLOAD_DIRECTORY'], \
-        f"{filename_hash}.{ext}")
-    if os.path.exists(outfile):
+    parsed = classify_tags(parse_tags(request.form['tags']))
+
+    # Clients which already know the content hash can skip the upload work
+    client_hash = request.form.get('sha256', '').lower()
+    if SHA256_PAT.match(client_hash):
+        with upload_stage("check"):
+            known = dbeng.has_content(client_hash)
+        if known:
+            return "ERROR: File exists\r\n", 409
+
+    # Reading, hashing and writing the file are timed separately
+    timings = {} if registry.enabled else None
+    with upload_stage("store"):
+        stored = store_file(received_file, timings)
+    for stage, seconds in (timings or {}).items():
+        upload_stage_seconds.labels(stage).observe(seconds)
+    if stored is None:
         return "ERROR: File exists\r\n", 409
-    with open(outfile, "wb") as f:
-        f.write(file_binary)
-
-    # Get text from the receipt with OCR
-    # TODO
-    parsed_ocr = ""
-
-    # Things related to tags, must be executed after tags parsing
-    purchase_date = parse_purchase_date(tags)
-    expiry_date = parse_expiry_date(purchase_date, tags)
+    outfile, content_hash = stored
 
     # Save to DB
-    receipt = {"filename": outfile, \
-               "purchase_date": purchase_date, \
-               "expiry_date": expiry_date, \
-               "ocr_text": parsed_ocr}
-    receipt_id = dbeng.insert_receipt(receipt)
+    receipt = build_receipt(outfile, content_hash, parsed)
+    with upload_stage("insert"):
+        receipt_id = dbeng.insert_receipt(receipt)
     if receipt_id == -1:
+        discard_file(outfile)
+        # Same content was stored concurrently under another extension
+        if dbeng.has_content(content_hash):
+            return "ERROR: File exists\r\n", 409
         logging.error(f"Returned receipt ID was wrong: {receipt_id}")
         return "ERROR: terror\n", 503 # XXX
-    dbeng.insert_tags(tags)
-    dbeng.insert_receipt_tags_association(receipt_id, tags)
+    with upload_stage("tags"):
+        dbeng.insert_receipt_tags_association(receipt_id, parsed.tags)
+    with upload_stage("notify"):
+        if ocr_pool is not None:
+            ocr_pool.notify()
+        if expiry_scheduler is not None:
+            expiry_scheduler.add(receipt_id, outfile, receipt["expiry_date"])
+        if thumbnails is not None:
+            thumbnails.prefetch(outfile, content_hash)
 
     return "Upload OK\r\n", 200
 
-def main(config_location: str, port: int):
-    global app
-    global dbeng
+@app.route('/batch', methods=['POST'])
+def upload_batch():
+    """
+    Upload many receipts in one request. Every 'file' part must be matched
+    by a 'tags' part in the same order. All receipts are written to the
+    database in a single transaction and the status is reported per file.
+    """
+    received_files = request.files.getlist('file')
+    received_tags = request.form.getlist('tags')
+    if len(received_files) == 0:
+        return "ERROR: Missing parameter: 'file'\r\n", 422
+    if len(received_files) != len(received_tags):
+        return "ERROR: Every 'file' must have matching 'tags'\r\n", 422
+
+    results = []
+    pending = []
+    for received_file, tags_str in zip(received_files, received_tags):
+        result = {"filename": received_file.filename}
+        results.append(result)
+        if received_file.filename == '':
+            result.update(status=422, message="Missing parameter: 'file'")
+            continue
+        if not is_allowed_file(received_file.filename):
+            result.update(status=415, message="Extension type not allowed")
+            continue
+        if tags_str == "":
+            result.update(status=422, message="Missing parameter: 'tags'")
+            continue
+        parsed = classify_tags(parse_tags(tags_str))
+        stored = store_file(received_file)
+        if stored is None:
+            result.update(status=409, message="File exists")
+            continue
+        outfile, content_hash = stored
+        pending.append((result, build_receipt(outfile, content_hash, parsed),
+                        parsed.tags))
+
+    receipt_ids = dbeng.insert_receipts([(r, t) for _, r, t in pending])
+    for (result, receipt, _), receipt_id in zip(pending, receipt_ids):
+        if receipt_id == -1:
+            discard_file(receipt["filename"])
+            if dbeng.has_content(receipt["content_sha256"]):
+                result.update(status=409, message="File exists")
+                continue
+            logging.error(f"Couldn't insert {receipt['filename']}")
+            result.update(status=503, message="Database insert failed")
+        else:
+            result.update(status=200, message="Upload OK", id=receipt_id)
+            if expiry_scheduler is not None:
+                expiry_scheduler.add(receipt_id, receipt["filename"],
+                                     receipt["expiry_date"])
+            if thumbnails is not None:
+                thumbnails.prefetch(receipt["filename"],
+                                    receipt["content_sha256"])
+    if ocr_pool is not None and len(pending) > 0:
+        ocr_pool.notify()
+
+    return jsonify(results), 200
+
+@app.route('/exists/<sha256>', methods=['GET'])
+def content_exists(sha256):
+    """
+    Whether a receipt with the given content SHA-256 has been stored.
+    Also answers HEAD requests.
+    """
+    sha256 = sha256.lower()
+    if not SHA256_PAT.match(sha256):
+        return "ERROR: Invalid SHA-256\r\n", 422
+    if dbeng.has_content(sha256):
+        return "Exists\r\n", 200
+    return "Not found\r\n", 404
+
+@app.route('/search', methods=['GET'])
+def search():
+    """
+    Full-text search over the receipt texts and tags. Results are newest
+    first; pass 'next_cursor' from a response as 'cursor' for the next page.
+    """
+    query = request.args.get('q', '')
+    if query.strip() == "":
+        return "ERROR: Missing parameter: 'q'\r\n", 422
+    page_args = parse_page_args(request.args)
+    if page_args is None:
+        return "ERROR: Invalid 'limit' or 'cursor'\r\n", 422
+    limit, cursor = page_args
+
+    # Fetch one extra row to know whether there's a next page
+    results = dbeng.search_receipts(query, limit + 1, cursor)
+    return jsonify(page_of(results, limit)), 200
+
+@app.route('/receipts', methods=['GET'])
+def list_receipts():
+    """
+    Receipts filtered by tags and purchase date, newest first. 'tags' is a
+    comma separated list matched with 'match' all (default) or any, 'from'
+    and 'to' are inclusive %Y-%m-%d dates. Paginated like /search.
+    """
+    tags = [t for t in parse_tags(request.args.get('tags', '').replace(",", " "))
+            if t != ""]
+    match = request.args.get('match', 'all')
+    if match not in ("all", "any"):
+        return "ERROR: 'match' must be 'all' or 'any'\r\n", 422
+    dates = parse_date_args(request.args)
+    if dates is None:
+        return "ERROR: Dates must be in %Y-%m-%d format\r\n", 422
+    date_from, date_to = dates
+    page_args = parse_page_args(request.args)
+    if page_args is None:
+        return "ERROR: Invalid 'limit' or 'cursor'\r\n", 422
+    limit, cursor = page_args
+
+    results = dbeng.query_receipts(tags, match == "all", date_from, date_to,
+                                   cursor, limit + 1)
+    return jsonify(page_of(results, limit)), 200
+
+@app.route('/export', methods=['GET'])
+def export():
+    """
+    Every receipt matching 'tags', 'match', 'from' and 'to' as in /receipts,
+    oldest first, as CSV or JSON lines by 'format' (csv by default). With
+    'group' tag or month, the receipt counts per tag or purchase month
+    instead. The response is streamed, so memory use doesn't depend on the
+    number of receipts.
+    """
+    tags = [t for t in parse_tags(request.args.get('tags', '').replace(",", " "))
+            if t != ""]
+    match = request.args.get('match', 'all')
+    if match not in ("all", "any"):
+        return "ERROR: 'match' must be 'all' or 'any'\r\n", 422
+    dates = parse_date_args(request.args)
+    if dates is None:
+        return "ERROR: Dates must be in %Y-%m-%d format\r\n", 422
+    out_format = request.args.get('format', 'csv')
+    if out_format not in EXPORT_FORMATS:
+        return "ERROR: 'format' must be 'csv' or 'jsonl'\r\n", 422
+    group = request.args.get('group')
+    if group is not None and group not in ("tag", "month"):
+        return "ERROR: 'group' must be 'tag' or 'month'\r\n", 422
+
+    if group is None:
+        columns = EXPORT_COLUMNS
+        rows = dbeng.export_receipts(tags, match == "all", *dates)
+        filename = "receipts"
+    else:
+        columns = [group, "receipts", "with_expiry"]
+        rows = dbeng.export_counts(group, tags, match == "all", *dates)
+        filename = f"receipts_by_{group}"
+    mimetype, ext = EXPORT_FORMATS[out_format]
+    headers = {"Content-Disposition":
+                   f"attachment; filename={filename}.{ext}"}
+    return Response(export_lines(rows, columns, out_format),
+                    mimetype=mimetype, headers=headers)
+
+def export_lines(rows, columns: list, out_format: str):
+    """
+    Format rows as CSV with a header or as JSON lines, yielding about
+    EXPORT_CHUNK_SIZE characters at a time.
+    """
+    buf = io.StringIO()
+    if out_format == "csv":
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow(columns)
+        write = lambda row: writer.writerow([row[c] for c in columns])
+    else:
+        write = lambda row: buf.write(json.dumps(
+                {c: row[c] for c in columns}) + "\n")
+    for row in rows:
+        write(row)
+        if buf.tell() >= EXPORT_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+@app.route('/receipts/<int:receipt_id>/thumb', methods=['GET'])
+def thumbnail(receipt_id):
+    """
+    A scaled down receipt image 'w' pixels wide, rounded up to one of
+    thumbs.WIDTHS. WebP if the client accepts it, otherwise JPEG. The ETag
+    is derived from the content hash, so unchanged thumbnails get a 304.
+    """
+    if thumbnails is None:
+        return "ERROR: Thumbnails aren't enabled\r\n", 501
+    try:
+        width = thumbs.snap_width(int(request.args.get('w',
+                                                       thumbs.DEFAULT_WIDTH)))
+    except ValueError:
+        width = None
+    if width is None:
+        return f"ERROR: 'w' must be 1-{thumbs.WIDTHS[-1]}\r\n", 422
+
+    receipt = dbeng.get_receipt(receipt_id)
+    if receipt is None:
+        return "ERROR: Receipt not found\r\n", 404
+    content_hash = receipt["content_sha256"] \
+        or os.path.splitext(os.path.basename(receipt["filename"]))[0]
+    fmt = "webp" if thumbnails.webp \
+        and request.accept_mimetypes["image/webp"] else "jpeg"
+    etag = f"{content_hash}-{width}-{fmt}"
+    headers = {"ETag": f'"{etag}"',
+               "Cache-Control": "public, max-age=86400",
+               "Vary": "Accept"}
+    if request.if_none_match.contains(etag):
+        return "", 304, headers
+
+    thumb_file = None
+    try:
+        for attempt in range(2):
+            path = thumbnails.get(receipt["filename"], content_hash, width, fmt,
+                                  timeout=THUMBNAIL_WAIT)
+            try:
+                thumb_file = open(path, "rb")
+                break
+            except FileNotFoundError:
+                # Evicted after the lookup
+                thumbnails.forget(path)
+    except TimeoutError:
+        return "ERROR: Thumbnail is being rendered\r\n", 503, \
+               {"Retry-After": "1"}
+    except Exception as e:
+        logging.error(f"Thumbnail of {receipt_id} failed: {e}")
+        return "ERROR: Can't create a thumbnail\r\n", 500
+    if thumb_file is None:
+        return "ERROR: Thumbnail not available\r\n", 503
+    response = send_file(thumb_file, mimetype=f"image/{fmt}")
+    response.headers.update(headers)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def show_metrics():
+    """
+    Request, upload stage and database timings of this process in the
+    Prometheus text format.
+    """
+    if not registry.enabled:
+        return "ERROR: Metrics aren't enabled\r\n", 404
+    return Response(registry.expose(),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
 
-    if len(sys.argv) < 2:
-        print(f"ERROR: {sys.argv[0]}: Missing configuration file parameter")
-        sys.exit(1)
+@app.route('/ocr/status', methods=['GET'])
+def ocr_status():
+    """
+    OCR queue depth and latencies for sizing the worker pool.
+    """
+    if ocr_pool is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(enabled=True, **ocr_pool.stats())), 200
 
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument("-d", help="Debug mode", action="store_true")
-    argparser.add_argument("-c", type=str, help="Configuration file (absolute path)", nargs=1)
-    args = argparser.parse_args()
+def store_file(received_file, timings: dict=None):
+    """
+    Hash and save the uploaded file in UPLOAD_CHUNK_SIZE blocks. Returns
+    the stored file path and content hash, or None if a receipt with the
+    same content exists.
+    """
+    filename = secure_filename(received_file.filename)
+    ext = os.path.splitext(filename)[-1].strip(".").lower()
+    return receipt_storage.store(received_file.stream, ext,
+                                 is_known=dbeng.has_content,
+                                 chunk_size=UPLOAD_CHUNK_SIZE,
+                                 timings=timings)
 
-    receipts_config = configparser.ConfigParser()
-    if args.c is not None and os.path.exists(args.c[0]):
-        config_location = os.path.abspath(args.c[0])
+def discard_file(filename):
+    """
+    Remove a stored file whose receipt couldn't be inserted. Object stores
+    don't refuse to overwrite, so the file may belong to a concurrent
+    upload of the same content.
+    """
+    if not dbeng.has_filename(filename):
+        receipt_storage.remove(filename)
+
+def build_receipt(outfile, content_hash, parsed: ParsedTags):
+    """
+    Build the receipt row from the classified tags.
+    """
+    # Text is read from the receipt later on by the OCR workers
+    parsed_ocr = ""
+
+    purchase_date = parsed.purchase_date or today()
+    expiry_date = expiry_from(purchase_date, parsed.expiry)
+
+    return {"filename": outfile, \
+            "purchase_date": purchase_date, \
+            "expiry_date": expiry_date, \
+            "ocr_text": parsed_ocr, \
+            "content_sha256": content_hash}
+
+def remote_storage():
+    """
+    The storage backend if receipt files aren't local files, otherwise
+    None.
+    """
+    if isinstance(receipt_storage, storage.LocalStorage):
+        return None
+    return receipt_storage
+
+def init_db(receipts_config, db_location: str):
+    db_config = receipts_config['db']
+    return dbengine.DbEngine(logging, db_location,
+                             pool_size=db_config.getint('pool_size', 0),
+                             synchronous=db_config.get('synchronous'),
+                             busy_timeout=db_config.getint('busy_timeout'),
+                             recent_hashes=db_config.getint('recent_hashes',
+                                                            10000),
+                             metrics=registry)
+
+def init_ocr(receipts_config):
+    """
+    Start the OCR workers if an engine has been configured.
+    """
+    engine_name = receipts_config.get('ocr', 'engine', fallback='none')
+    if engine_name == 'none':
+        return None
+    if engine_name not in ocr.engines:
+        raise ValueError(f"Unknown OCR engine: {engine_name}")
+
+    ocr_config = receipts_config['ocr']
+    engine_args = {}
+    if engine_name == 'tesseract' and 'lang' in ocr_config:
+        engine_args['lang'] = ocr_config['lang']
+    pool = ocr.OcrWorkerPool(dbeng, ocr.engines[engine_name](**engine_args),
+                             workers=ocr_config.getint('workers', 0),
+                             max_attempts=ocr_config.getint('max_attempts', 5),
+                             retry_backoff=ocr_config.getfloat('retry_backoff',
+                                                               30.0),
+                             storage=remote_storage())
+    pool.start()
+    return pool
+
+def server_workers(receipts_config) -> int:
+    """
+    The number of gunicorn worker processes, one per CPU core when the
+    configuration gives 0.
+    """
+    return receipts_config.getint('server', 'workers', fallback=0) \
+           or os.cpu_count() or 1
+
+def init_expiry_scheduler(receipts_config, poll_inserts: bool=False):
+    """
+    Start the expiry notifications if a sink has been configured. Set
+    poll_inserts when other processes insert receipts too.
+    """
+    sink_name = receipts_config.get('alerts', 'sink', fallback='none')
+    if sink_name == 'none':
+        return None
+
+    alerts_config = receipts_config['alerts']
+    if sink_name == 'file':
+        sink = expiry.FileSink(alerts_config['path'])
+    elif sink_name == 'webhook':
+        sink = expiry.WebhookSink(alerts_config['url'])
+    else:
+        raise ValueError(f"Unknown alert sink: {sink_name}")
+
+    lead_days = alerts_config.getint('lead_days', 30)
+    scheduler = expiry.ExpiryScheduler(
+            dbeng, sink, lead_time=datetime.timedelta(days=lead_days),
+            check_interval=alerts_config.getfloat('check_interval', 3600.0),
+            poll_inserts=poll_inserts)
+    scheduler.start()
+    return scheduler
+
+def init_storage(receipts_config, migrate: bool=True):
+    """
+    Set up the configured storage backend. For local storage, start moving
+    existing receipts to its layout if enabled and migrate is set.
+    """
+    backend = receipts_config.get('storage', 'backend', fallback='local')
+    if backend == 's3':
+        if not storage.boto3_available():
+            raise ValueError("The s3 storage backend needs boto3")
+        storage_config = receipts_config['storage']
+        return storage.S3Storage(
+                storage_config['bucket'],
+                prefix=storage_config.get('prefix', ''),
+                endpoint_url=storage_config.get('endpoint_url'),
+                region=storage_config.get('region'),
+                access_key=storage_config.get('access_key'),
+                secret_key=storage_config.get('secret_key'),
+                max_connections=storage_config.getint('max_connections', 10),
+                multipart_threshold_mb=storage_config.getint(
+                        'multipart_threshold_mb', 8),
+                multipart_chunk_mb=storage_config.getint('multipart_chunk_mb',
+                                                         8),
+                max_concurrency=storage_config.getint('max_concurrency', 4),
+                spool_dir=storage_config.get('spool_dir')), None
+    if backend != 'local':
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    receipts = storage.LocalStorage(
+            receipts_config.get('storage', 'upload_dir',
+                                fallback=UPLOAD_DIRECTORY),
+            layout=receipts_config.get('storage', 'layout',
+                                       fallback='sharded'))
+    migrator = None
+    if migrate and receipts_config.getboolean('storage', 'migrate',
+                                              fallback=True):
+        migrator = storage.LayoutMigrator(
+                dbeng, receipts,
+                batch_size=receipts_config.getint('storage', 'migrate_batch',
+                                                  fallback=500))
+        migrator.start()
+    return receipts, migrator
+
+def init_thumbnails(receipts_config):
+    """
+    Set up the thumbnail cache if enabled and Pillow is installed.
+    """
+    if not receipts_config.getboolean('thumbnails', 'enabled',
+                                      fallback=False):
+        return None
+    if not thumbs.pillow_available():
+        logging.warning("Thumbnails are enabled but Pillow isn't installed")
+        return None
+
+    thumbs_config = receipts_config['thumbnails']
+    return thumbs.ThumbnailCache(
+            thumbs_config.get('cache_dir', 'thumbnails'),
+            thumbs_config.getint('max_cache_mb', 512) * 1024 * 1024,
+            workers=thumbs_config.getint('workers', 2),
+            webp=thumbs.webp_supported(),
+            storage=remote_storage())
+
+def acquire_services_lock(path: str):
+    """
+    Lock path without waiting. Returns the open lock file, or None if
+    another process holds the lock. The lock is released when the process
+    exits.
+    """
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def load_config(config_location: str):
+    """
+    Read the configuration. Paths in it are relative to its directory,
+    which becomes the working directory.
+    """
+    config_location = os.path.abspath(config_location)
     os.chdir(os.path.dirname(config_location))
+    receipts_config = configparser.ConfigParser()
     receipts_config.read(config_location)
+    return receipts_config
 
-    db_location = receipts_config['db']['database_file']
-
-    if args.d:
-        app.debug = True
-        db_location = "receipts_test.db"
+def setup_logging(debug: bool) -> None:
+    if debug:
         logging.basicConfig(
             datefmt="%Y-%m-%d %H:%M:%S", \
             format="%(asctime)s.%(msecs)03d: %(levelname)s %(message)s", \
-            level=logging.INFO)
+            level=logging.DEBUG)
     else:
         logging.basicConfig(filename="receiptsapi.log", \
              datefmt="%Y-%m-%d %H:%M:%S", \
              format="%(asctime)s.%(msecs)03d: %(levelname)s %(message)s", \
              level=logging.INFO)
 
+def create_app(receipts_config, debug: bool=False, services: bool=None,
+               workers: int=1):
+    """
+    Set up the database and services of a server process and return the
+    app. Every worker process of a production server calls this for its
+    own database connections, workers tells how many there are. The OCR
+    workers, expiry notifications and storage migration run in one
+    process per database: the one holding the services lock, unless
+    services tells otherwise.
+    """
+    global dbeng
+    global ocr_pool
+    global expiry_scheduler
+    global thumbnails
+    global receipt_storage
+    global layout_migrator
+    global services_lock
+
+    db_config = receipts_config['db']
+    db_location = db_config['database_file']
+    if debug:
+        app.debug = True
+        db_location = "receipts_test.db"
     logging.info(f"Configured database location: {db_location}")
+    registry.enabled = receipts_config.getboolean('metrics', 'enabled',
+                                                  fallback=False)
+
+    max_upload_mb = receipts_config.getint('api', 'max_upload_mb', fallback=16)
+    app.config['MAX_CONTENT_LENGTH'] = max_upload_mb * 1024 * 1024
+
+    dbeng = init_db(receipts_config, db_location)
+    if services is None:
+        services_lock = acquire_services_lock(f"{db_location}.services.lock")
+        services = services_lock is not None
+    if services:
+        logging.info(f"Running the background services in process {os.getpid()}")
+
+    receipt_storage, layout_migrator = init_storage(receipts_config,
+                                                    migrate=services)
+    if services:
+        ocr_pool = init_ocr(receipts_config)
+        expiry_scheduler = init_expiry_scheduler(receipts_config,
+                                                 poll_inserts=workers > 1)
+    thumbnails = init_thumbnails(receipts_config)
+    draining.clear()
+    return app
+
+def shutdown(timeout: float=30.0) -> None:
+    """
+    Refuse new uploads, wait up to timeout seconds for the ones in flight
+    and stop the services. Called when the server process is terminated.
+    """
+    global ocr_pool
+    global expiry_scheduler
+    global thumbnails
+    global layout_migrator
+
+    draining.set()
+    with uploads_idle:
+        if not uploads_idle.wait_for(lambda: uploads_in_flight == 0, timeout):
+            logging.warning(f"Shutting down with {uploads_in_flight} "
+                            + "uploads in flight")
+    if layout_migrator is not None:
+        layout_migrator.stop()
+        layout_migrator = None
+    if expiry_scheduler is not None:
+        expiry_scheduler.stop()
+        expiry_scheduler = None
+    if ocr_pool is not None:
+        ocr_pool.stop()
+        ocr_pool = None
+    if thumbnails is not None:
+        thumbnails.close()
+        thumbnails = None
+    if dbeng is not None:
+        dbeng.close()
+    logging.info("Shut down")
 
-    dbeng = dbengine.DbEngine(logging, db_location)
-    app.run(host='127.0.0.1', port=port)
+def main(config_location: str, port: int):
+    if len(sys.argv) < 2:
+        print(f"ERROR: {sys.argv[0]}: Missing configuration file parameter")
+        sys.exit(1)
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-d", help="Debug mode", action="store_true")
+    argparser.add_argument("-c", type=str, help="Configuration file (absolute path)", nargs=1)
+    argparser.add_argument("-p", type=int, help="Port", default=port)
+    args = argparser.parse_args()
+
+    if args.c is not None and os.path.exists(args.c[0]):
+        config_location = args.c[0]
+    receipts_config = load_config(config_location)
+    setup_logging(args.d)
+    create_app(receipts_config, debug=args.d, services=True)
+
+    # The development server is single process, see wsgi.py for production
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(host='127.0.0.1', port=args.p)
+    finally:
+        shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+import contextlib
+import hashlib
+import importlib.util
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+LAYOUTS = ("flat", "sharded")
+SHA256_PAT = re.compile(r"^[0-9a-f]{64}$")
+MB = 1024 * 1024
+
+
+def boto3_available() -> bool:
+    return importlib.util.find_spec("boto3") is not None
+
+def spool_stream(stream, out, chunk_size: int, timings: dict=None) -> str:
+    """
+    Copy stream to out in chunk_size blocks and return the SHA-256 of it.
+    With timings, the seconds spent reading, hashing and writing are added
+    to its read, hash and write keys.
+    """
+    hasher = hashlib.sha256()
+    if timings is not None:
+        return timed_spool_stream(stream, out, chunk_size, hasher, timings)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        out.write(chunk)
+    return hasher.hexdigest()
+
+def timed_spool_stream(stream, out, chunk_size: int, hasher,
+                       timings: dict) -> str:
+    clock = time.perf_counter
+    spent = {"read": 0.0, "hash": 0.0, "write": 0.0}
+    while True:
+        start = clock()
+        chunk = stream.read(chunk_size)
+        read = clock()
+        spent["read"] += read - start
+        if not chunk:
+            break
+        hasher.update(chunk)
+        hashed = clock()
+        out.write(chunk)
+        spent["hash"] += hashed - read
+        spent["write"] += clock() - hashed
+    for stage, seconds in spent.items():
+        timings[stage] = timings.get(stage, 0.0) + seconds
+    return hasher.hexdigest()
+
+def shard_name(content_hash: str, ext: str) -> str:
+    return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.{ext}"
+
+
+class StorageBackend(object):
+    """
+    Where receipt files are kept. Files are named by the SHA-256 of their
+    content, and the name returned by store() is saved as the file name of
+    the receipt. Backends are pickled to the OCR worker processes.
+    """
+    def store(self, stream, ext: str, is_known=None,
+              chunk_size: int=64 * 1024, timings: dict=None):
+        """
+        Hash and save stream. Returns the stored name and content hash, or
+        None if is_known(content_hash) is true or the file exists. timings
+        is passed to spool_stream.
+        """
+        raise NotImplementedError
+
+    def store_file(self, path: str, content_hash: str, ext: str) -> str:
+        """
+        Save a copy of the file at path, whose content hash is already
+        known. Returns the stored name, also when the file exists.
+        """
+        raise NotImplementedError
+
+    def remove(self, name: str) -> None:
+        raise NotImplementedError
+
+    def local_copy(self, name: str):
+        """
+        Context manager giving a local path to the file for reading.
+        """
+        raise NotImplementedError
+
+
+class LocalStorage(StorageBackend):
+    """
+    Receipt files on the local disk, named by the SHA-256 of their content.
+    The sharded layout spreads the files over two levels of directories
+    named by the first digits of the hash, ab/cd/<hash>.<ext>, so no
+    directory grows large. The flat layout keeps every file in root.
+    """
+    def __init__(self, root: str, layout: str="sharded"):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.root = root
+        self.layout = layout
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, content_hash: str, ext: str) -> str:
+        if self.layout == "flat":
+            return os.path.join(self.root, f"{content_hash}.{ext}")
+        return os.path.join(self.root, shard_name(content_hash, ext))
+
+    def store(self, stream, ext: str, is_known=None,
+              chunk_size: int=64 * 1024, timings: dict=None):
+        """
+        Hash and save stream. Returns the stored path and content hash, or
+        None if is_known(content_hash) is true or the file exists.
+
+        The stream is read in chunk_size blocks into a temporary file in
+        root while it's hashed, so memory use doesn't depend on the file
+        size. The temporary file is then linked to its final name, which
+        fails atomically if the name is already taken.
+        """
+        tmp = tempfile.NamedTemporaryFile(dir=self.root, prefix=".upload-",
+                                          delete=False)
+        try:
+            with tmp:
+                content_hash = spool_stream(stream, tmp, chunk_size, timings)
+            if is_known is not None and is_known(content_hash):
+                return None
+            path = self.path_for(content_hash, ext)
+            if not self.__link(tmp.name, path):
+                return None
+            return path, content_hash
+        finally:
+            os.unlink(tmp.name)
+
+    def store_file(self, path: str, content_hash: str, ext: str) -> str:
+        dest = self.path_for(content_hash, ext)
+        if os.path.exists(dest):
+            return dest
+        tmp = tempfile.NamedTemporaryFile(dir=self.root, prefix=".upload-",
+                                          delete=False)
+        try:
+            with tmp, open(path, "rb") as src:
+                shutil.copyfileobj(src, tmp)
+            self.__link(tmp.name, dest)
+        finally:
+            os.unlink(tmp.name)
+        return dest
+
+    def remove(self, path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def local_copy(self, name: str):
+        yield name
+
+    def relocate(self, path: str, content_hash: str) -> str:
+        """
+        Link the file at path to where the layout puts it and return the
+        new path, which is path itself if the file is already in place.
+        The old name is left for the caller to remove.
+        """
+        ext = os.path.splitext(path)[1].strip(".")
+        new_path = self.path_for(content_hash, ext)
+        if new_path != path:
+            # Already linked by an interrupted migration if it exists
+            self.__link(path, new_path)
+        return new_path
+
+    def __link(self, src: str, dest: str) -> bool:
+        """
+        Hard link src to dest. Returns False if dest exists.
+        """
+        try:
+            try:
+                os.link(src, dest)
+            except FileNotFoundError:
+                if not os.path.exists(src):
+                    raise
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.link(src, dest)
+        except FileExistsError:
+            return False
+        return True
+
+
+class S3Storage(StorageBackend):
+    """
+    Receipt files in an S3 compatible object store such as MinIO, keyed
+    like the sharded layout under prefix. boto3 is an optional dependency.
+    Files over multipart_threshold_mb are uploaded in multipart_chunk_mb
+    parts, max_concurrency parts at a time. One client with a pool of
+    max_connections connections is shared by all threads of a process.
+    Uploads are spooled to a temporary file in spool_dir while hashing,
+    as the key depends on the hash.
+    """
+    def __init__(self, bucket: str, prefix: str="", endpoint_url: str=None,
+                 region: str=None, access_key: str=None,
+                 secret_key: str=None, max_connections: int=10,
+                 multipart_threshold_mb: int=8, multipart_chunk_mb: int=8,
+                 max_concurrency: int=4, spool_dir: str=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_connections = max(max_connections, max_concurrency)
+        self.multipart_threshold = multipart_threshold_mb * MB
+        self.multipart_chunk = multipart_chunk_mb * MB
+        self.max_concurrency = max_concurrency
+        self.spool_dir = spool_dir
+        self.lock = threading.Lock()
+        self.client = None
+        self.transfer_config = None
+
+    def __getstate__(self):
+        # Every process creates its own client
+        state = self.__dict__.copy()
+        state.update(lock=None, client=None, transfer_config=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def key_for(self, content_hash: str, ext: str) -> str:
+        return self.prefix + shard_name(content_hash, ext)
+
+    def store(self, stream, ext: str, is_known=None,
+              chunk_size: int=64 * 1024, timings: dict=None):
+        with tempfile.TemporaryFile(dir=self.spool_dir) as tmp:
+            content_hash = spool_stream(stream, tmp, chunk_size, timings)
+            if is_known is not None and is_known(content_hash):
+                return None
+            key = self.key_for(content_hash, ext)
+            if self.exists(key):
+                return None
+            tmp.seek(0)
+            client = self.__client()
+            client.upload_fileobj(tmp, self.bucket, key,
+                                  Config=self.transfer_config)
+        return key, content_hash
+
+    def store_file(self, path: str, content_hash: str, ext: str) -> str:
+        key = self.key_for(content_hash, ext)
+        if not self.exists(key):
+            self.__client().upload_file(path, self.bucket, key,
+                                        Config=self.transfer_config)
+        return key
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.__client().head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def remove(self, key: str) -> None:
+        self.__client().delete_object(Bucket=self.bucket, Key=key)
+
+    @contextlib.contextmanager
+    def local_copy(self, key: str):
+        suffix = os.path.splitext(key)[1]
+        tmp = tempfile.NamedTemporaryFile(dir=self.spool_dir, suffix=suffix,
+                                          delete=False)
+        try:
+            with tmp:
+                self.__client().download_fileobj(self.bucket, key, tmp,
+                                                 Config=self.transfer_config)
+            yield tmp.name
+        finally:
+            os.unlink(tmp.name)
+
+    def __client(self):
+        with self.lock:
+            if self.client is None:
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+                from botocore.config import Config
+
+                config = Config(max_pool_connections=self.max_connections,
+                                retries={"max_attempts": 5,
+                                         "mode": "standard"})
+                self.client = boto3.client(
+                        "s3", endpoint_url=self.endpoint_url,
+                        region_name=self.region,
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        config=config)
+                self.transfer_config = TransferConfig(
+                        multipart_threshold=self.multipart_threshold,
+                        multipart_chunksize=self.multipart_chunk,
+                        max_concurrency=self.max_concurrency,
+                        use_threads=True)
+            return self.client
+
+
+def receipt_hash(receipt: dict):
+    """
+    The content hash of a receipt row. Rows stored before the hashes were
+    recorded fall back to the file name, or None if it isn't a hash.
+    """
+    if receipt.get("content_sha256"):
+        return receipt["content_sha256"]
+    name = os.path.splitext(os.path.basename(receipt["filename"]))[0]
+    return name if SHA256_PAT.match(name) else None
+
+
+class LayoutMigrator(object):
+    """
+    Moves stored receipts to the layout of storage in the background,
+    batch_size receipts at a time. The files of a batch are linked to
+    their new names, the receipt rows are updated in one transaction and
+    only then are the old names removed, so uploads and readers keep
+    working during the migration. Receipts without a known content hash
+    are left in place. Resuming after an interruption is safe.
+    """
+    def __init__(self, dbeng, storage: LocalStorage, batch_size: int=500,
+                 pause: float=0.1):
+        self.dbeng = dbeng
+        self.storage = storage
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopping = threading.Event()
+        self.thread = None
+        self.moved = 0
+        self.skipped = 0
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="LayoutMigrator",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self) -> int:
+        """
+        Migrate every receipt, pausing between batches. Returns the number
+        of receipts moved.
+        """
+        after_id = 0
+        moved = 0
+        while not self.stopping.is_set():
+            rows = self.dbeng.list_receipt_files(after_id, self.batch_size)
+            if len(rows) == 0:
+                break
+            after_id = rows[-1]["id"]
+            moved += self.__migrate_batch(rows)
+            self.stopping.wait(self.pause)
+        if moved > 0 or self.skipped > 0:
+            logging.info(f"Storage: Moved {moved} receipts to the "
+                         + f"{self.storage.layout} layout, "
+                         + f"{self.skipped} skipped")
+        return moved
+
+    def __migrate_batch(self, rows: list) -> int:
+        updates = []
+        old_paths = []
+        for row in rows:
+            content_hash = receipt_hash(row)
+            if content_hash is None:
+                self.skipped += 1
+                continue
+            try:
+                new_path = self.storage.relocate(row["filename"], content_hash)
+            except OSError as e:
+                logging.warning(f"Storage: Can't move {row['filename']}: {e}")
+                self.skipped += 1
+                continue
+            if new_path != row["filename"]:
+                updates.append((row["id"], new_path))
+                old_paths.append(row["filename"])
+
+        if len(updates) > 0:
+            self.dbeng.update_receipt_filenames(updates)
+        for path in old_paths:
+            self.storage.remove(path)
+        self.moved += len(updates)
+        return len(updates)
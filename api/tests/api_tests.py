@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+import unittest
+
+import receipts_api
+import storage
+from db import dbengine
+
+
+test_db_name = "test_api.db"
+test_upload_dir = "test_uploads"
+
+def stored_files() -> list:
+    return [os.path.relpath(os.path.join(root, i), test_upload_dir)
+            for root, _, files in os.walk(test_upload_dir) for i in files]
+
+class ReceiptsApiRoutes(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        os.mkdir(test_upload_dir)
+
+        receipts_api.receipt_storage = storage.LocalStorage(test_upload_dir)
+        receipts_api.dbeng = dbengine.DbEngine(logging, test_db_name)
+        self.client = receipts_api.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+
+    def test_upload(self):
+        data = {"file": (io.BytesIO(b"receipt"), "receipt.png"),
+                "tags": "shop 2019-01-12 1_year"}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(200, resp.status_code, resp.data)
+
+        data = {"file": (io.BytesIO(b"receipt"), "receipt.png"),
+                "tags": "shop"}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(409, resp.status_code, "Duplicate accepted")
+
+    def test_upload_streamed(self):
+        content = os.urandom(3 * receipts_api.UPLOAD_CHUNK_SIZE + 123)
+        content_hash = hashlib.sha256(content).hexdigest()
+        data = {"file": (io.BytesIO(content), "scan.tiff"), "tags": "shop"}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(200, resp.status_code, resp.data)
+
+        data = {"file": (io.BytesIO(content), "scan.tiff"), "tags": "shop"}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(409, resp.status_code, "Duplicate accepted")
+
+        # Temporary files must not be left behind
+        stored = os.path.join(content_hash[:2], content_hash[2:4],
+                              f"{content_hash}.tiff")
+        self.assertListEqual([stored], stored_files())
+        with open(os.path.join(test_upload_dir, stored), "rb") as f:
+            self.assertEqual(content, f.read())
+
+    def test_upload_same_content_other_extension(self):
+        content = b"same receipt"
+        content_hash = hashlib.sha256(content).hexdigest()
+        resp = self.client.head(f"/exists/{content_hash}")
+        self.assertEqual(404, resp.status_code)
+
+        data = {"file": (io.BytesIO(content), "receipt.jpg"), "tags": "shop"}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(200, resp.status_code, resp.data)
+
+        data = {"file": (io.BytesIO(content), "receipt.jpeg"), "tags": "shop"}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(409, resp.status_code, "Duplicate accepted")
+        self.assertEqual(1, len(stored_files()))
+
+        resp = self.client.head(f"/exists/{content_hash}")
+        self.assertEqual(200, resp.status_code)
+        resp = self.client.get("/exists/nothex")
+        self.assertEqual(422, resp.status_code)
+
+    def test_upload_known_hash(self):
+        content = b"same receipt"
+        content_hash = hashlib.sha256(content).hexdigest()
+        data = {"file": (io.BytesIO(content), "receipt.jpg"), "tags": "shop"}
+        self.client.post("/", data=data)
+
+        # The body isn't looked at when the client sent a known hash
+        data = {"file": (io.BytesIO(b"whatever"), "receipt.jpg"),
+                "tags": "shop",
+                "sha256": content_hash}
+        resp = self.client.post("/", data=data)
+        self.assertEqual(409, resp.status_code, "Duplicate accepted")
+
+    def test_search_pagination(self):
+        data = {"file": [(io.BytesIO(f"receipt {i}".encode()), f"{i}.png")
+                         for i in range(5)],
+                "tags": ["groceries 2019-01-12"] * 5}
+        self.client.post("/batch", data=data)
+
+        ids = []
+        cursor = None
+        while True:
+            args = {"q": "groceries", "limit": 2}
+            if cursor is not None:
+                args["cursor"] = cursor
+            resp = self.client.get("/search", query_string=args)
+            self.assertEqual(200, resp.status_code, resp.data)
+            page = resp.get_json()
+            ids.extend(i["id"] for i in page["results"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertListEqual([5, 4, 3, 2, 1], ids)
+
+        resp = self.client.get("/search")
+        self.assertEqual(422, resp.status_code)
+
+    def test_list_receipts(self):
+        data = {"file": [(io.BytesIO(f"receipt {i}".encode()), f"{i}.png")
+                         for i in range(3)],
+                "tags": ["groceries 2019-01-12", "electronics 2019-02-01",
+                         "groceries shop 2019-02-02"]}
+        self.client.post("/batch", data=data)
+
+        def ids(**args):
+            resp = self.client.get("/receipts", query_string=args)
+            self.assertEqual(200, resp.status_code, resp.data)
+            return [i["id"] for i in resp.get_json()["results"]]
+
+        self.assertListEqual([3, 1], ids(tags="groceries"))
+        self.assertListEqual([3], ids(tags="groceries,shop"))
+        self.assertListEqual([3, 2, 1], ids(tags="shop,electronics,groceries",
+                                            match="any"))
+        self.assertListEqual([2], ids(**{"from": "2019-01-13",
+                                         "to": "2019-02-01"}))
+
+        resp = self.client.get("/receipts", query_string={"from": "1.2.2019"})
+        self.assertEqual(422, resp.status_code)
+
+    def test_upload_batch(self):
+        data = {"file": [(io.BytesIO(b"first"), "first.png"),
+                         (io.BytesIO(b"second"), "second.pdf"),
+                         (io.BytesIO(b"third"), "third.jpg"),
+                         (io.BytesIO(b"first"), "first_again.png")],
+                "tags": ["shop 2019-01-12", "shop", "other 2019-02-01 3_months", "shop"]}
+        resp = self.client.post("/batch", data=data)
+        self.assertEqual(200, resp.status_code, resp.data)
+
+        statuses = [i["status"] for i in resp.get_json()]
+        self.assertListEqual([200, 415, 200, 409], statuses)
+        self.assertEqual(2, len(stored_files()))
+
+    def test_upload_batch_tags_mismatch(self):
+        data = {"file": [(io.BytesIO(b"first"), "first.png"),
+                         (io.BytesIO(b"second"), "second.png")],
+                "tags": ["shop"]}
+        resp = self.client.post("/batch", data=data)
+        self.assertEqual(422, resp.status_code, "Mismatch accepted")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ sys.path.append("..")
 
 import logging
 import os
+import sqlite3
+import threading
 import unittest
 
 import db.dbengine as dbengine
@@ -11,10 +13,34 @@ import db.dbengine as dbengine
 
 test_db_name = "test.db"
 
+# Schema before migrations were introduced
+legacy_schema_script = """
+CREATE TABLE receipt (
+        id INTEGER PRIMARY KEY,
+        filename VARCHAR NOT NULL,
+        purchase_date DATE,
+        expiry_date DATE,
+        ocr_text VARCHAR,
+        UNIQUE (filename)
+);
+CREATE TABLE tag (
+        id INTEGER PRIMARY KEY,
+        tag VARCHAR,
+        UNIQUE (tag)
+);
+CREATE TABLE receipt_tag_association (
+        id INTEGER PRIMARY KEY,
+        receipt_id INTEGER,
+        tag_id INTEGER,
+        FOREIGN KEY(receipt_id) REFERENCES receipt (id),
+        FOREIGN KEY(tag_id) REFERENCES tag (id)
+);"""
+
 class DbEngTests(unittest.TestCase):
     def setUp(self):
-        if os.path.exists(test_db_name):
-            os.unlink(test_db_name)
+        for f in (test_db_name, f"{test_db_name}-wal", f"{test_db_name}-shm"):
+            if os.path.exists(f):
+                os.unlink(f)
 
     def test_receipts_mandatory_params(self):
         mandatory_params = ["filename",
@@ -72,5 +98,235 @@ class DbEngTests(unittest.TestCase):
 
         res = dbeng.insert_receipt_tags_association(receipt_id, tag_ids)
 
+    def test_insert_receipts_batch(self):
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        existing = {"filename": "deadbeef.jpg",
+                    "purchase_date": "2019-12-01",
+                    "ocr_text": "",
+                    "expiry_date": None}
+        dbeng.insert_receipt(existing)
+
+        items = [({"filename": "cafebabe.jpg",
+                   "purchase_date": "2019-12-01",
+                   "ocr_text": "",
+                   "expiry_date": None}, ["groceries", "shop"]),
+                 (dict(existing), ["groceries"]),
+                 ({"filename": "missing_params.jpg"}, ["shop"]),
+                 ({"filename": "feedface.jpg",
+                   "purchase_date": "2019-12-02",
+                   "ocr_text": "",
+                   "expiry_date": None}, ["shop", "shop"])]
+        receipt_ids = dbeng.insert_receipts(items)
+
+        self.assertGreater(receipt_ids[0], 1, "Wrong receipt id")
+        self.assertEqual(-1, receipt_ids[1], "Existing receipt inserted")
+        self.assertEqual(-1, receipt_ids[2], "Invalid receipt inserted")
+        self.assertGreater(receipt_ids[3], receipt_ids[0], "Wrong receipt id")
+
+        assoc = dbeng.cur.execute("SELECT receipt_id, tag_id FROM "
+                                  + "receipt_tag_association;").fetchall()
+        self.assertEqual(3, len(assoc), "Wrong association count")
+
+    def test_has_content(self):
+        content_hash = "ab" * 32
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        self.assertFalse(dbeng.has_content(content_hash))
+        receipt = {"filename": f"{content_hash}.jpg",
+                   "purchase_date": "2019-12-01",
+                   "ocr_text": "",
+                   "expiry_date": None,
+                   "content_sha256": content_hash}
+        self.assertGreater(dbeng.insert_receipt(receipt), 0)
+        self.assertTrue(dbeng.has_content(content_hash))
+
+        receipt["filename"] = f"{content_hash}.jpeg"
+        self.assertEqual(-1, dbeng.insert_receipt(receipt),
+                         "Same content inserted twice")
+        dbeng.close()
+
+        # Cache is warmed from the database
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        self.assertIn(content_hash, dbeng.recent_hashes)
+
+    def test_migrate_legacy_schema(self):
+        content_hash = "cd" * 32
+        conn = sqlite3.connect(test_db_name)
+        conn.executescript(legacy_schema_script)
+        conn.executemany("INSERT INTO receipt (filename) VALUES (?);",
+                         [(f"uploads/{content_hash}.jpg",),
+                          (f"uploads/{content_hash}.jpeg",),
+                          ("uploads/not_a_hash.png",)])
+        conn.execute("INSERT INTO tag (tag) VALUES ('groceries');")
+        conn.executemany("INSERT INTO receipt_tag_association "
+                         + "(receipt_id, tag_id) VALUES (?, ?);",
+                         [(1, 1), (1, 1), (2, 1)])
+        conn.commit()
+        conn.close()
+
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        version = dbeng.cur.execute("PRAGMA user_version;").fetchone()[0]
+        self.assertEqual(dbengine.schema_version, version)
+        self.assertTrue(dbeng.has_content(content_hash))
+        hashes = dbeng.cur.execute("SELECT content_sha256 FROM receipt "
+                                   + "ORDER BY id;").fetchall()
+        self.assertListEqual([content_hash, None, None],
+                             [i[0] for i in hashes])
+        assoc = dbeng.cur.execute("SELECT receipt_id, tag_id FROM "
+                                  + "receipt_tag_association;").fetchall()
+        self.assertListEqual([(1, 1), (2, 1)], [tuple(i) for i in assoc],
+                             "Duplicate associations weren't removed")
+        ids = [i["id"] for i in dbeng.search_receipts("groceries")]
+        self.assertListEqual([2, 1], ids, "Search index wasn't filled")
+
+    def test_search_receipts(self):
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        for i, text in enumerate(["milk bread total 4.20",
+                                  "laptop warranty",
+                                  "milk cheese"]):
+            receipt_id = dbeng.insert_receipt(
+                    {"filename": f"{i}.jpg",
+                     "purchase_date": "2019-12-01",
+                     "ocr_text": "",
+                     "expiry_date": None})
+            dbeng.complete_ocr_job(receipt_id, text)
+            tags = ["groceries"] if "milk" in text else ["electronics"]
+            dbeng.insert_tags(tags)
+            dbeng.insert_receipt_tags_association(receipt_id, tags)
+
+        found = dbeng.search_receipts("milk")
+        self.assertListEqual([3, 1], [i["id"] for i in found],
+                             "Not newest first")
+        self.assertEqual("groceries", found[0]["tags"])
+        ids = [i["id"] for i in dbeng.search_receipts("milk", before_id=3)]
+        self.assertListEqual([1], ids, "Keyset pagination failed")
+        ids = [i["id"] for i in dbeng.search_receipts("electronics warr*")]
+        self.assertListEqual([2], ids, "Tag and prefix search failed")
+        self.assertListEqual([], dbeng.search_receipts('"unbalanced AND ('))
+
+        dbeng.cur.execute("DELETE FROM receipt_tag_association "
+                          + "WHERE receipt_id = 2;")
+        self.assertListEqual([], dbeng.search_receipts("electronics"))
+
+    def test_query_receipts(self):
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        receipts = [("2019-01-05", ["groceries", "shop_a"]),
+                    ("2019-02-10 00:00:00", ["groceries", "shop_b"]),
+                    ("2019-02-28", ["electronics", "shop_b"]),
+                    ("2019-03-01", ["groceries", "shop_a"])]
+        dbeng.insert_receipts([({"filename": f"{i}.jpg",
+                                 "purchase_date": date,
+                                 "ocr_text": "",
+                                 "expiry_date": None}, tags)
+                               for i, (date, tags) in enumerate(receipts)])
+
+        def ids(**kwargs):
+            return [i["id"] for i in dbeng.query_receipts(**kwargs)]
+
+        self.assertListEqual([4, 2, 1], ids(tags=["groceries"]))
+        self.assertListEqual([2], ids(tags=["groceries", "shop_b"]))
+        self.assertListEqual([4, 3, 2, 1], ids(tags=["electronics", "shop_a",
+                                                     "shop_b"],
+                                               match_all=False))
+        self.assertListEqual([], ids(tags=["groceries", "unknown"]))
+        self.assertListEqual([3, 2], ids(date_from="2019-02-01",
+                                         date_to="2019-03-01"))
+        self.assertListEqual([2], ids(tags=["shop_b"], date_from="2019-02-01",
+                                      date_to="2019-03-01", before_id=3))
+        self.assertListEqual([4, 3], ids(limit=2))
+
+        # Duplicate associations are ignored
+        dbeng.insert_receipt_tags_association(1, ["groceries"])
+        count = dbeng.cur.execute("SELECT count(*) FROM receipt_tag_association "
+                                  + "WHERE receipt_id = 1;").fetchone()[0]
+        self.assertEqual(2, count)
+
+    def test_query_receipts_uses_indexes(self):
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+
+        def plan(**kwargs):
+            q, params = dbengine.receipts_query(**kwargs)
+            rows = dbeng.cur.execute("EXPLAIN QUERY PLAN " + q, params)
+            return [i["detail"] for i in rows.fetchall()]
+
+        tag_index = "USING COVERING INDEX receipt_tag_association_tag_receipt"
+        for match_all in (True, False):
+            details = plan(tag_ids=[1, 2], match_all=match_all)
+            self.assertTrue(any(tag_index in i for i in details), details)
+            self.assertFalse(any(i.startswith("SCAN") for i in details),
+                             details)
+
+        details = plan(date_from="2019-01-01", date_to="2019-02-01")
+        self.assertTrue(any("USING INDEX receipt_purchase_date" in i
+                            for i in details), details)
+        self.assertFalse(any(i.startswith("SCAN") for i in details), details)
+
+        # Listing the tags of a receipt uses the unique index
+        details = plan()
+        self.assertTrue(any("receipt_tag_association_receipt_tag" in i
+                            for i in details), details)
+
+    def test_pool_concurrent_inserts(self):
+        dbeng = dbengine.DbEngine(logging, test_db_name, pool_size=4,
+                                  synchronous="NORMAL", busy_timeout=1000)
+        threads_count = 8
+        per_thread = 25
+
+        def insert(thread_no):
+            for i in range(per_thread):
+                tags = ["groceries", f"shop_{thread_no}"]
+                receipt_id = dbeng.insert_receipt(
+                        {"filename": f"{thread_no}_{i}.jpg",
+                         "purchase_date": "2019-12-01",
+                         "ocr_text": "",
+                         "expiry_date": None})
+                dbeng.insert_tags(tags)
+                dbeng.insert_receipt_tags_association(receipt_id, tags)
+                self.assertEqual(2, len(dbeng.get_tag_ids(tags)))
+
+        threads = [threading.Thread(target=insert, args=(i,))
+                   for i in range(threads_count)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        with dbeng.pool.reader() as conn:
+            journal_mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+            receipts = conn.execute("SELECT count(*) FROM receipt;").fetchone()[0]
+            assoc = conn.execute("SELECT count(*) FROM "
+                                 + "receipt_tag_association;").fetchone()[0]
+        self.assertEqual("wal", journal_mode)
+        self.assertEqual(threads_count * per_thread, receipts)
+        self.assertEqual(threads_count * per_thread * 2, assoc)
+        self.assertLessEqual(dbeng.pool.readers_created, 4)
+        dbeng.close()
+
+    def test_tag_cache(self):
+        dbeng = dbengine.DbEngine(logging, test_db_name)
+        receipt_id = dbeng.insert_receipt({"filename": "deadbeef.jpg",
+                                           "purchase_date": "2019-12-01",
+                                           "ocr_text": "",
+                                           "expiry_date": None})
+        # Tags are created as they're associated
+        dbeng.insert_receipt_tags_association(receipt_id, ["shop", "food"])
+        self.assertEqual(2, len(dbeng.tag_cache))
+        self.assertEqual(0, dbeng.insert_tags(["shop", "food"]))
+        ids = dbeng.get_tag_ids(["shop", "food"])
+        self.assertEqual(2, len(ids))
+
+        # Warmed up from the database
+        other = dbengine.DbEngine(logging, test_db_name)
+        self.assertEqual(2, len(other.tag_cache))
+
+        # Another process renumbers a tag
+        conn = sqlite3.connect(test_db_name)
+        conn.execute("DELETE FROM tag WHERE tag = 'food';")
+        conn.execute("INSERT INTO tag (id, tag) VALUES (100, 'food');")
+        conn.commit()
+        conn.close()
+        self.assertIn(100, dbeng.get_tag_ids(["food"]))
+        self.assertEqual(1, dbeng.insert_tags(["food", "new"]))
+        self.assertEqual(1, len(dbeng.query_receipts(["shop"])))
+        dbeng.close()
+        other.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import datetime
+import logging
+import os
+import random
+import unittest
+
+import expiry
+from db import dbengine
+
+
+test_db_name = "test_expiry.db"
+
+class MemorySink(expiry.NotificationSink):
+    def __init__(self):
+        self.alerts = []
+
+    def notify(self, alert: dict) -> None:
+        self.alerts.append(alert)
+
+class Clock(object):
+    def __init__(self, now: datetime.datetime):
+        self.now = now
+
+    def __call__(self) -> datetime.datetime:
+        return self.now
+
+class ExpirySchedulerTests(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        self.dbeng = dbengine.DbEngine(logging, test_db_name)
+        self.start = datetime.datetime(2020, 1, 1)
+
+    def insert_receipts(self, count: int, days: int) -> dict:
+        rng = random.Random(count)
+        expiries = {}
+        items = []
+        for i in range(count):
+            expiry_date = self.start + datetime.timedelta(
+                    days=rng.randrange(days), hours=rng.randrange(24))
+            items.append(({"filename": f"{i}.jpg",
+                           "purchase_date": "2019-12-01",
+                           "ocr_text": "x",
+                           "expiry_date": expiry_date}, []))
+        receipt_ids = self.dbeng.insert_receipts(items)
+        for receipt_id, (receipt, _) in zip(receipt_ids, items):
+            expiries[receipt_id] = receipt["expiry_date"]
+        return expiries
+
+    def test_time_advancing_over_100k_receipts(self):
+        days = 1000
+        lead_time = datetime.timedelta(days=14)
+        expiries = self.insert_receipts(100000, days)
+
+        clock = Clock(self.start)
+        sink = MemorySink()
+        scheduler = expiry.ExpiryScheduler(self.dbeng, sink,
+                                           lead_time=lead_time, clock=clock)
+        self.assertEqual(100000, scheduler.load())
+
+        # Receipts inserted later are pushed to the heap directly
+        late_id = self.dbeng.insert_receipt({"filename": "late.jpg",
+                                             "purchase_date": "2020-01-01",
+                                             "ocr_text": "x",
+                                             "expiry_date": self.start})
+        scheduler.add(late_id, "late.jpg", self.start)
+        expiries[late_id] = self.start
+
+        for day in range(days + 1):
+            clock.now = self.start + datetime.timedelta(days=day)
+            for alert in scheduler.check():
+                expiry_date = expiries[alert["receipt_id"]]
+                self.assertLessEqual(expiry_date, clock.now + lead_time,
+                                     "Notified too early")
+                # Already within lead time at the first check
+                if day > 0:
+                    self.assertGreater(expiry_date,
+                                       clock.now - datetime.timedelta(days=1)
+                                       + lead_time, "Notified too late")
+
+        notified = [i["receipt_id"] for i in sink.alerts]
+        self.assertEqual(len(expiries), len(notified))
+        self.assertSetEqual(set(expiries.keys()), set(notified),
+                            "Receipt notified twice or not at all")
+        dates = [i["expiry_date"] for i in sink.alerts]
+        self.assertListEqual(sorted(dates), dates, "Not in expiry order")
+        self.assertIsNone(scheduler.next_expiry())
+
+    def test_notified_receipts_arent_reloaded(self):
+        self.insert_receipts(100, 100)
+        clock = Clock(self.start + datetime.timedelta(days=50))
+        sink = MemorySink()
+        scheduler = expiry.ExpiryScheduler(self.dbeng, sink,
+                                           lead_time=datetime.timedelta(0),
+                                           clock=clock)
+        scheduler.load()
+        clock.now += datetime.timedelta(days=10)
+        notified = len(scheduler.check())
+        self.assertGreater(notified, 0)
+
+        restarted = expiry.ExpiryScheduler(self.dbeng, sink, clock=clock)
+        self.assertEqual(len(scheduler), restarted.load())
+
+    def test_expired_while_down(self):
+        expiries = self.insert_receipts(10, 10)
+        clock = Clock(self.start + datetime.timedelta(days=20))
+        sink = MemorySink()
+        scheduler = expiry.ExpiryScheduler(self.dbeng, sink, clock=clock)
+        self.assertEqual(10, scheduler.load())
+        self.assertEqual(10, len(scheduler.check()))
+        self.assertTrue(all(i["expired"] and i["days_left"] < 0
+                            for i in sink.alerts))
+        self.assertSetEqual(set(expiries), set(i["receipt_id"]
+                                               for i in sink.alerts))
+
+    def test_poll_inserts(self):
+        self.insert_receipts(5, 100)
+        clock = Clock(self.start)
+        sink = MemorySink()
+        scheduler = expiry.ExpiryScheduler(self.dbeng, sink, clock=clock,
+                                           poll_inserts=True)
+        scheduler.load()
+        # Inserted by another process and by this one
+        other = self.dbeng.insert_receipts(
+                [({"filename": f"other_{i}.jpg",
+                   "purchase_date": "2019-12-01",
+                   "ocr_text": "x",
+                   "expiry_date": self.start}, []) for i in range(3)])
+        own_id = self.dbeng.insert_receipt({"filename": "own.jpg",
+                                            "purchase_date": "2020-01-01",
+                                            "ocr_text": "x",
+                                            "expiry_date": self.start})
+        scheduler.add(own_id, "own.jpg", self.start)
+        self.assertEqual(3, scheduler.poll())
+        self.assertEqual(0, scheduler.poll())
+        self.assertEqual(9, len(scheduler))
+
+        clock.now += datetime.timedelta(days=200)
+        self.assertEqual(9, len(scheduler.check()))
+        self.assertEqual(0, scheduler.poll())
+        self.assertTrue(set(other).issubset(i["receipt_id"]
+                                            for i in sink.alerts))
+
+    def test_failed_notifications_are_retried(self):
+        self.insert_receipts(10, 10)
+
+        class FailingSink(MemorySink):
+            fail = True
+            def notify(self, alert):
+                if self.fail:
+                    raise OSError("Connection refused")
+                super().notify(alert)
+
+        clock = Clock(self.start)
+        sink = FailingSink()
+        scheduler = expiry.ExpiryScheduler(self.dbeng, sink, clock=clock)
+        scheduler.load()
+        clock.now += datetime.timedelta(days=20)
+        self.assertEqual(0, len(scheduler.check()))
+        sink.fail = False
+        self.assertEqual(10, len(scheduler.check()))
+
+if __name__ == '__main__':
+    unittest.main()
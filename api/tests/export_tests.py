@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import unittest
+
+import receipts_api
+from db import dbengine
+
+
+test_db_name = "test_export.db"
+# Rows of the streaming test, override with EXPORT_TEST_ROWS
+test_rows = int(os.environ.get("EXPORT_TEST_ROWS", 1000000))
+max_rss_growth = 50 * 1024 * 1024
+
+def rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def fill_db(rows: int) -> None:
+    """
+    Synthetic receipts tagged 'shop_<n>' and 'even' or 'odd', one a day
+    in 28 day months from 2000-01-02 on, every tenth with an expiry date.
+    """
+    conn = sqlite3.connect(test_db_name)
+    # Keeping the search index up to date would take most of the time
+    for trigger in ("receipt_fts_insert", "receipt_fts_tag_insert"):
+        conn.execute(f"DROP TRIGGER {trigger};")
+    conn.executemany("INSERT INTO tag (id, tag) VALUES (?, ?);",
+                     [(1, "even"), (2, "odd")]
+                     + [(3 + i, f"shop_{i}") for i in range(10)])
+    receipts = ((i, f"uploads/{i:064x}.jpg",
+                 f"{2000 + i // 365 % 100:04}-{i // 28 % 12 + 1:02}-"
+                 + f"{i % 28 + 1:02}",
+                 "2030-01-01" if i % 10 == 0 else None, "", f"{i:064x}")
+                for i in range(1, rows + 1))
+    conn.executemany("INSERT INTO receipt (id, filename, purchase_date, "
+                     + "expiry_date, ocr_text, content_sha256) "
+                     + "VALUES (?, ?, ?, ?, ?, ?);", receipts)
+    associations = ((i, tag_id) for i in range(1, rows + 1)
+                    for tag_id in (1 + i % 2, 3 + i % 10))
+    conn.executemany("INSERT INTO receipt_tag_association (receipt_id, "
+                     + "tag_id) VALUES (?, ?);", associations)
+    conn.commit()
+    conn.close()
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        dbengine.DbEngine(logging, test_db_name).close()
+        self.client = receipts_api.app.test_client()
+
+    def tearDown(self):
+        receipts_api.dbeng.close()
+        os.unlink(test_db_name)
+
+    def open_db(self, rows: int) -> None:
+        fill_db(rows)
+        receipts_api.dbeng = dbengine.DbEngine(logging, test_db_name)
+
+    def test_export_formats(self):
+        self.open_db(100)
+        resp = self.client.get("/export?tags=shop_3,odd&from=2000-01-01")
+        self.assertEqual(200, resp.status_code, resp.data)
+        self.assertEqual("text/csv", resp.mimetype)
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertListEqual([3, 13, 23, 33, 43, 53, 63, 73, 83, 93],
+                             [int(r["id"]) for r in rows])
+        self.assertEqual("odd shop_3", rows[0]["tags"])
+
+        resp = self.client.get("/export?tags=even,odd&match=any&format=jsonl"
+                               + "&to=2000-01-03")
+        rows = [json.loads(i) for i in resp.get_data(as_text=True).split("\n")
+                if i != ""]
+        self.assertListEqual([1, 2], [r["id"] for r in rows])
+        self.assertIsNone(rows[1]["expiry_date"])
+
+        self.assertEqual(422, self.client.get("/export?format=xml").status_code)
+        self.assertEqual(422, self.client.get("/export?group=day").status_code)
+        resp = self.client.get("/export?tags=unknown")
+        self.assertEqual("id,filename,purchase_date,expiry_date,"
+                         + "content_sha256,tags\n", resp.get_data(as_text=True))
+
+    def test_export_counts(self):
+        self.open_db(100)
+        resp = self.client.get("/export?group=tag&format=jsonl")
+        counts = [json.loads(i) for i in resp.get_data(as_text=True).split("\n")
+                  if i != ""]
+        self.assertDictEqual({"tag": "even", "receipts": 50,
+                              "with_expiry": 10}, counts[0])
+        self.assertEqual(12, len(counts))
+
+        resp = self.client.get("/export?group=month&tags=shop_0")
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertListEqual([("2000-01", "2", "2"), ("2000-02", "3", "3"),
+                              ("2000-03", "3", "3"), ("2000-04", "2", "2")],
+                             [(r["month"], r["receipts"], r["with_expiry"])
+                              for r in rows])
+
+    @unittest.skipUnless(os.path.exists("/proc/self/statm"),
+                         "Needs /proc to measure memory use")
+    def test_export_streamed(self):
+        self.open_db(test_rows)
+        baseline = rss()
+        peak = baseline
+        lines = 0
+        resp = self.client.get("/export", buffered=False)
+        for i, chunk in enumerate(resp.response):
+            lines += chunk.count(b"\n") if isinstance(chunk, bytes) \
+                         else chunk.count("\n")
+            if i % 10 == 0:
+                peak = max(peak, rss())
+        resp.close()
+        self.assertEqual(test_rows + 1, lines)
+        self.assertLess(peak - baseline, max_rss_growth,
+                        f"Memory grew by {(peak - baseline) / 1024 / 1024:.1f} MB")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import io
+import logging
+import os
+import shutil
+import unittest
+
+import import_receipts
+import storage
+from db import dbengine
+
+
+test_db_name = "test_import.db"
+test_upload_dir = "test_import_uploads"
+test_scans_dir = "test_import_scans"
+test_checkpoint = "test_import.checkpoint"
+
+class ImportTests(unittest.TestCase):
+    def setUp(self):
+        for path in (test_db_name, test_checkpoint):
+            if os.path.exists(path):
+                os.unlink(path)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        shutil.rmtree(test_scans_dir, ignore_errors=True)
+        self.dbeng = dbengine.DbEngine(logging, test_db_name)
+        self.storage = storage.LocalStorage(test_upload_dir)
+
+    def tearDown(self):
+        self.dbeng.close()
+        for path in (test_db_name, test_checkpoint):
+            if os.path.exists(path):
+                os.unlink(path)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        shutil.rmtree(test_scans_dir, ignore_errors=True)
+
+    def write_scan(self, relpath: str, content: bytes) -> None:
+        path = os.path.join(test_scans_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def run_import(self) -> import_receipts.Importer:
+        importer = import_receipts.Importer(self.dbeng, self.storage,
+                                            test_scans_dir, test_checkpoint,
+                                            workers=2, batch_size=2,
+                                            out=io.StringIO())
+        importer.run()
+        return importer
+
+    def test_path_tags(self):
+        self.assertEqual("2019-01-01 shop food",
+                         import_receipts.path_tags("2019/01/shop_food.jpg"))
+        self.assertEqual("work tv 2_years",
+                         import_receipts.path_tags("work/tv_2_years.png"))
+        self.assertEqual("shop 2019-01-12",
+                         import_receipts.path_tags("2019/01/shop_2019-01-12.jpg"))
+        self.assertEqual("2019 13 shop",
+                         import_receipts.path_tags("2019/13/shop.jpg"))
+
+    def test_import(self):
+        self.write_scan("2019/01/shop_food.jpg", b"first")
+        self.write_scan("2019/02/market_1_year.png", b"second")
+        self.write_scan("2019/02/copy.jpg", b"first")
+        self.write_scan("2019/02/notes.txt", b"not a receipt")
+        importer = self.run_import()
+        self.assertEqual(2, importer.imported)
+        self.assertEqual(1, importer.skipped)
+
+        receipts = self.dbeng.query_receipts(["shop"])
+        self.assertEqual(1, len(receipts))
+        self.assertTrue(receipts[0]["purchase_date"].startswith("2019-01-01"))
+        receipts = self.dbeng.query_receipts(["market"])
+        self.assertEqual(1, len(receipts))
+        self.assertTrue(receipts[0]["expiry_date"].startswith("2020-02-01"))
+        with open(receipts[0]["filename"], "rb") as f:
+            self.assertEqual(b"second", f.read())
+
+        # Resumed after the checkpoint
+        self.write_scan("2020/01/shop.jpg", b"third")
+        importer = self.run_import()
+        self.assertEqual(1, importer.imported)
+        self.assertEqual(0, importer.skipped)
+        self.assertEqual(2, len(self.dbeng.query_receipts(["shop"])))
+
+        # Known content is skipped without the checkpoint
+        os.unlink(test_checkpoint)
+        importer = self.run_import()
+        self.assertEqual(0, importer.imported)
+        self.assertEqual(4, importer.skipped)
+
+if __name__ == '__main__':
+    unittest.main()
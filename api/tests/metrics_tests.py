@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import io
+import logging
+import os
+import shutil
+import unittest
+
+import metrics
+import receipts_api
+import storage
+from db import dbengine
+
+
+test_db_name = "test_metrics.db"
+test_upload_dir = "test_metrics_uploads"
+
+class RegistryTests(unittest.TestCase):
+    def test_expose(self):
+        registry = metrics.Registry(enabled=True)
+        uploads = registry.counter("uploads_total", "Uploads", ["status"])
+        uploads.labels("200").inc()
+        uploads.labels("200").inc(2)
+        uploads.labels('a "b"\n').inc()
+        latency = registry.histogram("latency_seconds", "Latency",
+                                     buckets=(0.1, 1.0))
+        latency.labels().observe(0.05)
+        latency.labels().observe(0.5)
+        latency.labels().observe(5)
+        self.assertIs(uploads, registry.counter("uploads_total", "Uploads",
+                                                ["status"]))
+        self.assertRaises(ValueError, registry.histogram, "uploads_total", "")
+
+        self.assertEqual("\n".join([
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            "latency_seconds_sum 5.55",
+            "latency_seconds_count 3",
+            "# HELP uploads_total Uploads",
+            "# TYPE uploads_total counter",
+            'uploads_total{status="200"} 3',
+            'uploads_total{status="a \\"b\\"\\n"} 1']) + "\n",
+            registry.expose())
+
+    def test_disabled(self):
+        registry = metrics.Registry()
+        latency = registry.histogram("latency_seconds", "Latency")
+        with latency.labels().time():
+            pass
+        registry.counter("uploads_total", "Uploads").labels().inc()
+        self.assertNotIn("_count 1", registry.expose())
+        self.assertNotIn("uploads_total 1", registry.expose())
+
+class MetricsRouteTests(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        receipts_api.receipt_storage = storage.LocalStorage(test_upload_dir)
+        receipts_api.dbeng = dbengine.DbEngine(
+                logging, test_db_name, metrics=receipts_api.registry)
+        self.client = receipts_api.app.test_client()
+
+    def tearDown(self):
+        receipts_api.registry.enabled = False
+        receipts_api.dbeng.close()
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+
+    def test_metrics(self):
+        self.assertEqual(404, self.client.get("/metrics").status_code)
+
+        receipts_api.registry.enabled = True
+        data = {"file": (io.BytesIO(os.urandom(1000)), "receipt.png"),
+                "tags": "shop"}
+        self.assertEqual(200, self.client.post("/", data=data).status_code)
+        resp = self.client.get("/metrics")
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+        for stage in ("receive", "store", "read", "hash", "write", "insert",
+                      "tags", "notify"):
+            self.assertIn(f'receipts_upload_stage_seconds_count{{stage="{stage}"}}',
+                          text)
+        self.assertIn('receipts_db_seconds_count{method="insert_receipt"} 1',
+                      text)
+        self.assertIn('receipts_request_seconds_count{endpoint="/",'
+                      + 'method="POST",status="200"} 1', text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import logging
+import os
+import time
+import unittest
+
+import ocr
+from db import dbengine
+
+
+test_db_name = "test_ocr.db"
+
+class FailingEngine(ocr.OcrEngine):
+    def extract_text(self, path: str) -> str:
+        raise RuntimeError(f"Can't read {path}")
+
+class CrashingEngine(ocr.OcrEngine):
+    """
+    Kills its worker process the first time, breaking the pool.
+    """
+    def __init__(self, marker: str):
+        self.marker = marker
+
+    def extract_text(self, path: str) -> str:
+        if not os.path.exists(self.marker):
+            open(self.marker, "w").close()
+            os._exit(1)
+        return "total 3.20"
+
+def insert_receipts(dbeng, count: int) -> None:
+    for i in range(count):
+        dbeng.insert_receipt({"filename": f"{i}.jpg",
+                              "purchase_date": "2019-12-01",
+                              "ocr_text": "",
+                              "expiry_date": None})
+
+def wait_until(predicate, timeout: float=10.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+class OcrWorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        self.dbeng = dbengine.DbEngine(logging, test_db_name)
+
+    def test_fills_ocr_text(self):
+        insert_receipts(self.dbeng, 5)
+        self.assertEqual(5, self.dbeng.count_ocr_jobs()["pending"])
+
+        pool = ocr.OcrWorkerPool(self.dbeng, ocr.StubEngine("total 12.50"),
+                                 workers=2, poll_interval=0.1)
+        pool.start()
+        try:
+            done = wait_until(lambda: pool.stats()["completed"] == 5)
+        finally:
+            pool.stop()
+        self.assertTrue(done, "OCR jobs weren't completed")
+
+        texts = self.dbeng.cur.execute("SELECT ocr_text FROM receipt;") \
+                    .fetchall()
+        self.assertListEqual(["total 12.50"] * 5, [i[0] for i in texts])
+        stats = pool.stats()
+        self.assertEqual(0, stats["queue"]["pending"])
+        self.assertEqual(5, stats["queue"]["done"])
+        self.assertGreaterEqual(stats["latency_p99"], stats["latency_p50"])
+
+    def test_retries_and_gives_up(self):
+        insert_receipts(self.dbeng, 2)
+        pool = ocr.OcrWorkerPool(self.dbeng, FailingEngine(), workers=1,
+                                 max_attempts=3, retry_backoff=0.0,
+                                 poll_interval=0.1)
+        pool.start()
+        try:
+            done = wait_until(lambda: pool.stats()["failed"] == 2)
+        finally:
+            pool.stop()
+        self.assertTrue(done, "OCR jobs weren't given up on")
+
+        jobs = self.dbeng.cur.execute("SELECT state, attempts, last_error "
+                                      + "FROM ocr_job;").fetchall()
+        for state, attempts, last_error in jobs:
+            self.assertEqual("failed", state)
+            self.assertEqual(3, attempts)
+            self.assertIn("Can't read", last_error)
+
+    def test_broken_pool_is_restarted(self):
+        marker = "test_ocr_crashed"
+        if os.path.exists(marker):
+            os.unlink(marker)
+        self.addCleanup(os.unlink, marker)
+        insert_receipts(self.dbeng, 2)
+        pool = ocr.OcrWorkerPool(self.dbeng, CrashingEngine(marker),
+                                 workers=1, retry_backoff=0.0,
+                                 poll_interval=0.1)
+        pool.start()
+        try:
+            done = wait_until(lambda: pool.stats()["completed"] == 2)
+        finally:
+            pool.stop()
+        self.assertTrue(done, "OCR jobs weren't completed after the crash")
+        self.assertEqual(2, self.dbeng.count_ocr_jobs()["done"])
+
+    def test_receipts_with_text_arent_queued(self):
+        self.dbeng.insert_receipt({"filename": "read.jpg",
+                                   "purchase_date": "2019-12-01",
+                                   "ocr_text": "already read",
+                                   "expiry_date": None})
+        self.assertEqual(0, self.dbeng.count_ocr_jobs()["pending"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -65,5 +65,41 @@ class ReceiptsApiParsers(unittest.TestCase):
                          years, \
                          "Expiring after 25 years failed")
 
+    def test_classify_tags(self):
+        tags = receipts_api.parse_tags(
+                "Shop\t2019-01-12 2018-12-31 1_year 10_days  2019-02-30 food")
+        parsed = receipts_api.classify_tags(tags)
+        self.assertListEqual(parsed.tags, ["2019-02-30", "food", "shop"])
+        self.assertEqual(parsed.purchase_date, datetime.datetime(2018, 12, 31))
+        self.assertEqual(parsed.expiry, relativedelta(days=10))
+
+        parsed = receipts_api.classify_tags(["shop", "2nd"])
+        self.assertListEqual(parsed.tags, ["shop", "2nd"])
+        self.assertIsNone(parsed.purchase_date)
+        self.assertIsNone(parsed.expiry)
+
+    def test_parse_wrappers(self):
+        tags = ["1_month", "2019-01-12", "shop"]
+        purchase_date = receipts_api.parse_purchase_date(tags)
+        self.assertEqual(purchase_date, datetime.datetime(2019, 1, 12))
+        self.assertEqual(receipts_api.parse_expiry_date(purchase_date, tags),
+                         datetime.datetime(2019, 2, 12))
+        self.assertListEqual(tags, ["shop"])
+
+        # Dates which don't exist are plain tags
+        tags = ["2020-13-45", "2019-01-12", "2018-12-31", "shop"]
+        purchase_date = receipts_api.parse_purchase_date(tags)
+        self.assertEqual(purchase_date, datetime.datetime(2018, 12, 31))
+        self.assertListEqual(tags, ["2020-13-45", "shop"])
+
+        # Without a date the expiry starts from today
+        tags = ["1_day", "shop"]
+        purchase_date = receipts_api.parse_purchase_date(tags)
+        self.assertEqual(purchase_date.date(), datetime.date.today())
+        self.assertEqual(receipts_api.parse_expiry_date(purchase_date, tags),
+                         purchase_date + relativedelta(days=1))
+        self.assertIsNone(receipts_api.expiry_from(
+                purchase_date, relativedelta(years=100000)))
+
 if __name__ == '__main__':
     unittest.main()
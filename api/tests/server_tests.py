@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import receipts_api
+
+
+test_config = """
+[db]
+database_file = receipts.db
+pool_size = 2
+
+[storage]
+upload_dir = uploads
+
+[server]
+workers = 2
+"""
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        config_path = os.path.join(self.workdir, "receipts.cfg")
+        with open(config_path, "w") as f:
+            f.write(test_config)
+        self.receipts_config = receipts_api.load_config(config_path)
+
+    def tearDown(self):
+        receipts_api.shutdown(timeout=1)
+        receipts_api.draining.clear()
+        if receipts_api.services_lock is not None:
+            receipts_api.services_lock.close()
+            receipts_api.services_lock = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_create_app(self):
+        app = receipts_api.create_app(self.receipts_config)
+        self.assertIsNotNone(receipts_api.services_lock,
+                             "First process didn't run the services")
+        self.assertIsNone(receipts_api.acquire_services_lock(
+                "receipts.db.services.lock"))
+
+        client = app.test_client()
+        data = {"file": (io.BytesIO(b"receipt"), "receipt.png"),
+                "tags": "shop"}
+        self.assertEqual(200, client.post("/", data=data).status_code)
+        self.assertEqual(1, len(receipts_api.dbeng.query_receipts(["shop"])))
+
+    def test_server_workers(self):
+        self.assertEqual(2, receipts_api.server_workers(self.receipts_config))
+        self.receipts_config["server"]["workers"] = "0"
+        self.assertEqual(os.cpu_count() or 1,
+                         receipts_api.server_workers(self.receipts_config))
+
+    def test_shutdown_drains_uploads(self):
+        app = receipts_api.create_app(self.receipts_config, services=False)
+        client = app.test_client()
+
+        # An upload in flight delays the shutdown
+        with receipts_api.uploads_idle:
+            receipts_api.uploads_in_flight += 1
+        stopper = threading.Thread(target=receipts_api.shutdown,
+                                   kwargs={"timeout": 10})
+        stopper.start()
+        time.sleep(0.1)
+        self.assertTrue(stopper.is_alive())
+
+        data = {"file": (io.BytesIO(b"late"), "late.png"), "tags": "shop"}
+        self.assertEqual(503, client.post("/", data=data).status_code)
+        self.assertEqual(200, client.get("/ocr/status").status_code)
+
+        with receipts_api.uploads_idle:
+            receipts_api.uploads_in_flight -= 1
+            receipts_api.uploads_idle.notify_all()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import pickle
+import shutil
+import unittest
+
+import storage
+from db import dbengine
+
+
+test_db_name = "test_storage.db"
+test_upload_dir = "test_storage_uploads"
+test_bucket = "receipts"
+
+def moto_available() -> bool:
+    return storage.boto3_available() \
+        and importlib.util.find_spec("moto") is not None
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        self.dbeng = dbengine.DbEngine(logging, test_db_name)
+
+    def tearDown(self):
+        self.dbeng.close()
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+
+    def test_store(self):
+        content = os.urandom(1000)
+        content_hash = hashlib.sha256(content).hexdigest()
+        sharded = storage.LocalStorage(test_upload_dir)
+        path, stored_hash = sharded.store(io.BytesIO(content), "jpg",
+                                          chunk_size=100)
+        self.assertEqual(content_hash, stored_hash)
+        self.assertEqual(os.path.join(test_upload_dir, content_hash[:2],
+                                      content_hash[2:4], f"{content_hash}.jpg"),
+                         path)
+        with open(path, "rb") as f:
+            self.assertEqual(content, f.read())
+
+        self.assertIsNone(sharded.store(io.BytesIO(content), "jpg"))
+        self.assertIsNone(sharded.store(io.BytesIO(b"known"), "jpg",
+                                        is_known=lambda h: True))
+        # Only the stored file and its shard directories are left
+        self.assertListEqual([content_hash[:2]], os.listdir(test_upload_dir))
+
+        flat = storage.LocalStorage(test_upload_dir, layout="flat")
+        path, _ = flat.store(io.BytesIO(content), "png")
+        self.assertEqual(os.path.join(test_upload_dir, f"{content_hash}.png"),
+                         path)
+
+    def test_migrate(self):
+        flat = storage.LocalStorage(test_upload_dir, layout="flat")
+        items = []
+        for i in range(25):
+            path, content_hash = flat.store(io.BytesIO(f"{i}".encode()), "jpg")
+            items.append(({"filename": path, "purchase_date": "2019-01-01",
+                           "expiry_date": None, "ocr_text": "",
+                           "content_sha256": content_hash if i > 0 else None},
+                          ["shop"]))
+        other = os.path.join(test_upload_dir, "not-a-hash.jpg")
+        with open(other, "wb") as f:
+            f.write(b"other")
+        items.append(({"filename": other, "purchase_date": "2019-01-01",
+                       "expiry_date": None, "ocr_text": ""}, ["shop"]))
+        self.dbeng.insert_receipts(items)
+
+        sharded = storage.LocalStorage(test_upload_dir)
+        # A file linked by an interrupted migration
+        row = self.dbeng.list_receipt_files(1, 1)[0]
+        sharded.relocate(row["filename"], row["content_sha256"])
+
+        migrator = storage.LayoutMigrator(self.dbeng, sharded, batch_size=10,
+                                          pause=0)
+        self.assertEqual(25, migrator.run())
+        self.assertEqual(1, migrator.skipped)
+
+        for row in self.dbeng.list_receipt_files(0, 100):
+            if row["filename"] == other:
+                continue
+            content_hash = storage.receipt_hash(row)
+            self.assertEqual(sharded.path_for(content_hash, "jpg"),
+                             row["filename"])
+            self.assertTrue(os.path.exists(row["filename"]))
+        flat_files = [i.name for i in os.scandir(test_upload_dir)
+                      if i.is_file()]
+        self.assertListEqual(["not-a-hash.jpg"], flat_files,
+                             "Flat files left behind")
+
+        self.assertEqual(0, storage.LayoutMigrator(self.dbeng, sharded).run())
+
+@unittest.skipUnless(moto_available(), "boto3 or moto isn't installed")
+class S3StorageTests(unittest.TestCase):
+    def setUp(self):
+        import boto3
+        import moto
+
+        os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+        os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+        mock = getattr(moto, "mock_aws", None) or getattr(moto, "mock_s3")
+        self.mock = mock()
+        self.mock.start()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=test_bucket)
+        self.storage = storage.S3Storage(test_bucket, prefix="r/",
+                                         region="us-east-1",
+                                         multipart_threshold_mb=5,
+                                         multipart_chunk_mb=5,
+                                         max_concurrency=3)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_store(self):
+        content = os.urandom(1000)
+        content_hash = hashlib.sha256(content).hexdigest()
+        key, stored_hash = self.storage.store(io.BytesIO(content), "jpg")
+        self.assertEqual(content_hash, stored_hash)
+        self.assertEqual(f"r/{content_hash[:2]}/{content_hash[2:4]}/"
+                         + f"{content_hash}.jpg", key)
+        self.assertIsNone(self.storage.store(io.BytesIO(content), "jpg"))
+        self.assertIsNone(self.storage.store(io.BytesIO(b"known"), "jpg",
+                                             is_known=lambda h: True))
+
+        # Worker processes get a copy without the client
+        copy = pickle.loads(pickle.dumps(self.storage))
+        self.assertIsNone(copy.client)
+        with copy.local_copy(key) as path:
+            self.assertTrue(path.endswith(".jpg"))
+            with open(path, "rb") as f:
+                self.assertEqual(content, f.read())
+        self.assertFalse(os.path.exists(path))
+
+        self.storage.remove(key)
+        self.assertFalse(self.storage.exists(key))
+
+    def test_multipart(self):
+        content = os.urandom(12 * 1024 * 1024)
+        key, _ = self.storage.store(io.BytesIO(content), "tiff")
+        head = self.s3.head_object(Bucket=test_bucket, Key=key)
+        self.assertEqual(len(content), head["ContentLength"])
+        # Multipart uploads have an ETag of the form <md5>-<parts>
+        self.assertTrue(head["ETag"].strip('"').endswith("-3"), head["ETag"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+import threading
+import time
+import unittest
+
+import receipts_api
+import storage
+import thumbs
+from db import dbengine
+
+
+test_db_name = "test_thumbs.db"
+test_upload_dir = "test_thumbs_uploads"
+test_cache_dir = "test_thumbs_cache"
+
+class FakeRender(object):
+    """
+    Writes size bytes instead of an image and counts the renders.
+    """
+    def __init__(self, size: int=100, delay: float=0.0):
+        self.size = size
+        self.delay = delay
+        self.renders = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, src, dest, width, fmt):
+        time.sleep(self.delay)
+        with self.lock:
+            self.renders += 1
+        with open(src, "rb") as f:
+            content = f.read()
+        thumb = f"{width} {fmt} ".encode() + content
+        with open(dest, "wb") as f:
+            f.write(thumb.ljust(self.size, b"x"))
+
+class ThumbnailCacheTests(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(test_cache_dir, ignore_errors=True)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        os.mkdir(test_upload_dir)
+        self.src = os.path.join(test_upload_dir, "receipt.png")
+        with open(self.src, "wb") as f:
+            f.write(b"receipt")
+
+    def tearDown(self):
+        shutil.rmtree(test_cache_dir, ignore_errors=True)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+
+    def test_snap_width(self):
+        self.assertEqual(128, thumbs.snap_width(1))
+        self.assertEqual(256, thumbs.snap_width(200))
+        self.assertEqual(1024, thumbs.snap_width(1024))
+        self.assertIsNone(thumbs.snap_width(0))
+        self.assertIsNone(thumbs.snap_width(5000))
+
+    def test_hit_and_miss(self):
+        render = FakeRender()
+        cache = thumbs.ThumbnailCache(test_cache_dir, 10000, render=render)
+        path = cache.get(self.src, "abc", 128, "jpeg")
+        self.assertEqual(cache.get(self.src, "abc", 128, "jpeg"), path)
+        cache.get(self.src, "abc", 256, "jpeg")
+        cache.close()
+        self.assertEqual(2, render.renders)
+        stats = cache.stats()
+        self.assertEqual((1, 2), (stats["hits"], stats["misses"]))
+        with open(path, "rb") as f:
+            self.assertTrue(f.read().startswith(b"128 jpeg receipt"))
+
+    def test_concurrent_misses_render_once(self):
+        render = FakeRender(delay=0.1)
+        cache = thumbs.ThumbnailCache(test_cache_dir, 10000, workers=4,
+                                      render=render)
+        threads = [threading.Thread(target=cache.get,
+                                    args=(self.src, "abc", 128, "jpeg"))
+                   for _ in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        cache.close()
+        self.assertEqual(1, render.renders)
+
+    def test_lru_eviction(self):
+        render = FakeRender(size=100)
+        cache = thumbs.ThumbnailCache(test_cache_dir, 350, render=render)
+        for name in ("a", "b", "c"):
+            cache.get(self.src, name, 128, "jpeg")
+        # "a" becomes the most recently used
+        cache.get(self.src, "a", 128, "jpeg")
+        cache.get(self.src, "d", 128, "jpeg")
+        cache.close()
+
+        self.assertListEqual(["a-128.jpeg", "c-128.jpeg", "d-128.jpeg"],
+                             sorted(os.listdir(test_cache_dir)))
+        stats = cache.stats()
+        self.assertEqual(1, stats["evictions"])
+        self.assertEqual(300, stats["bytes"])
+
+        # The limit is applied to what's on disk after a restart
+        cache = thumbs.ThumbnailCache(test_cache_dir, 200, render=render)
+        self.assertEqual(2, len(os.listdir(test_cache_dir)))
+        self.assertEqual(200, cache.stats()["bytes"])
+        cache.close()
+
+    def test_evicted_files_already_removed(self):
+        render = FakeRender(size=100)
+        cache = thumbs.ThumbnailCache(test_cache_dir, 250, render=render)
+        path = cache.get(self.src, "a", 128, "jpeg")
+        cache.get(self.src, "b", 128, "jpeg")
+        # Cleaned up by hand, the eviction mustn't fail the render
+        os.remove(path)
+        self.assertTrue(cache.get(self.src, "c", 128, "jpeg").endswith(
+                "c-128.jpeg"))
+        cache.close()
+        self.assertEqual(1, cache.stats()["evictions"])
+
+    def test_prefetch_format(self):
+        for webp, name in ((True, "abc-256.webp"), (False, "abc-256.jpeg")):
+            shutil.rmtree(test_cache_dir, ignore_errors=True)
+            cache = thumbs.ThumbnailCache(test_cache_dir, 10000,
+                                          render=FakeRender(), webp=webp)
+            cache.prefetch(self.src, "abc")
+            cache.close()
+            self.assertListEqual([name], os.listdir(test_cache_dir))
+            self.assertEqual(0, cache.stats()["misses"])
+
+    @unittest.skipUnless(thumbs.pillow_available(), "Pillow isn't installed")
+    def test_render_thumbnail(self):
+        from PIL import Image
+
+        src = os.path.join(test_upload_dir, "scan.tiff")
+        Image.new("RGB", (2000, 3000), "white").save(src, "TIFF")
+        dest = os.path.join(test_upload_dir, "thumb.jpeg")
+        thumbs.render_thumbnail(src, dest, 256, "jpeg")
+        with Image.open(dest) as thumb:
+            self.assertEqual((256, 384), thumb.size)
+            self.assertEqual("JPEG", thumb.format)
+
+class ThumbnailRouteTests(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(test_db_name):
+            os.unlink(test_db_name)
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        shutil.rmtree(test_cache_dir, ignore_errors=True)
+        os.mkdir(test_upload_dir)
+
+        receipts_api.receipt_storage = storage.LocalStorage(test_upload_dir)
+        receipts_api.dbeng = dbengine.DbEngine(logging, test_db_name)
+        self.render = FakeRender()
+        receipts_api.thumbnails = thumbs.ThumbnailCache(test_cache_dir, 10000,
+                                                        render=self.render,
+                                                        webp=True)
+        self.client = receipts_api.app.test_client()
+
+    def tearDown(self):
+        receipts_api.thumbnails.close()
+        receipts_api.thumbnails = None
+        shutil.rmtree(test_upload_dir, ignore_errors=True)
+        shutil.rmtree(test_cache_dir, ignore_errors=True)
+
+    def test_thumbnail(self):
+        content = b"receipt image"
+        content_hash = hashlib.sha256(content).hexdigest()
+        data = {"file": (io.BytesIO(content), "receipt.png"), "tags": "shop"}
+        self.assertEqual(200, self.client.post("/", data=data).status_code)
+        receipt_id = receipts_api.dbeng.query_receipts(["shop"])[0]["id"]
+
+        resp = self.client.get(f"/receipts/{receipt_id}/thumb?w=200")
+        self.assertEqual(200, resp.status_code, resp.data)
+        self.assertEqual("image/jpeg", resp.mimetype)
+        self.assertEqual(f'"{content_hash}-256-jpeg"', resp.headers["ETag"])
+        self.assertTrue(resp.data.startswith(b"256 jpeg receipt image"))
+
+        resp = self.client.get(f"/receipts/{receipt_id}/thumb?w=200",
+                               headers={"If-None-Match":
+                                        f'"{content_hash}-256-jpeg"'})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b"", resp.data)
+
+        resp = self.client.get(f"/receipts/{receipt_id}/thumb",
+                               headers={"Accept": "image/webp,image/*"})
+        self.assertEqual("image/webp", resp.mimetype)
+        self.assertEqual(f'"{content_hash}-256-webp"', resp.headers["ETag"])
+
+        # The WebP of the default width was rendered on upload
+        receipts_api.thumbnails.close()
+        self.assertEqual(2, self.render.renders)
+
+    def test_slow_render(self):
+        self.render.delay = 1.0
+        data = {"file": (io.BytesIO(b"slow"), "receipt.png"), "tags": "shop"}
+        self.assertEqual(200, self.client.post("/", data=data).status_code)
+        receipt_id = receipts_api.dbeng.query_receipts(["shop"])[0]["id"]
+
+        start = time.monotonic()
+        resp = self.client.get(f"/receipts/{receipt_id}/thumb?w=512")
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual("1", resp.headers["Retry-After"])
+        self.assertLess(time.monotonic() - start, 1.0)
+
+        time.sleep(1.0)
+        resp = self.client.get(f"/receipts/{receipt_id}/thumb?w=512")
+        self.assertEqual(200, resp.status_code)
+        # The prefetched one and the one the 503 was for
+        self.assertEqual(2, self.render.renders)
+
+    def test_thumbnail_errors(self):
+        self.assertEqual(404, self.client.get("/receipts/1/thumb").status_code)
+        self.assertEqual(422, self.client.get("/receipts/1/thumb?w=abc")
+                                  .status_code)
+        self.assertEqual(422, self.client.get("/receipts/1/thumb?w=5000")
+                                  .status_code)
+
+        receipts_api.thumbnails.close()
+        receipts_api.thumbnails = None
+        self.assertEqual(501, self.client.get("/receipts/1/thumb").status_code)
+        receipts_api.thumbnails = thumbs.ThumbnailCache(test_cache_dir, 100,
+                                                        render=self.render)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import collections
+import importlib.util
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Requested widths are rounded up to one of these to bound the cache size
+WIDTHS = (128, 256, 512, 1024)
+DEFAULT_WIDTH = 256
+FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+
+def pillow_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+def webp_supported() -> bool:
+    if not pillow_available():
+        return False
+    from PIL import features
+    return features.check("webp")
+
+def snap_width(width: int):
+    """
+    The smallest supported width at least as wide as width, or None if
+    it's out of range.
+    """
+    if width < 1:
+        return None
+    for i in WIDTHS:
+        if i >= width:
+            return i
+    return None
+
+def render_thumbnail(src: str, dest: str, width: int, fmt: str) -> None:
+    """
+    Scale src down to width, keeping the aspect ratio, and save it to
+    dest. Pillow is an optional dependency.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as image:
+        # Lets JPEG decoding skip most of the pixels of large scans
+        image.draft("RGB", (width, width * 10))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width * 10), Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(dest, FORMATS[fmt], quality=80)
+
+
+def remove_file(path: str) -> None:
+    """
+    Remove an evicted thumbnail, which a concurrent eviction or a cleanup
+    of the cache directory may have removed already.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ThumbnailCache(object):
+    """
+    Scaled down copies of receipt images on disk, named by the content
+    hash, width and format. Thumbnails are rendered in a thread pool, and
+    concurrent requests for the same thumbnail wait for one render. The
+    least recently used thumbnails are removed when the cache grows over
+    max_bytes. Usage is tracked in memory, so after a restart the oldest
+    files go first. webp tells whether WebP thumbnails can be rendered.
+    Receipt files are read through storage when they aren't local files.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int, workers: int=2,
+                 render=render_thumbnail, webp: bool=False, storage=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.render = render
+        self.webp = webp
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="Thumbnail")
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.rendering = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.__load()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, src: str, content_hash: str, width: int, fmt: str,
+            timeout: float=30.0) -> str:
+        """
+        The path of the thumbnail of src, rendering it if needed. Raises
+        TimeoutError if it isn't rendered within timeout, the render goes
+        on in the background.
+        """
+        return self.__lookup(src, content_hash, width, fmt).result(timeout)
+
+    def prefetch(self, src: str, content_hash: str, width: int=DEFAULT_WIDTH,
+                 fmt: str=None) -> None:
+        """
+        Render a thumbnail in the background, e.g. right after an upload.
+        By default in the format browsers get, WebP when it's supported.
+        """
+        if fmt is None:
+            fmt = "webp" if self.webp else "jpeg"
+        self.__lookup(src, content_hash, width, fmt, count=False)
+
+    def forget(self, path: str) -> None:
+        """
+        Drop an entry whose file has disappeared.
+        """
+        name = os.path.basename(path)
+        with self.lock:
+            size = self.entries.pop(name, None)
+            if size is not None:
+                self.size -= size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def __lookup(self, src: str, content_hash: str, width: int, fmt: str,
+                 count: bool=True):
+        name = f"{content_hash}-{width}.{fmt}"
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                if count:
+                    self.hits += 1
+                future = Future()
+                future.set_result(self.path(name))
+                return future
+            if count:
+                self.misses += 1
+            future = self.rendering.get(name)
+            if future is None:
+                future = self.executor.submit(self.__render, src, name,
+                                              width, fmt)
+                self.rendering[name] = future
+            return future
+
+    def __render(self, src: str, name: str, width: int, fmt: str) -> str:
+        path = self.path(name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            if self.storage is None:
+                self.render(src, tmp_path, width, fmt)
+            else:
+                with self.storage.local_copy(src) as local_src:
+                    self.render(local_src, tmp_path, width, fmt)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            with self.lock:
+                self.entries[name] = size
+                self.size += size
+                evicted = self.__evict()
+            for i in evicted:
+                remove_file(self.path(i))
+            return path
+        except Exception as e:
+            logging.error(f"Thumbnail: Rendering {src} failed: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            with self.lock:
+                self.rendering.pop(name, None)
+
+    def __evict(self) -> list:
+        """
+        Drop the least recently used entries over max_bytes. The newest
+        entry is always kept. Returns the names to remove.
+        """
+        evicted = []
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    def __load(self) -> None:
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        with self.lock:
+            for _, name, size in files:
+                self.entries[name] = size
+                self.size += size
+            evicted = self.__evict()
+        for name in evicted:
+            remove_file(self.path(name))
+        logging.info(f"Thumbnail: Loaded {len(self.entries)} cached thumbnails")
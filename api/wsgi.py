@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Entry point for production WSGI servers. The configuration file is given
+in RECEIPTS_CONFIG, e.g.
+
+    RECEIPTS_CONFIG=/etc/receipts.cfg gunicorn -c gunicorn.conf.py wsgi:app
+
+Every worker process imports this module and opens its own database.
+"""
+
+import os
+
+import receipts_api
+
+receipts_config = receipts_api.load_config(os.environ.get("RECEIPTS_CONFIG",
+                                                          "receipts.cfg"))
+receipts_api.setup_logging(debug=False)
+app = receipts_api.create_app(
+        receipts_config, workers=receipts_api.server_workers(receipts_config))
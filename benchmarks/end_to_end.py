@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the whole receipt path: a fake IMAP server holding
+a synthetic corpus of tagged receipt mails, the IMAP producer, HTTP, the
+upload route, DbEngine and the disk. The corpus is generated from a seed,
+so runs with the same arguments process the same mails. Results are
+printed as JSON, or written to -o, for comparing runs over time:
+throughput, upload latency percentiles, peak RSS of the API and of this
+process, SQLite and storage growth, and the per-stage timings reported by
+the API's /metrics.
+
+Run from this directory, e.g.
+
+    ./end_to_end.py -n 500 -o results/$(git rev-parse --short HEAD).json
+"""
+import sys
+import os
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+API_DIR = os.path.join(ROOT_DIR, "api")
+PRODUCER_DIR = os.path.join(ROOT_DIR, "producers", "imap")
+sys.path.append(PRODUCER_DIR)
+sys.path.append(os.path.join(PRODUCER_DIR, "tests"))
+sys.path.append(os.path.join(API_DIR, "benchmarks"))
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+import requests
+
+import imap_handler
+from fake_imap import FakeImapServer, MailStore, make_message
+from load_test import gunicorn_available, percentile, wait_until_up
+
+SHOPS = ["k-market", "s-market", "lidl", "prisma", "verkkokauppa",
+         "gigantti", "tokmanni", "motonet", "clas_ohlson", "ikea"]
+CATEGORIES = ["groceries", "electronics", "tools", "furniture", "clothes",
+              "pharmacy", "fuel", "books"]
+EXPIRY_TAGS = ["6_months", "1_year", "2_years", "3_years"]
+
+config_template = """
+[db]
+database_file = {workdir}/receipts.db
+pool_size = 4
+
+[storage]
+upload_dir = {workdir}/uploads
+
+[server]
+bind = 127.0.0.1:{port}
+workers = {workers}
+threads = 4
+
+[metrics]
+enabled = yes
+"""
+
+METRIC_LINE_PAT = re.compile(r'^(\w+)_(sum|count)\{(\w+)="([^"]*)"\} (\S+)$')
+
+
+def png_image(rng: random.Random, width: int, height: int) -> bytes:
+    """
+    A grayscale PNG looking like a scanned receipt to the compressor: white
+    paper with lines of noise for text.
+    """
+    white = b"\xff" * width
+    rows = []
+    for y in range(height):
+        text = y % 16 < 6 and rng.random() < 0.8
+        rows.append(b"\x00" + (rng.randbytes(width) if text else white))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data \
+            + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) \
+        + chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) \
+        + chunk(b"IEND", b"")
+
+def build_corpus(seed: int, messages: int, max_images: int, width: int,
+                 height: int, duplicates: float) -> list:
+    """
+    (subject, images) of every mail. The subject holds the tags: a shop, a
+    category, a purchase date and sometimes an expiry period. A fraction
+    of the images are resent copies of earlier ones.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    sent = []
+    start = datetime.date(2019, 1, 1)
+    for i in range(messages):
+        date = start + datetime.timedelta(days=rng.randrange(730))
+        tags = [rng.choice(SHOPS), rng.choice(CATEGORIES),
+                date.strftime("%Y-%m-%d")]
+        if rng.random() < 0.3:
+            tags.append(rng.choice(EXPIRY_TAGS))
+        images = []
+        for n in range(rng.randint(1, max_images)):
+            if len(sent) > 0 and rng.random() < duplicates:
+                content = rng.choice(sent)
+            else:
+                content = png_image(rng, width, height)
+                sent.append(content)
+            images.append((f"receipt_{i}_{n}.png", content))
+        corpus.append((" ".join(tags), images))
+    return corpus
+
+def start_api(mode: str, workdir: str, port: int, workers: int):
+    config_path = os.path.join(workdir, "receipts.cfg")
+    with open(config_path, "w") as f:
+        f.write(config_template.format(workdir=workdir, port=port,
+                                       workers=workers))
+    if mode == "dev":
+        cmd = [sys.executable, "receipts_api.py", "-c", config_path,
+               "-p", str(port)]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+               "wsgi:app"]
+    env = dict(os.environ, RECEIPTS_CONFIG=config_path)
+    return subprocess.Popen(cmd, cwd=API_DIR, env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+def peak_rss_mb(pid: int):
+    """
+    Sum of the peak RSS of pid and its children, None without /proc.
+    """
+    total = 0
+    found = False
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+                        found = True
+        except OSError:
+            pass
+    return round(total / 1024, 1) if found else None
+
+def files_size(paths: list) -> int:
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+def tree_size(root: str) -> int:
+    return sum(os.path.getsize(os.path.join(d, f))
+               for d, _, files in os.walk(root) for f in files)
+
+def db_size(workdir: str) -> int:
+    db_path = os.path.join(workdir, "receipts.db")
+    return files_size([db_path, db_path + "-wal"])
+
+def stage_means(metrics_text: str) -> dict:
+    """
+    Mean milliseconds per label of the upload stage and DbEngine method
+    histograms in a /metrics response.
+    """
+    sums = {}
+    counts = {}
+    for line in metrics_text.splitlines():
+        match = METRIC_LINE_PAT.match(line)
+        if match is None:
+            continue
+        name, kind, _, label, value = match.groups()
+        target = sums if kind == "sum" else counts
+        target[(name, label)] = float(value)
+    means = {}
+    for (name, label), count in counts.items():
+        if count > 0 and (name, label) in sums:
+            means.setdefault(name, {})[label] = {
+                "count": int(count),
+                "mean_ms": round(sums[(name, label)] / count * 1000, 3)}
+    return means
+
+def latency_summary(latencies: list) -> dict:
+    if len(latencies) == 0:
+        return {}
+    return {f"p{p}": round(percentile(latencies, p) * 1000, 2)
+            for p in (50, 95, 99)} \
+        | {"max": round(max(latencies) * 1000, 2)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args) -> dict:
+    corpus = build_corpus(args.seed, args.n, args.i, args.width, args.height,
+                          args.duplicates)
+    store = MailStore()
+    for subject, images in corpus:
+        store.append("receipts", make_message(subject, images))
+    attachments = [content for _, images in corpus
+                   for _, content in images]
+
+    # Time every upload as the producer sees it
+    latencies = []
+    latencies_lock = threading.Lock()
+    upload = imap_handler.upload
+
+    def timed_upload(*upload_args, **upload_kwargs):
+        start = time.perf_counter()
+        try:
+            return upload(*upload_args, **upload_kwargs)
+        finally:
+            with latencies_lock:
+                latencies.append(time.perf_counter() - start)
+    imap_handler.upload = timed_upload
+
+    workdir = tempfile.mkdtemp(prefix="receipts-bench-")
+    api = start_api(args.server, workdir, args.port, args.w)
+    url = f"http://127.0.0.1:{args.port}/"
+    try:
+        wait_until_up(url)
+        db_before = db_size(workdir)
+        with FakeImapServer(store) as server:
+            host, port = server.address
+            with imap_handler.ImapHandler(login_name="receipt",
+                                          password="abc123",
+                                          server_address=host,
+                                          port=port,
+                                          use_ssl=False,
+                                          folder="receipts") as handler:
+                start = time.perf_counter()
+                if args.b > 0:
+                    with imap_handler.Uploader(url, args.c) as uploader:
+                        imap_handler.process_batched(handler, uploader,
+                                                     args.b)
+                else:
+                    imap_handler.process_messages(handler, url)
+                elapsed = time.perf_counter() - start
+        metrics_text = requests.get(url + "metrics").text
+        api_rss = peak_rss_mb(api.pid)
+    finally:
+        imap_handler.upload = upload
+        api.terminate()
+        api.wait(60)
+
+    try:
+        db_path = os.path.join(workdir, "receipts.db")
+        conn = sqlite3.connect(db_path)
+        receipts = conn.execute("SELECT count(*) FROM receipt;").fetchone()[0]
+        conn.close()
+        db_after = db_size(workdir)
+        storage_bytes = tree_size(os.path.join(workdir, "uploads"))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    attachment_bytes = sum(len(i) for i in attachments)
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+                                      .isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "params": {"seed": args.seed, "messages": args.n,
+                   "max_images": args.i, "width": args.width,
+                   "height": args.height, "duplicates": args.duplicates,
+                   "server": args.server, "workers": args.w,
+                   "fetch_batch_size": args.b, "upload_concurrency": args.c},
+        "results": {
+            "messages": len(corpus),
+            "attachments": len(attachments),
+            "unique_attachments": len(set(attachments)),
+            "receipts_stored": receipts,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(len(corpus) / elapsed, 2),
+            "attachments_per_s": round(len(attachments) / elapsed, 2),
+            "mb_per_s": round(attachment_bytes / elapsed / 1024 / 1024, 2),
+            "upload_latency_ms": latency_summary(latencies),
+            "api_peak_rss_mb": api_rss,
+            "harness_peak_rss_mb": round(resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "attachment_bytes": attachment_bytes,
+            "storage_bytes": storage_bytes,
+            "db_bytes_before": db_before,
+            "db_bytes_after": db_after,
+            "db_bytes_per_receipt": round((db_after - db_before)
+                                          / max(receipts, 1), 1),
+            "api_timings": stage_means(metrics_text),
+        },
+    }
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+            description="End-to-end receipts benchmark")
+    argparser.add_argument("-n", type=int, default=200, help="Mails")
+    argparser.add_argument("-i", type=int, default=3,
+                           help="Most images per mail")
+    argparser.add_argument("--width", type=int, default=600,
+                           help="Image width in pixels")
+    argparser.add_argument("--height", type=int, default=800,
+                           help="Image height in pixels")
+    argparser.add_argument("--duplicates", type=float, default=0.05,
+                           help="Fraction of images resent")
+    argparser.add_argument("--seed", type=int, default=1)
+    argparser.add_argument("--server", choices=("dev", "gunicorn"),
+                           default="dev")
+    argparser.add_argument("-w", type=int, default=4, help="gunicorn workers")
+    argparser.add_argument("-b", type=int, default=50,
+                           help="Fetch batch size, 0 is sequential")
+    argparser.add_argument("-c", type=int, default=8,
+                           help="Upload concurrency")
+    argparser.add_argument("--port", type=int, default=5598)
+    argparser.add_argument("-o", type=str, default=None,
+                           help="Write the JSON here instead of stdout")
+    args = argparser.parse_args()
+    logging.disable(logging.INFO)
+
+    if args.server == "gunicorn" and not gunicorn_available():
+        print("ERROR: gunicorn isn't installed")
+        sys.exit(1)
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.o is None:
+        print(output)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.o)), exist_ok=True)
+        with open(args.o, "w") as f:
+            f.write(output + "\n")
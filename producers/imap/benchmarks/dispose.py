@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Time to archive every message of a large folder one message at a time
+(COPY, STORE and a full EXPUNGE each) against one bulk UID MOVE, and bulk
+COPY with UID EXPUNGE for servers without MOVE.
+"""
+import sys
+sys.path.append("..")
+sys.path.append("../tests")
+
+import argparse
+import logging
+import time
+
+import imap_handler
+from fake_imap import FakeImapServer, MailStore, make_message
+
+NO_MOVE = ("IMAP4rev1", "UIDPLUS")
+LEGACY = ("IMAP4rev1",)
+
+
+def fill_store(count: int) -> MailStore:
+    store = MailStore()
+    raw = make_message("shop groceries", [])
+    for i in range(count):
+        store.append("receipts", raw)
+    return store
+
+def run(count: int, capabilities: tuple, bulk: bool) -> float:
+    store = fill_store(count)
+    with FakeImapServer(store, capabilities) as server:
+        host, port = server.address
+        with imap_handler.ImapHandler(login_name="receipt",
+                                      password="abc123",
+                                      server_address=host,
+                                      port=port,
+                                      use_ssl=False,
+                                      folder="receipts") as handler:
+            uids = handler.search_uids()
+            start = time.perf_counter()
+            if bulk:
+                handler.move_messages(uids, imap_handler.ARCHIVED_FOLDER)
+            else:
+                for uid in uids:
+                    handler.move_message(str(uid),
+                                         imap_handler.ARCHIVED_FOLDER)
+            elapsed = time.perf_counter() - start
+    assert len(store.uids(imap_handler.ARCHIVED_FOLDER)) == count
+    assert len(store.uids("receipts")) == 0
+    return elapsed
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=10000, help="Messages")
+    argparser.add_argument("--skip-single", action="store_true",
+                           help="Skip the slow per message run")
+    args = argparser.parse_args()
+    logging.disable(logging.INFO)
+
+    results = []
+    if not args.skip_single:
+        results.append(("per message", run(args.n, LEGACY, False)))
+    results.append(("bulk COPY+UID EXPUNGE", run(args.n, NO_MOVE, True)))
+    results.append(("bulk UID MOVE", run(args.n, NO_MOVE + ("MOVE",), True)))
+    for name, elapsed in results:
+        print(f"{name:22} {elapsed:8.3f}s {args.n / elapsed:10.1f} messages/sec")
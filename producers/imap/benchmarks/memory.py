@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Peak Python memory (tracemalloc) of extracting the images from large
+multipart messages by fetching whole messages against fetching only the
+image parts. The fake IMAP server runs in a child process so that only the
+producer's allocations are counted.
+"""
+import sys
+sys.path.append("..")
+sys.path.append("../tests")
+
+import argparse
+import email
+import logging
+import multiprocessing
+import os
+import time
+import tracemalloc
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+
+import imap_handler
+from fake_imap import FakeImapServer, MailStore, make_message
+
+
+def make_large_message(i: int, size: int) -> bytes:
+    """
+    A receipt image, an HTML body and a PDF making up the rest of size.
+    """
+    image_size = 512 * 1024
+    msg = email.message_from_bytes(
+            make_message(f"shop_{i} groceries",
+                         [(f"receipt_{i}.png", os.urandom(image_size))]))
+    msg.attach(MIMEText("<p>receipt</p>" * 10000, "html"))
+    pdf_size = max(0, int(size / 1.37) - image_size - 140000)
+    msg.attach(MIMEApplication(os.urandom(pdf_size), "pdf"))
+    return msg.as_bytes()
+
+def serve(count: int, size: int, address, stop) -> None:
+    store = MailStore()
+    for i in range(count):
+        store.append("receipts", make_large_message(i, size))
+    for msg in store.folder("receipts").messages:
+        msg.mime()
+    with FakeImapServer(store) as server:
+        address.put(server.address)
+        stop.wait()
+
+def run(address: tuple, fetch_parts: bool, batch_size: int) -> tuple:
+    host, port = address
+    tracemalloc.start()
+    start = time.perf_counter()
+    with imap_handler.ImapHandler(login_name="receipt",
+                                  password="abc123",
+                                  server_address=host,
+                                  port=port,
+                                  use_ssl=False,
+                                  folder="receipts",
+                                  fetch_parts=fetch_parts) as handler:
+        images = 0
+        for msg in handler.yield_messages_batched(batch_size):
+            images += 1
+            if fetch_parts:
+                msg["payload"].close()
+            del msg
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return images, peak, elapsed
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=5, help="Messages")
+    argparser.add_argument("-s", type=int, default=20,
+                           help="Message size in MB")
+    argparser.add_argument("-b", type=int, default=1, help="Fetch batch size")
+    args = argparser.parse_args()
+    logging.disable(logging.INFO)
+
+    address = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve,
+                                     args=(args.n, args.s * 1024 * 1024,
+                                           address, stop))
+    server.start()
+    try:
+        server_address = address.get()
+        for name, fetch_parts in (("whole messages", False),
+                                  ("image parts", True)):
+            images, peak, elapsed = run(server_address, fetch_parts, args.b)
+            print(f"{name:15} {images} images, peak {peak / 2**20:7.1f} MB, "
+                  + f"{elapsed:.2f}s")
+    finally:
+        stop.set()
+        server.join()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Messages/sec of the sequential producer loop against the batched fetch
+with concurrent uploads, using the fake IMAP server and a fake API with
+a configurable response latency.
+"""
+import sys
+sys.path.append("..")
+sys.path.append("../tests")
+
+import argparse
+import logging
+import time
+
+import imap_handler
+from fake_api import FakeApi
+from fake_imap import FakeImapServer, MailStore, make_message
+
+
+def fill_store(count: int) -> MailStore:
+    store = MailStore()
+    for i in range(count):
+        image = (f"receipt_{i}.png", f"receipt {i} ".encode() * 2000)
+        store.append("receipts", make_message(f"shop_{i % 30} groceries",
+                                              [image]))
+    return store
+
+def run(count: int, latency: float, batch_size: int,
+        concurrency: int) -> float:
+    store = fill_store(count)
+    with FakeImapServer(store) as server, FakeApi(latency=latency) as api:
+        host, port = server.address
+        with imap_handler.ImapHandler(login_name="receipt",
+                                      password="abc123",
+                                      server_address=host,
+                                      port=port,
+                                      use_ssl=False,
+                                      folder="receipts") as handler:
+            start = time.perf_counter()
+            if batch_size > 0:
+                with imap_handler.Uploader(api.url, concurrency) as uploader:
+                    imap_handler.process_batched(handler, uploader, batch_size)
+            else:
+                imap_handler.process_messages(handler, api.url)
+            elapsed = time.perf_counter() - start
+        assert len(api.stored) == count, len(api.stored)
+    return count / elapsed
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-n", type=int, default=500, help="Messages")
+    argparser.add_argument("-l", type=float, default=0.02,
+                           help="API latency in seconds")
+    argparser.add_argument("-b", type=int, default=50, help="Fetch batch size")
+    argparser.add_argument("-c", type=int, default=8,
+                           help="Upload concurrency")
+    args = argparser.parse_args()
+    logging.disable(logging.INFO)
+
+    sequential = run(args.n, args.l, 0, 1)
+    batched = run(args.n, args.l, args.b, args.c)
+    print(f"sequential: {sequential:8.1f} messages/sec")
+    print(f"batched:    {batched:8.1f} messages/sec "
+          + f"(batch size {args.b}, {args.c} uploaders)")
+    print(f"speedup: {batched / sequential:.1f}x")
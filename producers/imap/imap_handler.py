@@ -2,17 +2,32 @@
 
 import configparser
 import email
+import email.header
+import email.message
 import hashlib
 import imaplib
 import logging
 import os
 import pytz
 import requests
+import select
+import signal
+import ssl
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dateutil.parser
+from requests.adapters import HTTPAdapter
 from typing import Generator
 
+import metrics
+import mimeparts
+from spool import Spool, SpoolUploader
+from syncstate import Checkpoint, SyncState
+from watcher import Watcher
+
 
 received_tz = pytz.timezone("CET")
 local_tz = pytz.timezone("Europe/Helsinki")
@@ -20,10 +35,86 @@ local_tz = pytz.timezone("Europe/Helsinki")
 class CredsException(): pass
 
 import re
-pattern_uid = re.compile('\d+ \(UID (?P<uid>\d+)\)')
-def parse_uid(data):
-    match = pattern_uid.match(data)
-    return match.group('uid')
+pattern_fetch_uid = re.compile(rb'UID (?P<uid>\d+)')
+def parse_fetch_response(data: list) -> list:
+    """
+    Parse the (UID, literal) pairs from a FETCH response where one literal
+    was requested per message. The UID may come before or after the literal.
+    """
+    messages = []
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            match = pattern_fetch_uid.search(item[0])
+            pending = [match.group('uid').decode() if match else None, item[1]]
+            messages.append(pending)
+        elif isinstance(item, bytes) and pending is not None \
+                and pending[0] is None:
+            match = pattern_fetch_uid.search(item)
+            if match:
+                pending[0] = match.group('uid').decode()
+    return [(uid, literal) for uid, literal in messages if uid is not None]
+
+def compress_uids(uids: list, max_length: int=1000) -> list:
+    """
+    Compress UIDs into IMAP sequence sets like "1:3,7,9:12". Sets are split
+    at max_length characters to keep command lines short.
+    """
+    uids = sorted(set(int(i) for i in uids))
+    ranges = []
+    for uid in uids:
+        if len(ranges) > 0 and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    sets = []
+    current = []
+    length = 0
+    for first, last in ranges:
+        item = str(first) if first == last else f"{first}:{last}"
+        if len(current) > 0 and length + len(item) + 1 > max_length:
+            sets.append(",".join(current))
+            current = []
+            length = 0
+        current.append(item)
+        length += len(item) + 1
+    if len(current) > 0:
+        sets.append(",".join(current))
+    return sets
+
+def parse_headers(msg: email.message.Message) -> tuple:
+    """
+    The tags from the subject and the arrival time of a message.
+    """
+    subject = email.header.decode_header(msg["Subject"])
+    from_field = msg["From"]
+    parsed_date = dateutil.parser.parse(msg["Date"])
+    arrival_time = parsed_date.replace(tzinfo=received_tz) \
+                              .astimezone(tz=local_tz)
+    cleaned_subj = filter(lambda x: x is not None, subject[0])
+    cleaned_subj = " ".join(cleaned_subj).rstrip("\n")
+    # cleaned_subj will be sent as tags, hence mark sender (from)
+    # XXX cleaned_subj.append(f"from_
+    return cleaned_subj, arrival_time
+
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)]"
+
+# Written to the textfile of the [Metrics] section when enabled
+registry = metrics.Registry()
+stage_seconds = registry.histogram(
+        "imap_handler_stage_seconds",
+        "Time spent fetching, parsing, decoding and uploading messages",
+        "stage")
+uploads_total = registry.counter(
+        "imap_handler_uploads_total", "Attachments by upload result",
+        "result")
+
+def stage(name: str):
+    """
+    Context manager timing a stage of processing a message.
+    """
+    return stage_seconds.labels(name).time()
 
 class ImapHandler(object):
     def __init__(self, **kwargs):
@@ -33,94 +124,627 @@ class ImapHandler(object):
         :param password (str): IMAP password
         :param server_address (str): IMAP server address
         :parem folder (str): IMAP folder to fetch messages
+        :param port (int): IMAP server port, optional
+        :param use_ssl (bool): Connect with TLS, defaults to True
+        :param fetch_parts (bool): Fetch only the image parts of messages
+                                   in batched mode, defaults to False
+        :param part_chunk_size (int): Bytes fetched per command when
+                                      fetching parts
         '''
         self.login_name = kwargs['login_name']
         self.password = kwargs['password']
         self.server_address = kwargs['server_address']
         self.folder = kwargs['folder']
-        self.imap = imaplib.IMAP4_SSL(self.server_address)
+        self.port = kwargs.get('port')
+        self.use_ssl = kwargs.get('use_ssl', True)
+        self.fetch_parts = kwargs.get('fetch_parts', False)
+        self.part_chunk_size = kwargs.get('part_chunk_size', 1024 * 1024)
+        self.selected = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self.imap = self.connect()
+
+    def connect(self) -> imaplib.IMAP4:
+        if self.use_ssl:
+            return imaplib.IMAP4_SSL(self.server_address,
+                                     self.port or imaplib.IMAP4_SSL_PORT)
+        return imaplib.IMAP4(self.server_address,
+                             self.port or imaplib.IMAP4_PORT)
 
     def __enter__(self):
         self.imap.login(self.login_name, self.password)
         return self
 
     def __exit__(self, type, value, traceback):
-        self.imap.close()
+        if self.imap.state == 'SELECTED':
+            self.imap.close()
         self.imap.logout()
 
+    @property
+    def sync_key(self) -> str:
+        return f"{self.login_name}@{self.server_address}/{self.folder}"
+
+    def select_folder(self, readonly: bool=False, force: bool=False) -> None:
+        """
+        Select the folder unless it's already selected and record its
+        UIDVALIDITY and UIDNEXT.
+        """
+        if not force and self.selected == readonly:
+            return
+        status, data = self.imap.select(mailbox=self.folder, readonly=readonly)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"Selecting {self.folder} failed: {data}")
+        self.selected = readonly
+        resp, uidvalidity = self.imap.response('UIDVALIDITY')
+        if uidvalidity and uidvalidity[0] is not None:
+            self.uidvalidity = int(uidvalidity[-1])
+        resp, uidnext = self.imap.response('UIDNEXT')
+        if uidnext and uidnext[0] is not None:
+            self.uidnext = int(uidnext[-1])
+
+    @property
+    def capabilities(self) -> tuple:
+        return self.imap.capabilities
+
+    def __data_pending(self, timeout: float) -> bool:
+        """
+        Wait up to timeout for the server to send something. imaplib reads
+        through a buffered file, so check what's already buffered before
+        waiting on the socket.
+        """
+        sock = self.imap.sock
+        if isinstance(sock, ssl.SSLSocket) and sock.pending() > 0:
+            return True
+        old_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            buffered = self.imap.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            buffered = b""
+        finally:
+            sock.settimeout(old_timeout)
+        if len(buffered) > 0:
+            return True
+        readable, _, _ = select.select([sock], [], [], timeout)
+        return len(readable) > 0
+
+    def idle(self, timeout: float, stop: threading.Event=None) -> list:
+        """
+        Wait in IDLE until the server reports a change, timeout passes or
+        stop is set. Returns the untagged responses received, e.g.
+        [b"3 EXISTS"]. imaplib has no IDLE, so the command is driven by
+        hand on the imaplib connection.
+        """
+        self.select_folder()
+        tag = self.imap._new_tag()
+        self.imap.send(tag + b" IDLE\r\n")
+        try:
+            responses = []
+            line = self.imap.readline()
+            # Changes the server hadn't reported yet may precede the
+            # continuation
+            while line.startswith(b"* "):
+                responses.append(line[2:].strip())
+                line = self.imap.readline()
+            if not line.startswith(b"+"):
+                raise imaplib.IMAP4.error(f"IDLE failed: {line.strip()}")
+            deadline = time.monotonic() + timeout
+            while len(responses) == 0 and not (stop and stop.is_set()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self.__data_pending(min(remaining, 0.5)):
+                    line = self.imap.readline()
+                    if not line:
+                        raise imaplib.IMAP4.abort("Connection closed in IDLE")
+                    responses.append(line[2:].strip())
+            self.imap.send(b"DONE\r\n")
+            while True:
+                line = self.imap.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed in IDLE")
+                if line.startswith(tag):
+                    if line[len(tag):].split()[0] != b"OK":
+                        raise imaplib.IMAP4.error(f"IDLE failed: {line.strip()}")
+                    return responses
+                responses.append(line[2:].strip())
+        finally:
+            self.imap.tagged_commands.pop(tag, None)
+
+    def mail_arrived(self) -> bool:
+        """
+        Whether the server already reported new mail which IDLE and NOOP
+        won't report again. Servers send EXISTS in replies to any command,
+        e.g. to a UID FETCH or UID MOVE while syncing, and imaplib buffers
+        them. Messages from the UIDNEXT of the last SELECT on are new.
+        """
+        if self.uidnext is None:
+            return False
+        while self.imap.response('EXISTS')[1][0] is not None:
+            if len(self.search_uids(self.uidnext - 1)) > 0:
+                return True
+        return False
+
+    def poll(self) -> list:
+        """
+        NOOP for servers without IDLE. Returns the EXISTS counts reported
+        since the last call.
+        """
+        self.select_folder()
+        self.imap.noop()
+        status, data = self.imap.response('EXISTS')
+        return [i for i in data if i is not None]
+
     def get_count(self) -> int:
-        self.imap.select(self.folder)
+        self.select_folder()
         status, data = self.imap.search(None, 'ALL')
         return sum(1 for num in data[0].split())
 
     def delete_message(self, msg_id, subject) -> None:
-        self.imap.select(self.folder)
+        self.select_folder()
         logging.info(f"Deleting message ID {msg_id} with subject {subject}")
         self.imap.store(msg_id, '+FLAGS', r'\Deleted')
         self.imap.expunge()
 
+    def delete_messages(self, msg_uids: list) -> None:
+        """
+        Delete messages by UID with one STORE and one expunge.
+        """
+        if len(msg_uids) == 0:
+            return
+        self.select_folder()
+        logging.info(f"Deleting {len(msg_uids)} messages")
+        for uid_set in compress_uids(msg_uids):
+            self.imap.uid('STORE', uid_set, '+FLAGS.SILENT', r'(\Deleted)')
+        self.__expunge(msg_uids)
+
     def move_message(self, msg_id: str, dest_folder: str) -> None:
-        result = self.imap.uid('COPY', msg_id, dest_folder)
+        self.move_messages([msg_id], dest_folder)
+
+    def move_messages(self, msg_uids: list, dest_folder: str) -> bool:
+        """
+        Move messages by UID with UID MOVE if the server supports it and
+        otherwise with COPY, STORE and one expunge. Returns False if the
+        copy failed and the messages were left in place.
+        """
+        if len(msg_uids) == 0:
+            return True
+        self.select_folder()
+        uid_sets = compress_uids(msg_uids)
+        if "MOVE" in self.capabilities:
+            for uid_set in uid_sets:
+                status, data = self.imap.uid('MOVE', uid_set, dest_folder)
+                if status != 'OK':
+                    logging.error(f"Moving {uid_set} to {dest_folder} failed: "
+                                  + f"{data}")
+                    return False
+            return True
+
+        for uid_set in uid_sets:
+            status, data = self.imap.uid('COPY', uid_set, dest_folder)
+            if status != 'OK':
+                logging.error(f"Copying {uid_set} to {dest_folder} failed: "
+                              + f"{data}")
+                return False
+        for uid_set in uid_sets:
+            self.imap.uid('STORE', uid_set, '+FLAGS.SILENT', r'(\Deleted)')
+        self.__expunge(msg_uids)
+        return True
 
-        if result[0] == 'OK':
-            mov, data = self.imap.uid('STORE', msg_id, '+FLAGS', '(\Deleted)')
+    def __expunge(self, msg_uids: list) -> None:
+        """
+        Expunge only the given messages with UIDPLUS. Plain EXPUNGE also
+        removes other messages flagged as deleted.
+        """
+        if "UIDPLUS" in self.capabilities:
+            for uid_set in compress_uids(msg_uids):
+                self.imap.uid('EXPUNGE', uid_set)
+        else:
             self.imap.expunge()
 
     def sha256_checksum(self, data: str) -> str:
         return hashlib.sha256(data).hexdigest()
 
-    def yield_messages(self) -> Generator[dict, None, None]:
-        self.imap.select(mailbox=self.folder, readonly=False)
-        all_status, all_data = self.imap.search(None, 'ALL')
-        logging.info(f"Total messages available: {len(all_data)}")
-        for num in reversed(all_data[0].split()):
-            status, data = self.imap.fetch(num, '(RFC822)')
-            msg = email.message_from_bytes(data[0][1])
-            subject = email.header.decode_header(msg["Subject"])
-            from_field = msg["From"]
-            parsed_date = dateutil.parser.parse(msg["Date"])
-            arrival_time = parsed_date.replace(tzinfo=received_tz) \
-                                      .astimezone(tz=local_tz)
-            cleaned_subj = filter(lambda x: x is not None, subject[0])
-            cleaned_subj = " ".join(cleaned_subj).rstrip("\n")
-            # cleaned_subj will be sent as tags, hence mark sender (from)
-            # XXX cleaned_subj.append(f"from_
-
-            msgid_resp, msg_id = self.imap.fetch(num, "(UID)")
-            msg_uid = parse_uid(msg_id[0].decode())
-
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                if not content_type.startswith("image/"):
-                    continue
-
-                orig_fname = part.get_filename()
+    def parse_message(self, raw: bytes, msg_uid: str) -> Generator[dict, None, None]:
+        """
+        Yield the image attachments of a RFC822 message. A message which
+        can't be parsed is logged and skipped, and stays in the folder.
+        """
+        try:
+            attachments = list(self.__parse_attachments(raw, msg_uid))
+        except Exception as e:
+            logging.error(f"Skipping UID {msg_uid}, parsing it failed: {e}")
+            return
+        yield from attachments
 
+    def __parse_attachments(self, raw: bytes,
+                            msg_uid: str) -> Generator[dict, None, None]:
+        with stage("parse"):
+            msg = email.message_from_bytes(raw)
+            cleaned_subj, arrival_time = parse_headers(msg)
+
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if not content_type.startswith("image/"):
+                continue
+
+            orig_fname = part.get_filename() or ""
+
+            with stage("decode"):
                 msg_payload = part.get_payload(decode=True)
                 fout_name = self.sha256_checksum(msg_payload)
-                fout_ext = "." + orig_fname.rsplit(".", 1)[1].lower()
+            fout_ext = "." + (orig_fname.rsplit(".", 1)[1].lower()
+                              if "." in orig_fname
+                              else part.get_content_subtype())
+
+            logmsg = f"Retrieving UID {msg_uid} {fout_name}{fout_ext} " \
+                     + f"[{len(msg_payload)} bytes] with subject: " \
+                     + f"{cleaned_subj}"
+            logging.info(logmsg)
+
+            yield {"fname": fout_name + fout_ext,
+                   "sha256": fout_name,
+                   "msg_uid": msg_uid,
+                   "arrival_time": arrival_time,
+                   "tags": cleaned_subj,
+                   "payload": msg_payload}
+
+    def yield_messages(self, since_uid: int=0,
+                       on_fetch=None) -> Generator[dict, None, None]:
+        """
+        Fetch the messages after since_uid one at a time in UID order.
+        on_fetch is called with the UID of every fetched message before
+        its attachments are yielded.
+        """
+        self.select_folder(force=True)
+        uids = self.search_uids(since_uid)
+        logging.info(f"Messages available after UID {since_uid}: {len(uids)}")
+        for uid in uids:
+            with stage("fetch"):
+                status, data = self.imap.uid('FETCH', str(uid), '(UID RFC822)')
+            if status != 'OK':
+                logging.error(f"Fetching UID {uid} failed: {data}")
+                continue
+            for msg_uid, raw in parse_fetch_response(data):
+                if on_fetch is not None:
+                    on_fetch(msg_uid)
+                yield from self.parse_message(raw, msg_uid)
+
+    def search_uids(self, since_uid: int=0) -> list:
+        """
+        UIDs above since_uid in ascending order.
+        """
+        self.select_folder()
+        if since_uid > 0:
+            status, data = self.imap.uid('SEARCH', None, 'UID',
+                                         f"{since_uid + 1}:*")
+        else:
+            status, data = self.imap.uid('SEARCH', None, 'ALL')
+        # n:* always matches the last message, even if its UID is below n
+        uids = [int(i) for i in data[0].split() if int(i) > since_uid]
+        uids.sort()
+        return uids
+
+    def yield_messages_batched(self, batch_size: int=50, since_uid: int=0,
+                               on_fetch=None) -> Generator[dict, None, None]:
+        """
+        Like yield_messages, but fetches batch_size messages and their UIDs
+        with a single UID FETCH, in UID order starting after since_uid.
+        BODY.PEEK doesn't mark the messages as seen. on_fetch is called
+        with the UID of every fetched message, also of the ones without
+        attachments, before its attachments are yielded.
 
-                logmsg = f"Retrieving ID {int(num)} {fout_name}{fout_ext} " \
-                         + f"[{len(msg_payload)} bytes] with subject: " \
-                         + f"{cleaned_subj}"
+        With fetch_parts only the headers and BODYSTRUCTURE are fetched in
+        batches, followed by the image parts. The payloads are then file
+        objects instead of bytes.
+        """
+        self.select_folder(force=True)
+        uids = self.search_uids(since_uid)
+        logging.info(f"Messages available after UID {since_uid}: {len(uids)}")
+        for i in range(0, len(uids), batch_size):
+            uid_set = ",".join(str(u) for u in uids[i:i + batch_size])
+            if self.fetch_parts:
+                yield from self.__yield_image_parts(uid_set, on_fetch)
+                continue
+            with stage("fetch"):
+                status, data = self.imap.uid('FETCH', uid_set,
+                                             '(UID BODY.PEEK[])')
+            if status != 'OK':
+                logging.error(f"Fetching UIDs {uid_set} failed: {data}")
+                continue
+            for msg_uid, raw in parse_fetch_response(data):
+                if on_fetch is not None:
+                    on_fetch(msg_uid)
+                yield from self.parse_message(raw, msg_uid)
+
+    def __yield_image_parts(self, uid_set: str,
+                            on_fetch=None) -> Generator[dict, None, None]:
+        with stage("fetch"):
+            status, data = self.imap.uid('FETCH', uid_set,
+                                         f'(UID BODYSTRUCTURE {HEADER_FIELDS})')
+        if status != 'OK':
+            logging.error(f"Fetching UIDs {uid_set} failed: {data}")
+            return
+        for fields in mimeparts.parse_fetch(data):
+            msg_uid = fields["UID"].decode()
+            if on_fetch is not None:
+                on_fetch(msg_uid)
+            header = next(v for k, v in fields.items()
+                          if k.startswith("BODY[HEADER"))
+            try:
+                with stage("parse"):
+                    cleaned_subj, arrival_time = parse_headers(
+                            email.message_from_bytes(header))
+            except Exception as e:
+                logging.error(f"Skipping UID {msg_uid}, parsing it failed: {e}")
+                continue
+            for part in mimeparts.image_parts(fields["BODYSTRUCTURE"]):
+                with stage("fetch_part"):
+                    payload, sha256, size = self.fetch_part(msg_uid, part)
+                filename = part["filename"] or ""
+                fout_ext = "." + (filename.rsplit(".", 1)[1].lower()
+                                  if "." in filename else part["subtype"])
+
+                logmsg = f"Retrieving UID {msg_uid} {sha256}{fout_ext} " \
+                         + f"[{size} bytes] with subject: {cleaned_subj}"
                 logging.info(logmsg)
 
-                yield {"fname": fout_name + fout_ext,
+                yield {"fname": sha256 + fout_ext,
+                       "sha256": sha256,
                        "msg_uid": msg_uid,
                        "arrival_time": arrival_time,
                        "tags": cleaned_subj,
-                       "payload": msg_payload}
+                       "payload": payload}
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print(f"ERROR: {sys.argv[0]}: Missing configuration filename. Must be absolute path")
-        sys.exit(1)
+    def fetch_part(self, msg_uid: str, part: dict) -> tuple:
+        """
+        Fetch a body part part_chunk_size bytes at a time, decoding it into
+        a temporary file while hashing. Returns the file, the SHA-256 and
+        the decoded size.
+        """
+        writer = mimeparts.HashingWriter()
+        decoder = mimeparts.Decoder(part["encoding"], writer)
+        section = part["section"]
+        offset = 0
+        while True:
+            status, data = self.imap.uid(
+                    'FETCH', msg_uid,
+                    f"(BODY.PEEK[{section}]<{offset}.{self.part_chunk_size}>)")
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"Fetching part {section} of UID "
+                                          + f"{msg_uid} failed: {data}")
+            fields = mimeparts.parse_fetch(data)
+            chunk = fields[0].get(f"BODY[{section}]<{offset}>") \
+                if len(fields) > 0 else None
+            if chunk is None:
+                break
+            decoder.feed(chunk)
+            offset += len(chunk)
+            if len(chunk) < self.part_chunk_size or offset >= part["size"]:
+                break
+        decoder.close()
+        return writer.finish(), writer.hexdigest(), writer.size
+
+ARCHIVED_FOLDER = "receipts/archived"
+ERRORS_FOLDER = "receipts/errors"
+
+def content_exists(api_host: str, sha256: str, session=requests) -> bool:
+    """
+    Ask the API whether content with the given hash is already stored.
+    """
+    try:
+        ret = session.head(f"{api_host.rstrip('/')}/exists/{sha256}")
+    except requests.RequestException as e:
+        logging.warning(f"Checking {sha256} failed: {e}")
+        return False
+    return ret.status_code == 200
 
-    os.chdir(os.path.dirname(sys.argv[1]))
+def upload(api_host: str, msg: dict, session=requests) -> bool:
+    """
+    Send an attachment to the API. Returns True if it's stored, either now
+    or already before.
+    """
+    with stage("exists"):
+        exists = content_exists(api_host, msg['sha256'], session)
+    if exists:
+        logging.info(f"msgid_{int(msg['msg_uid'])}: {msg['fname']} already stored")
+        uploads_total.labels("exists").inc()
+        return True
+
+    logmsg = f"msgid_{int(msg['msg_uid'])}: Sending {msg['fname']} with tags '{msg['tags']}' to {api_host}"
+    logging.info(logmsg)
+    try:
+        with stage("upload"):
+            ret = session.post(api_host,
+                               files={'tags': (None, msg['tags']),
+                                      'sha256': (None, msg['sha256']),
+                                      'file': (msg['fname'], msg['payload'])})
+    except requests.RequestException as e:
+        logging.info(f"msgid_{int(msg['msg_uid'])}: {e}")
+        uploads_total.labels("error").inc()
+        return False
+    if ret.ok or ret.status_code == 409:
+        uploads_total.labels("stored" if ret.ok else "exists").inc()
+        return True
+    logging.info(f"msgid_{int(msg['msg_uid'])}: [{ret.status_code}] {ret.content}")
+    uploads_total.labels("failed").inc()
+    return False
+
+class Uploader(object):
+    """
+    Uploads attachments from a bounded pool of threads which share one
+    keep-alive requests.Session.
+    """
+    def __init__(self, api_host: str, concurrency: int=4):
+        self.api_host = api_host
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # Bounds the attachments held in memory while waiting for upload
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def submit(self, msg: dict):
+        """
+        Queue an upload, blocking while the queue is full. Returns a
+        future of upload().
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(upload, self.api_host, msg,
+                                          self.session)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.__done(msg))
+        return future
+
+    def __done(self, msg: dict) -> None:
+        # Payloads of fetched parts are temporary files
+        if hasattr(msg["payload"], "close"):
+            msg["payload"].close()
+        self.slots.release()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+class Disposer(object):
+    """
+    Collects the processed messages and moves them to the archived or
+    errors folder in bulk, so a run costs one move and one expunge per
+    destination instead of one per message.
+    """
+    def __init__(self, imap_handler: ImapHandler):
+        self.imap_handler = imap_handler
+        self.results = {}
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def add(self, msg_uid: str, ok: bool) -> None:
+        """
+        Record an attachment's result. A message goes to errors if any of
+        its attachments failed.
+        """
+        self.results[msg_uid] = self.results.get(msg_uid, True) and ok
+
+    def flush(self) -> list:
+        """
+        Move the collected messages. Returns the UIDs which were moved.
+        """
+        moved = []
+        for dest, ok in ((ARCHIVED_FOLDER, True), (ERRORS_FOLDER, False)):
+            uids = [uid for uid, result in self.results.items()
+                    if result == ok]
+            if len(uids) == 0:
+                continue
+            logging.info(f"Moving {len(uids)} messages to {dest}")
+            if self.imap_handler.move_messages(uids, dest):
+                moved.extend(uids)
+        self.results = {}
+        return moved
+
+def sync_start(imap_handler: ImapHandler, sync_state: SyncState) -> int:
+    """
+    The UID after which the folder is fetched, 0 without sync_state.
+    """
+    if sync_state is None:
+        return 0
+    imap_handler.select_folder(force=True)
+    since_uid = sync_state.since_uid(imap_handler.sync_key,
+                                     imap_handler.uidvalidity)
+    if since_uid == 0:
+        logging.info(f"Full sync of {imap_handler.sync_key}, "
+                     + f"UIDVALIDITY {imap_handler.uidvalidity}")
+    return since_uid
+
+def sync_flush(imap_handler: ImapHandler, disposer: Disposer,
+               checkpoint: Checkpoint, sync_state: SyncState) -> None:
+    """
+    Move the finished messages and advance the checkpoint past them.
+    """
+    for msg_uid in disposer.flush():
+        checkpoint.close(msg_uid)
+    if checkpoint.advance() and sync_state is not None:
+        sync_state.update(imap_handler.sync_key, imap_handler.uidvalidity,
+                          checkpoint.last_uid)
+
+def process_messages(imap_handler: ImapHandler, api_host: str,
+                     sync_state: SyncState=None) -> None:
+    """
+    Fetch and upload messages one at a time.
+
+    With sync_state only the messages after the last processed UID are
+    fetched, as in process_batched.
+    """
+    checkpoint = Checkpoint(sync_start(imap_handler, sync_state))
+    disposer = Disposer(imap_handler)
+    for msg in imap_handler.yield_messages(checkpoint.last_uid,
+                                           checkpoint.fetched):
+        checkpoint.open(msg["msg_uid"])
+        disposer.add(msg["msg_uid"], upload(api_host, msg))
+    sync_flush(imap_handler, disposer, checkpoint, sync_state)
+
+def process_batched(imap_handler: ImapHandler, uploader: Uploader,
+                    batch_size: int, sync_state: SyncState=None) -> None:
+    """
+    Fetch messages in batches and upload them concurrently. A message is
+    archived once all of its attachments are stored and moved to errors
+    if any of them failed. Finished messages are moved batch_size at a
+    time. A message whose attachment couldn't be handed over at all, e.g.
+    when the spool write failed, is left in the inbox. IMAP commands are
+    only issued from this thread.
+
+    With sync_state only the messages after the last processed UID are
+    fetched, and the checkpoint is advanced as messages are moved.
+    """
+    pending = {}
+    since_uid = sync_start(imap_handler, sync_state)
+    checkpoint = Checkpoint(since_uid)
+    disposer = Disposer(imap_handler)
+
+    def finish(msg_uid):
+        futures = pending.pop(msg_uid)
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if len(errors) > 0:
+            # Nothing was decided about the message, so it's left in the
+            # inbox and the checkpoint stays open to retry it next run
+            logging.error(f"Leaving message {msg_uid} in place: {errors[0]}")
+            return
+        disposer.add(msg_uid, all(f.result() for f in futures))
+
+    def flush():
+        sync_flush(imap_handler, disposer, checkpoint, sync_state)
+
+    for msg in imap_handler.yield_messages_batched(batch_size, since_uid,
+                                                   checkpoint.fetched):
+        checkpoint.open(msg["msg_uid"])
+        pending.setdefault(msg["msg_uid"], []).append(uploader.submit(msg))
+        done = [uid for uid, futures in pending.items()
+                if uid != msg["msg_uid"] and all(f.done() for f in futures)]
+        for msg_uid in done:
+            finish(msg_uid)
+        if len(disposer) >= batch_size:
+            flush()
+    for msg_uid in list(pending.keys()):
+        finish(msg_uid)
+    flush()
+
+def main(config_file: str) -> None:
+    os.chdir(os.path.dirname(config_file))
 
     must_have_sections = ('IMAP', 'Messages', 'Receipts_api',)
     config = configparser.ConfigParser()
-    config.read(sys.argv[1])
+    config.read(config_file)
 
     if not all(i in config.sections() for i in must_have_sections):
         print("ERROR: {}: Parsing config file failed. Must have sections: {}"
@@ -131,31 +755,100 @@ if __name__ == '__main__':
     password = config['IMAP']['password']
     server_address = config['IMAP']['server_address']
     folder = config['IMAP']['folder']
+    port = config['IMAP'].getint('port')
+    use_ssl = config['IMAP'].getboolean('ssl', True)
+    fetch_batch_size = config['IMAP'].getint('fetch_batch_size', 0)
+    fetch_parts = config['IMAP'].getboolean('fetch_parts', False)
     receipt_api_host = config['Receipts_api']['server_address']
+    upload_concurrency = config['Receipts_api'].getint('upload_concurrency', 4)
+    sync_state_file = config['IMAP'].get('sync_state', 'imap_sync_state.json')
+    daemon = config.has_section('Daemon') \
+        and config['Daemon'].getboolean('enabled', False)
+    use_spool = config.has_section('Spool') \
+        and config['Spool'].getboolean('enabled', False)
+    metrics_file = config['Metrics'].get('textfile', '') \
+        if config.has_section('Metrics') else ''
+    registry.enabled = metrics_file != ''
 
     logging.basicConfig(filename="imap_handler.log",
                 datefmt="%Y-%m-%d %H:%M:%S",
                 format="%(asctime)s.%(msecs)03d: %(levelname)s %(message)s",
                 level=logging.INFO)
 
-    with ImapHandler(login_name=login_name,
-                     password=password,
-                     server_address=server_address,
-                     folder=folder) as imap_handler:
-        for msg in imap_handler.yield_messages():
-            logmsg = f"msgid_{int(msg['msg_uid'])}: Sending {msg['fname']} with tags '{msg['tags']}' to {receipt_api_host}"
-            logging.info(logmsg)
-            ret = requests.post(receipt_api_host,
-                                files={'tags': (None, msg['tags']),
-                                       'file': (msg['fname'], msg['payload'])})
-            if ret.ok:
-                logging.info(f"msgid_{int(msg['msg_uid'])}: Moving message to receipts/archived")
-                imap_handler.move_message(msg["msg_uid"], "receipts/archived")
-                logging.info(f"msgid_{int(msg['msg_uid'])}: Message archived")
-                logging.info(f"msgid_{int(msg['msg_uid'])}: Completed")
+    def connect():
+        return ImapHandler(login_name=login_name,
+                           password=password,
+                           server_address=server_address,
+                           folder=folder,
+                           port=port,
+                           use_ssl=use_ssl,
+                           fetch_parts=fetch_parts)
+
+    sync_state = SyncState(sync_state_file) if sync_state_file else None
+    spool = None
+    if use_spool:
+        spool_config = config['Spool']
+        spool = Spool(spool_config.get('path', 'spool'))
+    with Uploader(receipt_api_host, upload_concurrency) as uploader:
+        spool_uploader = None
+        if spool is not None:
+            spool_uploader = SpoolUploader(
+                    spool, uploader,
+                    max_attempts=spool_config.getint('max_attempts', 0),
+                    retry_backoff=spool_config.getfloat('retry_backoff', 30.0),
+                    max_backoff=spool_config.getfloat('max_backoff', 3600.0))
+
+        def process(imap_handler):
+            try:
+                process_folder(imap_handler)
+            finally:
+                if registry.enabled:
+                    registry.write_textfile(metrics_file)
+
+        def process_folder(imap_handler):
+            if spool is not None:
+                # Messages are archived as soon as they're spooled
+                process_batched(imap_handler, spool, fetch_batch_size or 1,
+                                sync_state)
+                spool_uploader.notify()
+            elif fetch_batch_size > 0:
+                process_batched(imap_handler, uploader, fetch_batch_size,
+                                sync_state)
             else:
-                logging.info(f"msgid_{int(msg['msg_uid'])}: [{ret.status_code}] {ret.content}")
-                imap_handler.move_message(msg["msg_uid"], "receipts/errors")
-                logging.info(f"msgid_{int(msg['msg_uid'])}: Message moved to errors")
-                logging.info(f"msgid_{int(msg['msg_uid'])}: Completed")
+                process_messages(imap_handler, receipt_api_host, sync_state)
+
+        if daemon:
+            daemon_config = config['Daemon']
+            watcher = Watcher(connect, process,
+                              heartbeat_file=daemon_config.get(
+                                  'heartbeat_file',
+                                  'imap_handler_heartbeat.json'),
+                              idle_timeout=daemon_config.getfloat(
+                                  'idle_timeout', 300.0),
+                              poll_interval=daemon_config.getfloat(
+                                  'poll_interval', 60.0),
+                              max_backoff=daemon_config.getfloat(
+                                  'max_backoff', 300.0))
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: watcher.stop())
+            if spool_uploader is not None:
+                spool_uploader.start()
+            watcher.run()
+            if spool_uploader is not None:
+                spool_uploader.stop()
+        else:
+            with connect() as imap_handler:
+                process(imap_handler)
+            if spool_uploader is not None:
+                spool_uploader.drain()
+    if spool is not None:
+        spool.close()
+    if registry.enabled:
+        registry.write_textfile(metrics_file)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"ERROR: {sys.argv[0]}: Missing configuration filename. Must be absolute path")
+        sys.exit(1)
 
+    main(sys.argv[1])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Counters and histograms with one label, written for the node_exporter
+textfile collector. The subset of api/metrics.py the producer uses, as
+the two are deployed separately.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+# Seconds, from a fast cache hit to a slow upload
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+                     .replace('"', '\\"')
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Timer(object):
+    """
+    Context manager observing the time spent in it.
+    """
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+null_timer = NullTimer()
+
+
+class Child(object):
+    """
+    A metric's value for one label value.
+    """
+    __slots__ = ("metric", "label")
+
+    def __init__(self, metric, label: str):
+        self.metric = metric
+        self.label = label
+
+    def inc(self, amount: float=1.0) -> None:
+        self.metric.add(self.label, amount)
+
+    def observe(self, value: float) -> None:
+        self.metric.add(self.label, value)
+
+    def time(self):
+        if not self.metric.registry.enabled:
+            return null_timer
+        return Timer(self)
+
+
+class Metric(object):
+    """
+    A counter, or a histogram when buckets are given. A histogram keeps
+    the count per bucket followed by the sum for every label value.
+    """
+    def __init__(self, registry, name: str, documentation: str,
+                 labelname: str, buckets: tuple=None):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelname = labelname
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels(self, label: str) -> Child:
+        return Child(self, label)
+
+    def add(self, label: str, value: float) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            if self.buckets is None:
+                self.values[label] = self.values.get(label, 0.0) + value
+                return
+            counts = self.values.get(label)
+            if counts is None:
+                counts = self.values[label] = [0] * (len(self.buckets) + 1) \
+                                              + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def expose(self) -> list:
+        kind = "counter" if self.buckets is None else "histogram"
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {kind}"]
+        with self.lock:
+            values = sorted((k, v if self.buckets is None else list(v))
+                            for k, v in self.values.items())
+        for label, value in values:
+            labels = f'{self.labelname}="{escape(label)}"'
+            if self.buckets is None:
+                lines.append(f"{self.name}{{{labels}}} {format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), value):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else format_value(bound)
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} '
+                             + str(cumulative))
+            lines.append(f"{self.name}_sum{{{labels}}} "
+                         + format_value(value[-1]))
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Registry(object):
+    """
+    Updates are dropped while the registry isn't enabled, so instrumented
+    code costs little more than a flag check when metrics are off.
+    """
+    def __init__(self, enabled: bool=False):
+        self.enabled = enabled
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str,
+                labelname: str) -> Metric:
+        self.metrics.append(Metric(self, name, documentation, labelname))
+        return self.metrics[-1]
+
+    def histogram(self, name: str, documentation: str, labelname: str,
+                  buckets: tuple=DEFAULT_BUCKETS) -> Metric:
+        self.metrics.append(Metric(self, name, documentation, labelname,
+                                   tuple(buckets)))
+        return self.metrics[-1]
+
+    def expose(self) -> str:
+        lines = []
+        for metric in sorted(self.metrics, key=lambda m: m.name):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Write the metrics for the node_exporter textfile collector. The
+        file is replaced atomically so that it's never read half written.
+        """
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.expose())
+        os.replace(tmp, path)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Helpers for fetching single MIME parts: parsing FETCH responses with
+BODYSTRUCTURE and decoding part bodies incrementally.
+"""
+
+import binascii
+import hashlib
+import re
+import tempfile
+
+token_pat = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"'
+                       rb'|([^\s()\[]+(?:\[[^\]]*\])?(?:<\d+>)?))')
+
+
+def tokenize(data: list) -> list:
+    """
+    Tokens of an imaplib response where literals arrive as
+    (prefix, literal) tuples. Parentheses become "(" and ")", quoted
+    strings and literals bytes and atoms bytes as well, with NIL as None.
+    """
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            tokens.extend(tokenize_text(re.sub(rb'\{\d+\}$', b"", prefix)))
+            tokens.append(literal)
+        elif isinstance(item, bytes):
+            tokens.extend(tokenize_text(item))
+    return tokens
+
+def tokenize_text(text: bytes) -> list:
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = token_pat.match(text, pos)
+        if match is None:
+            raise ValueError(f"Can't parse {text[pos:]!r}")
+        pos = match.end()
+        if match.group(1):
+            tokens.append("(")
+        elif match.group(2):
+            tokens.append(")")
+        elif match.group(3) is not None:
+            tokens.append(re.sub(rb'\\(.)', rb'\1', match.group(3)))
+        else:
+            atom = match.group(4)
+            tokens.append(None if atom.upper() == b"NIL" else atom)
+    return tokens
+
+def parse_lists(tokens: list) -> list:
+    """
+    Nest the tokens into lists by their parentheses.
+    """
+    stack = [[]]
+    for token in tokens:
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            item = stack.pop()
+            stack[-1].append(item)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+def parse_fetch(data: list) -> list:
+    """
+    One dict per message of a FETCH response, e.g. {"UID": b"4",
+    "BODYSTRUCTURE": [...], "BODY[2]": b"..."}. Keys are upper case.
+    """
+    messages = []
+    for fields in parse_lists(tokenize(data)):
+        # Skip the message sequence numbers
+        if not isinstance(fields, list):
+            continue
+        messages.append({fields[i].decode().upper(): fields[i + 1]
+                         for i in range(0, len(fields) - 1, 2)})
+    return messages
+
+def params_dict(params) -> dict:
+    if not isinstance(params, list):
+        return {}
+    return {params[i].decode().lower(): params[i + 1].decode()
+            for i in range(0, len(params) - 1, 2)
+            if params[i] is not None and params[i + 1] is not None}
+
+def image_parts(structure: list, section: str="") -> list:
+    """
+    The image parts of a BODYSTRUCTURE as dicts with the section number to
+    fetch, subtype, encoding, encoded size and filename. Attached messages
+    aren't descended into.
+    """
+    if len(structure) > 0 and isinstance(structure[0], list):
+        # The parts come first, followed by the subtype and extension data
+        parts = []
+        prefix = f"{section}." if section else ""
+        for num, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            parts.extend(image_parts(child, prefix + str(num)))
+        return parts
+
+    if structure[0] is None or structure[0].lower() != b"image":
+        return []
+    params = params_dict(structure[2])
+    filename = params.get("name")
+    if len(structure) > 8 and isinstance(structure[8], list) \
+            and len(structure[8]) > 1:
+        filename = params_dict(structure[8][1]).get("filename", filename)
+    return [{"section": section or "1",
+             "subtype": structure[1].decode().lower(),
+             "encoding": (structure[5] or b"7bit").decode().lower(),
+             "size": int(structure[6]),
+             "filename": filename}]
+
+
+class HashingWriter(object):
+    """
+    Writes to a temporary file, kept in memory up to max_size, while
+    hashing. The file holds the only full copy of the data.
+    """
+    def __init__(self, max_size: int=1024 * 1024):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self.sha256.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+    def finish(self):
+        """
+        The file rewound for reading.
+        """
+        self.file.seek(0)
+        return self.file
+
+class Decoder(object):
+    """
+    Decodes a Content-Transfer-Encoding from chunks split at arbitrary
+    positions and writes the result to out.
+    """
+    def __init__(self, encoding: str, out):
+        self.encoding = encoding
+        self.out = out
+        self.pending = b""
+
+    def feed(self, chunk: bytes) -> None:
+        if self.encoding == "base64":
+            data = self.pending + chunk.translate(None, b" \t\r\n")
+            complete = len(data) - len(data) % 4
+            self.pending = data[complete:]
+            if complete > 0:
+                self.out.write(binascii.a2b_base64(data[:complete]))
+        elif self.encoding == "quoted-printable":
+            # Soft line breaks may span chunks, decode whole lines only
+            data = self.pending + chunk
+            end = data.rfind(b"\n") + 1
+            self.pending = data[end:]
+            if end > 0:
+                self.out.write(binascii.a2b_qp(data[:end]))
+        else:
+            self.out.write(chunk)
+
+    def close(self) -> None:
+        if len(self.pending) == 0:
+            return
+        if self.encoding == "base64":
+            # Tolerate missing padding like email does
+            padded = self.pending + b"=" * (-len(self.pending) % 4)
+            self.out.write(binascii.a2b_base64(padded))
+        else:
+            self.out.write(binascii.a2b_qp(self.pending))
+        self.pending = b""
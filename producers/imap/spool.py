@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+schema_script = """
+CREATE TABLE IF NOT EXISTS item (
+	sha256 TEXT PRIMARY KEY,
+	fname TEXT NOT NULL,
+	tags TEXT NOT NULL,
+	msg_uid TEXT,
+	added REAL NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	next_attempt REAL NOT NULL,
+	last_error TEXT,
+	failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS item_due ON item(failed, next_attempt);
+"""
+
+
+class Spool(object):
+    """
+    Attachments waiting to be uploaded, stored as files named by their
+    content hash with an SQLite index holding the tags and retry state.
+    An attachment is durable once put() returns, so the message can be
+    archived before the API has seen it.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.path, "spool.db"),
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(schema_script)
+        self.__remove_orphans()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM item "
+                                     + "WHERE failed = 0").fetchone()[0]
+
+    def file_path(self, fname: str) -> str:
+        return os.path.join(self.path, fname)
+
+    def put(self, msg: dict) -> bool:
+        """
+        Store an attachment. Returns False if it was already spooled.
+        """
+        path = self.file_path(msg["fname"])
+        with self.lock:
+            exists = self.conn.execute("SELECT 1 FROM item WHERE sha256 = ?",
+                                       (msg["sha256"],)).fetchone()
+        if exists is not None:
+            return False
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            payload = msg["payload"]
+            if hasattr(payload, "read"):
+                shutil.copyfileobj(payload, f)
+            else:
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.__sync_dir()
+
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO item (sha256, fname, tags, "
+                              + "msg_uid, added, next_attempt) "
+                              + "VALUES (?, ?, ?, ?, ?, ?)",
+                              (msg["sha256"], msg["fname"], msg["tags"],
+                               msg["msg_uid"], now, now))
+        return True
+
+    def submit(self, msg: dict) -> Future:
+        """
+        Spool an attachment and return a finished future of True, so the
+        spool can stand in for the Uploader when processing messages. The
+        future raises if the attachment couldn't be stored, and the message
+        is then left in the inbox rather than archived or sent to errors.
+        """
+        future = Future()
+        try:
+            self.put(msg)
+            future.set_result(True)
+        except OSError as e:
+            # Not an upload failure, so the message is neither archived
+            # nor moved to errors
+            logging.error(f"Spool: Storing {msg['fname']} failed: {e}")
+            future.set_exception(e)
+        finally:
+            if hasattr(msg["payload"], "close"):
+                msg["payload"].close()
+        return future
+
+    def due(self, limit: int, now: float, exclude: set=frozenset()) -> list:
+        """
+        Items whose next attempt is due, oldest first.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM item WHERE failed = 0 "
+                                     + "AND next_attempt <= ? "
+                                     + "ORDER BY next_attempt LIMIT ?",
+                                     (now, limit + len(exclude))).fetchall()
+        return [dict(i) for i in rows if i["sha256"] not in exclude][:limit]
+
+    def next_due(self):
+        """
+        When the next item is due, or None if the spool is empty.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT MIN(next_attempt) FROM item "
+                                    + "WHERE failed = 0").fetchone()
+        return row[0]
+
+    def done(self, sha256: str) -> None:
+        with self.lock:
+            rows = self.conn.execute("DELETE FROM item WHERE sha256 = ? "
+                                     + "RETURNING fname", (sha256,)).fetchall()
+        for row in rows:
+            try:
+                os.remove(self.file_path(row["fname"]))
+            except FileNotFoundError:
+                pass
+
+    def retry(self, sha256: str, error: str, next_attempt: float=None) -> None:
+        """
+        Record a failed upload. Without next_attempt the item is given up
+        on, but kept in the spool.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE item SET attempts = attempts + 1, "
+                              + "last_error = ?, next_attempt = ?, failed = ? "
+                              + "WHERE sha256 = ?",
+                              (error, next_attempt or 0,
+                               1 if next_attempt is None else 0, sha256))
+
+    def stats(self) -> dict:
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) - SUM(failed), "
+                                    + "SUM(failed), MIN(added) "
+                                    + "FROM item").fetchone()
+        return {"pending": row[0] or 0,
+                "failed": row[1] or 0,
+                "oldest": row[2]}
+
+    def __sync_dir(self) -> None:
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __remove_orphans(self) -> None:
+        """
+        Remove files left behind by a crash before they were indexed.
+        """
+        with self.lock:
+            known = set(i[0] for i in self.conn.execute("SELECT fname FROM item"))
+        for fname in os.listdir(self.path):
+            if fname.startswith("spool.db") or fname in known:
+                continue
+            logging.info(f"Spool: Removing orphaned {fname}")
+            os.remove(self.file_path(fname))
+
+
+class SpoolUploader(object):
+    """
+    Drains the spool through an Uploader. Failed uploads are retried with
+    exponential backoff, and given up on after max_attempts unless it's 0.
+    Retries are safe because the API is asked for the hash first and a
+    duplicate upload is answered with 409.
+    """
+    def __init__(self, spool: Spool, uploader, max_attempts: int=0,
+                 retry_backoff: float=30.0, max_backoff: float=3600.0,
+                 poll_interval: float=60.0):
+        self.spool = spool
+        self.uploader = uploader
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.idle = threading.Condition(self.lock)
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.uploaded = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.__run, name="SpoolUploader",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.wait()
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def drain(self) -> int:
+        """
+        Try to upload every item which is due once and wait for the
+        uploads. Returns the number of items tried.
+        """
+        tried = set()
+        while not self.stopping.is_set():
+            items = self.__submit_due(tried)
+            if len(items) == 0:
+                break
+            tried.update(items)
+        self.wait()
+        return len(tried)
+
+    def wait(self) -> None:
+        with self.lock:
+            while len(self.in_flight) > 0:
+                self.idle.wait()
+
+    def __run(self) -> None:
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            submitted = []
+            try:
+                submitted = self.__submit_due()
+            except Exception as e:
+                logging.error(f"Spool: Submitting uploads failed: {e}")
+            if len(submitted) > 0:
+                continue
+            timeout = self.poll_interval
+            next_due = self.spool.next_due()
+            if next_due is not None:
+                timeout = max(0.01, min(timeout, next_due - time.time()))
+            self.wakeup.wait(timeout)
+
+    def __submit_due(self, exclude: set=frozenset()) -> list:
+        """
+        Submit the due items which aren't in flight or excluded. Returns
+        their hashes.
+        """
+        with self.lock:
+            skip = self.in_flight | exclude
+        items = self.spool.due(self.uploader.concurrency, time.time(), skip)
+        for item in items:
+            with self.lock:
+                self.in_flight.add(item["sha256"])
+            try:
+                payload = open(self.spool.file_path(item["fname"]), "rb")
+            except OSError as e:
+                self.__finish(item, None, e)
+                continue
+            msg = {"fname": item["fname"],
+                   "sha256": item["sha256"],
+                   "msg_uid": item["msg_uid"],
+                   "tags": item["tags"],
+                   "payload": payload}
+            future = self.uploader.submit(msg)
+            future.add_done_callback(
+                    lambda f, item=item: self.__finish(item, f))
+        return [i["sha256"] for i in items]
+
+    def __finish(self, item: dict, future, error: Exception=None) -> None:
+        sha256 = item["sha256"]
+        try:
+            if error is None:
+                try:
+                    if future.result():
+                        self.spool.done(sha256)
+                        with self.lock:
+                            self.uploaded += 1
+                        return
+                    error = "upload failed"
+                except Exception as e:
+                    error = e
+            attempts = item["attempts"] + 1
+            if self.max_attempts > 0 and attempts >= self.max_attempts:
+                logging.error(f"Spool: {item['fname']} failed {attempts} "
+                              + f"times, giving up: {error}")
+                self.spool.retry(sha256, str(error))
+                with self.lock:
+                    self.failed += 1
+                return
+            delay = min(self.max_backoff,
+                        self.retry_backoff * 2 ** (attempts - 1))
+            logging.warning(f"Spool: {item['fname']} failed, retrying in "
+                            + f"{delay:.0f}s: {error}")
+            self.spool.retry(sha256, str(error), time.time() + delay)
+        except Exception as e:
+            logging.error(f"Spool: Recording the result of {sha256} "
+                          + f"failed: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(sha256)
+                self.idle.notify_all()
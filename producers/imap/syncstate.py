@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import os
+import threading
+
+
+class SyncState(object):
+    """
+    Per folder UIDVALIDITY and the highest UID processed so far, stored as
+    JSON. A folder only needs to be fetched from the next UID on, unless
+    the server changed its UIDVALIDITY, which invalidates all UIDs.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.folders = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.folders = json.load(f)
+
+    def since_uid(self, key: str, uidvalidity: int) -> int:
+        """
+        The highest processed UID, or 0 when the folder has to be synced
+        from the start.
+        """
+        with self.lock:
+            folder = self.folders.get(key)
+        if folder is None or folder["uidvalidity"] != uidvalidity:
+            return 0
+        return folder["last_uid"]
+
+    def update(self, key: str, uidvalidity: int, last_uid: int) -> None:
+        with self.lock:
+            self.folders[key] = {"uidvalidity": uidvalidity,
+                                 "last_uid": last_uid}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.folders, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class Checkpoint(object):
+    """
+    Tracks the highest UID below which every fetched message has been
+    disposed of, when messages finish out of order. Messages are
+    registered in UID order as they're fetched and stay open while their
+    attachments are being uploaded.
+    """
+    def __init__(self, last_uid: int=0):
+        self.last_uid = last_uid
+        self.fetched_uids = collections.deque()
+        self.open_uids = set()
+
+    def fetched(self, uid) -> None:
+        self.fetched_uids.append(int(uid))
+
+    def open(self, uid) -> None:
+        self.open_uids.add(int(uid))
+
+    def close(self, uid) -> None:
+        self.open_uids.discard(int(uid))
+
+    def advance(self) -> bool:
+        """
+        Move past the finished messages. Returns whether last_uid changed.
+        """
+        changed = False
+        while len(self.fetched_uids) > 0 \
+                and self.fetched_uids[0] not in self.open_uids:
+            self.last_uid = self.fetched_uids.popleft()
+            changed = True
+        return changed
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the receipts API which records the uploads it receives.
+"""
+
+import email.parser
+import email.policy
+import http.server
+import threading
+import time
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status: int, body: bytes=b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        if self.server.unavailable:
+            self.respond(503)
+            return
+        sha256 = self.path.rsplit("/", 1)[-1]
+        with self.server.lock:
+            stored = sha256 in self.server.stored
+        self.respond(200 if stored else 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        parser = email.parser.BytesParser(policy=email.policy.HTTP)
+        form = parser.parsebytes(b"Content-Type: " +
+                                 self.headers["Content-Type"].encode() +
+                                 b"\r\n\r\n" + body)
+        fields = {}
+        for part in form.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = part.get_payload(decode=True)
+
+        tags = fields.get("tags", b"").decode()
+        sha256 = fields.get("sha256", b"").decode()
+        with self.server.lock:
+            self.server.connections.add(self.client_address)
+            if self.server.unavailable:
+                self.server.failures += 1
+                status = 503
+            elif self.server.fail_tag is not None \
+                    and self.server.fail_tag in tags.split():
+                self.server.failures += 1
+                status = 503
+            elif sha256 in self.server.stored:
+                status = 409
+            else:
+                self.server.stored[sha256] = (tags, fields.get("file"))
+                status = 200
+        self.respond(status, b"Upload OK\r\n" if status == 200
+                             else b"ERROR\r\n")
+
+
+class FakeApi(http.server.ThreadingHTTPServer):
+    """
+    Use as a context manager; url is the upload URL. Uploads with fail_tag
+    in their tags get a 503, and every request does while unavailable is
+    set.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency: float=0.0, fail_tag: str=None):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.latency = latency
+        self.fail_tag = fail_tag
+        self.unavailable = False
+        self.stored = {}
+        self.failures = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={"poll_interval": 0.05},
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Minimal in-process IMAP4rev1 server for tests and benchmarks. Implements
+the subset of commands ImapHandler uses, over plain TCP.
+"""
+
+import email
+import email.message
+import re
+import select
+import socket
+import socketserver
+import threading
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+DEFAULT_CAPABILITIES = ("IMAP4rev1", "UIDPLUS", "MOVE", "IDLE")
+
+token_pat = re.compile(rb'"((?:[^"\\]|\\.)*)"|\(|\)|[^\s()]+')
+
+
+class Message(object):
+    def __init__(self, uid: int, raw: bytes):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set()
+        self.parsed = None
+
+    def mime(self) -> email.message.Message:
+        if self.parsed is None:
+            self.parsed = email.message_from_bytes(self.raw)
+        return self.parsed
+
+
+def quote(value) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def part_body(part: email.message.Message) -> bytes:
+    """
+    The body of a leaf part as it is in the message, still encoded.
+    """
+    return part.get_payload().encode("ascii", "surrogateescape")
+
+def body_structure(part: email.message.Message) -> str:
+    params = part.get_params() or []
+    params = " ".join(f"{quote(k.upper())} {quote(v)}" for k, v in params[1:])
+    params = f"({params})" if params else "NIL"
+    if part.is_multipart():
+        children = "".join(body_structure(i) for i in part.get_payload())
+        return f"({children} {quote(part.get_content_subtype().upper())} " \
+               + f"{params} NIL NIL NIL)"
+
+    body = part_body(part)
+    disposition = part.get_content_disposition()
+    filename = part.get_param("filename", header="content-disposition")
+    if disposition is None:
+        disposition = "NIL"
+    elif filename is None:
+        disposition = f"({quote(disposition.upper())} NIL)"
+    else:
+        disposition = f'({quote(disposition.upper())} ("FILENAME" ' \
+                      + f"{quote(filename)}))"
+    fields = [quote(part.get_content_maintype().upper()),
+              quote(part.get_content_subtype().upper()), params, "NIL", "NIL",
+              quote(part.get("Content-Transfer-Encoding", "7bit").upper()),
+              str(len(body))]
+    if part.get_content_maintype() == "text":
+        fields.append(str(body.count(b"\n")))
+    fields += ["NIL", disposition, "NIL", "NIL"]
+    return "(" + " ".join(fields) + ")"
+
+def section_body(msg: email.message.Message, section: str) -> bytes:
+    """
+    The body of a numbered section like "2" or "1.3".
+    """
+    part = msg
+    for num in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(num) - 1]
+        elif num != "1":
+            raise ValueError(f"No section {section}")
+    return part_body(part)
+
+
+class Folder(object):
+    def __init__(self, uidvalidity: int):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+
+    def append(self, raw: bytes) -> int:
+        uid = self.uidnext
+        self.uidnext += 1
+        self.messages.append(Message(uid, raw))
+        return uid
+
+
+class MailStore(object):
+    """
+    Folders shared by all connections of a server.
+    """
+    def __init__(self):
+        self.folders = {}
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.next_uidvalidity = 1000
+
+    def folder(self, name: str) -> Folder:
+        with self.lock:
+            if name not in self.folders:
+                self.folders[name] = Folder(self.next_uidvalidity)
+                self.next_uidvalidity += 1
+            return self.folders[name]
+
+    def append(self, name: str, raw: bytes) -> int:
+        with self.lock:
+            uid = self.folder(name).append(raw)
+            self.changed.notify_all()
+            return uid
+
+    def reset_uidvalidity(self, name: str) -> None:
+        """
+        Renumber a folder like a server which lost its UID state.
+        """
+        with self.lock:
+            folder = self.folder(name)
+            folder.uidvalidity = self.next_uidvalidity
+            self.next_uidvalidity += 1
+            for uid, msg in enumerate(folder.messages, 1):
+                msg.uid = uid
+            folder.uidnext = len(folder.messages) + 1
+
+    def uids(self, name: str) -> list:
+        with self.lock:
+            return [i.uid for i in self.folder(name).messages]
+
+
+def make_message(subject: str, images: list,
+                 date: str="Mon, 13 Jan 2020 10:00:00 +0100") -> bytes:
+    """
+    A receipt mail with a text part and (filename, bytes) image attachments.
+    """
+    msg = MIMEMultipart()
+    msg["Subject"] = subject
+    msg["From"] = "sender@example.com"
+    msg["Date"] = date
+    msg.attach(MIMEText("Receipt attached"))
+    for filename, content in images:
+        image = MIMEImage(content, "png")
+        image.add_header("Content-Disposition", "attachment",
+                         filename=filename)
+        msg.attach(image)
+    return msg.as_bytes()
+
+def parse_set(spec: str, values: list) -> list:
+    """
+    Resolve an IMAP sequence set against the sorted values it may refer to.
+    """
+    if len(values) == 0:
+        return []
+    largest = values[-1]
+    wanted = set()
+    ranges = []
+    for part in spec.split(","):
+        if ":" in part:
+            lo, hi = part.split(":", 1)
+            lo = largest if lo == "*" else int(lo)
+            hi = largest if hi == "*" else int(hi)
+            ranges.append((min(lo, hi), max(lo, hi)))
+        else:
+            wanted.add(largest if part == "*" else int(part))
+    return [v for v in values
+            if v in wanted or any(lo <= v <= hi for lo, hi in ranges)]
+
+def tokenize(line: bytes) -> list:
+    tokens = []
+    for match in token_pat.finditer(line):
+        if match.group(1) is not None:
+            tokens.append(match.group(1).decode())
+        else:
+            tokens.append(match.group(0).decode())
+    return tokens
+
+
+class ImapRequestHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.store = self.server.store
+        self.selected = None
+        self.readonly = False
+        self.known_exists = 0
+        with self.server.lock:
+            self.server.handlers.add(self)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.handlers.discard(self)
+        super().finish()
+
+    def send(self, data: bytes) -> None:
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def untagged(self, line: str) -> None:
+        self.send(f"* {line}\r\n".encode())
+
+    def handle(self):
+        self.untagged("OK Fake IMAP server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            self.line = line.rstrip(b"\r\n").decode()
+            tokens = tokenize(line.rstrip(b"\r\n"))
+            if len(tokens) < 2:
+                self.send(b"* BAD Empty command\r\n")
+                continue
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            self.server.commands.append(command if command != "UID"
+                                        else "UID " + args[0].upper())
+            handler = getattr(self, "cmd_" + command.lower(), None)
+            if handler is None:
+                self.send(f"{tag} BAD Unknown command {command}\r\n".encode())
+                continue
+            try:
+                result = handler(tag, args)
+            except Exception as e:
+                self.send(f"{tag} BAD {e}\r\n".encode())
+                continue
+            if result == "LOGOUT":
+                return
+            if result is not None:
+                self.send(f"{tag} {result}\r\n".encode())
+
+    def messages(self) -> list:
+        return self.store.folder(self.selected).messages
+
+    def report_exists(self) -> None:
+        count = len(self.messages())
+        if count != self.known_exists:
+            self.known_exists = count
+            self.untagged(f"{count} EXISTS")
+
+    def cmd_capability(self, tag, args):
+        self.untagged("CAPABILITY " + " ".join(self.server.capabilities))
+        return "OK CAPABILITY completed"
+
+    def cmd_login(self, tag, args):
+        if self.server.credentials is not None \
+                and tuple(args[:2]) != self.server.credentials:
+            return "NO LOGIN failed"
+        return "OK LOGIN completed"
+
+    def cmd_logout(self, tag, args):
+        self.untagged("BYE Logging out")
+        self.send(f"{tag} OK LOGOUT completed\r\n".encode())
+        return "LOGOUT"
+
+    def cmd_noop(self, tag, args):
+        if self.selected is not None:
+            with self.store.lock:
+                self.report_exists()
+        return "OK NOOP completed"
+
+    def cmd_select(self, tag, args, readonly=False):
+        with self.store.lock:
+            folder = self.store.folder(args[0])
+            self.selected = args[0]
+            self.readonly = readonly
+            self.known_exists = len(folder.messages)
+            self.untagged(f"{len(folder.messages)} EXISTS")
+            self.untagged("0 RECENT")
+            self.untagged(f"OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid")
+            self.untagged(f"OK [UIDNEXT {folder.uidnext}] Predicted next UID")
+        mode = "READ-ONLY" if readonly else "READ-WRITE"
+        return f"OK [{mode}] SELECT completed"
+
+    def cmd_examine(self, tag, args):
+        return self.cmd_select(tag, args, readonly=True)
+
+    def cmd_close(self, tag, args):
+        if self.selected is not None and not self.readonly:
+            with self.store.lock:
+                self.expunge(report=False)
+        self.selected = None
+        return "OK CLOSE completed"
+
+    def cmd_search(self, tag, args, uid=False):
+        with self.store.lock:
+            messages = self.messages()
+            if len(args) >= 2 and args[-2].upper() == "UID":
+                uids = parse_set(args[-1], [m.uid for m in messages])
+                matched = [(n, m) for n, m in enumerate(messages, 1)
+                           if m.uid in uids]
+            else:
+                matched = list(enumerate(messages, 1))
+            found = [str(m.uid if uid else n) for n, m in matched]
+        self.untagged(" ".join(["SEARCH"] + found))
+        return "OK SEARCH completed"
+
+    def resolve(self, spec: str, uid: bool) -> list:
+        """
+        (sequence number, message) pairs for a sequence or UID set.
+        """
+        messages = self.messages()
+        if uid:
+            uids = set(parse_set(spec, [m.uid for m in messages]))
+            return [(n, m) for n, m in enumerate(messages, 1) if m.uid in uids]
+        nums = set(parse_set(spec, list(range(1, len(messages) + 1))))
+        return [(n, m) for n, m in enumerate(messages, 1) if n in nums]
+
+    def cmd_fetch(self, tag, args, uid=False):
+        items = re.search(r"FETCH\s+\S+\s+(.*)$", self.line,
+                          re.IGNORECASE).group(1).strip()
+        if items.startswith("(") and items.endswith(")"):
+            items = items[1:-1]
+        items = items.upper()
+        with self.store.lock:
+            targets = self.resolve(args[0], uid)
+            for num, msg in targets:
+                self.send_fetch(num, msg, items, uid)
+        return "OK FETCH completed"
+
+    def send_fetch(self, num: int, msg: Message, items: str,
+                   uid: bool) -> None:
+        parts = []
+        literals = []
+        if uid or "UID" in items.split():
+            parts.append(f"UID {msg.uid}".encode())
+        if "FLAGS" in items.split():
+            parts.append(f"FLAGS ({' '.join(sorted(msg.flags))})".encode())
+        if "RFC822.SIZE" in items:
+            parts.append(f"RFC822.SIZE {len(msg.raw)}".encode())
+        if "BODYSTRUCTURE" in items.split():
+            parts.append(("BODYSTRUCTURE "
+                          + body_structure(msg.mime())).encode())
+        for item, body in self.server.body_items(msg, items):
+            literals.append((item, body))
+        out = f"* {num} FETCH (".encode() + b" ".join(parts)
+        for item, body in literals:
+            if not out.endswith(b"("):
+                out += b" "
+            out += f"{item} {{{len(body)}}}\r\n".encode() + body
+        self.send(out + b")\r\n")
+        if "BODY[" in items and "PEEK" not in items or "RFC822" in items.split():
+            msg.flags.add("\\Seen")
+
+    def cmd_store(self, tag, args, uid=False):
+        with self.store.lock:
+            targets = self.resolve(args[0], uid)
+            op = args[1].upper()
+            flags = set(i for i in args[2:] if i not in ("(", ")"))
+            for num, msg in targets:
+                if op.startswith("+"):
+                    msg.flags |= flags
+                elif op.startswith("-"):
+                    msg.flags -= flags
+                else:
+                    msg.flags = set(flags)
+                if ".SILENT" not in op:
+                    self.untagged(f"{num} FETCH (FLAGS "
+                                  + f"({' '.join(sorted(msg.flags))}))")
+        return "OK STORE completed"
+
+    def cmd_copy(self, tag, args, uid=False):
+        with self.store.lock:
+            targets = self.resolve(args[0], uid)
+            dest = self.store.folder(args[1])
+            for num, msg in targets:
+                dest.append(msg.raw)
+            self.store.changed.notify_all()
+        return "OK COPY completed"
+
+    def cmd_move(self, tag, args, uid=False):
+        if "MOVE" not in self.server.capabilities:
+            return "BAD MOVE not supported"
+        with self.store.lock:
+            targets = self.resolve(args[0], uid)
+            self.cmd_copy(tag, args, uid)
+            moved = set(id(m) for _, m in targets)
+            self.remove(lambda m: id(m) in moved)
+        return "OK MOVE completed"
+
+    def expunge(self, report: bool=True, uids: set=None) -> None:
+        self.remove(lambda m: "\\Deleted" in m.flags
+                    and (uids is None or m.uid in uids), report)
+
+    def remove(self, predicate, report: bool=True) -> None:
+        """
+        Remove messages one at a time like a server renumbering its
+        sequence numbers after every removal.
+        """
+        messages = self.messages()
+        num = 0
+        while num < len(messages):
+            if predicate(messages[num]):
+                del messages[num]
+                if report:
+                    self.untagged(f"{num + 1} EXPUNGE")
+                self.known_exists -= 1
+            else:
+                num += 1
+
+    def cmd_expunge(self, tag, args, uid=False):
+        with self.store.lock:
+            if uid:
+                if "UIDPLUS" not in self.server.capabilities:
+                    return "BAD UID EXPUNGE not supported"
+                uids = set(m.uid for _, m in self.resolve(args[0], True))
+                self.expunge(uids=uids)
+            else:
+                self.expunge()
+        return "OK EXPUNGE completed"
+
+    def cmd_uid(self, tag, args):
+        command = args[0].lower()
+        if command not in ("fetch", "search", "store", "copy", "move",
+                           "expunge"):
+            return f"BAD Unknown UID command {args[0]}"
+        result = getattr(self, "cmd_" + command)(tag, args[1:], uid=True)
+        # Like real servers, report new mail in replies to other commands
+        with self.store.lock:
+            if self.selected is not None:
+                self.report_exists()
+        return result
+
+    def cmd_idle(self, tag, args):
+        if "IDLE" not in self.server.capabilities:
+            return "BAD IDLE not supported"
+        self.send(b"+ idling\r\n")
+        while True:
+            with self.store.lock:
+                if self.selected is not None:
+                    self.report_exists()
+            readable, _, _ = select.select([self.connection], [], [],
+                                           self.server.idle_poll)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return "LOGOUT"
+                if line.strip().upper() == b"DONE":
+                    return "OK IDLE terminated"
+                return "BAD Expected DONE"
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    Serves a MailStore on 127.0.0.1. Use as a context manager; address is
+    the (host, port) to connect to.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    idle_poll = 0.05
+
+    def __init__(self, store: MailStore=None,
+                 capabilities: tuple=DEFAULT_CAPABILITIES,
+                 credentials: tuple=None):
+        super().__init__(("127.0.0.1", 0), ImapRequestHandler)
+        self.store = store if store is not None else MailStore()
+        self.capabilities = capabilities
+        self.credentials = credentials
+        self.commands = []
+        self.handlers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self) -> tuple:
+        return self.server_address
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={"poll_interval": 0.05},
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+    def drop_connections(self) -> None:
+        """
+        Cut every open connection like a server restart or a NAT timeout.
+        """
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def body_items(self, msg: Message, items: str) -> list:
+        """
+        (name, literal) pairs for the body items requested in a FETCH.
+        """
+        literals = []
+        for item, section, origin, count in re.findall(
+                r"(RFC822(?![.\w])|BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?)",
+                items):
+            if item == "RFC822":
+                literals.append(("RFC822", msg.raw))
+                continue
+            if section == "":
+                body = msg.raw
+            elif section.startswith("HEADER.FIELDS"):
+                names = section[section.index("(") + 1:-1].lower().split()
+                body = "".join(f"{k}: {v}\r\n" for k, v in msg.mime().items()
+                               if k.lower() in names).encode() + b"\r\n"
+            else:
+                body = section_body(msg.mime(), section)
+            name = f"BODY[{section}]"
+            if origin:
+                body = body[int(origin):int(origin) + int(count)]
+                name += f"<{origin}>"
+            literals.append((name, body))
+        return literals
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import email
+import hashlib
+import os
+import unittest
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+
+import imap_handler
+from syncstate import Checkpoint, SyncState
+from fake_api import FakeApi
+from fake_imap import FakeImapServer, MailStore, make_message
+
+
+def handler_for(server: FakeImapServer, **kwargs) -> imap_handler.ImapHandler:
+    host, port = server.address
+    return imap_handler.ImapHandler(login_name="receipt",
+                                    password="abc123",
+                                    server_address=host,
+                                    port=port,
+                                    use_ssl=False,
+                                    folder="receipts",
+                                    **kwargs)
+
+def fill_store(count: int, images_per_message: int=1) -> MailStore:
+    store = MailStore()
+    for i in range(count):
+        images = [(f"receipt_{i}_{n}.PNG", f"image {i} {n}".encode())
+                  for n in range(images_per_message)]
+        store.append("receipts", make_message(f"shop_{i} 2020-01-{i % 28 + 1:02}",
+                                              images))
+    return store
+
+class ImapHandlerTests(unittest.TestCase):
+    def test_parse_fetch_response(self):
+        data = [(b'1 (UID 10 BODY[] {3}', b'abc'), b')',
+                (b'2 (BODY[] {3}', b'def'), b' UID 11)']
+        self.assertListEqual([("10", b"abc"), ("11", b"def")],
+                             imap_handler.parse_fetch_response(data))
+
+    def test_yield_messages_batched(self):
+        store = fill_store(7, images_per_message=2)
+        with FakeImapServer(store) as server:
+            with handler_for(server) as handler:
+                msgs = list(handler.yield_messages_batched(batch_size=3))
+            fetches = server.commands.count("UID FETCH")
+
+        self.assertEqual(14, len(msgs))
+        self.assertEqual(3, fetches, "Messages weren't fetched in batches")
+        first = msgs[0]
+        self.assertEqual("1", first["msg_uid"])
+        self.assertEqual("shop_0 2020-01-01", first["tags"])
+        self.assertEqual(hashlib.sha256(b"image 0 0").hexdigest() + ".png",
+                         first["fname"])
+        self.assertEqual(b"image 0 0", first["payload"])
+        # BODY.PEEK doesn't mark the messages as read
+        self.assertTrue(all("\\Seen" not in m.flags for m in
+                            store.folder("receipts").messages))
+
+    def test_batched_matches_sequential(self):
+        store = fill_store(5, images_per_message=2)
+        with FakeImapServer(store) as server:
+            with handler_for(server) as handler:
+                batched = list(handler.yield_messages_batched(batch_size=2))
+                sequential = list(handler.yield_messages())
+        key = lambda m: (m["msg_uid"], m["fname"])
+        self.assertListEqual(sorted(map(key, sequential)),
+                             sorted(map(key, batched)))
+
+    def test_process_batched(self):
+        store = fill_store(20, images_per_message=2)
+        # Every attachment of the tenth message fails
+        store.append("receipts", make_message("fail_me", [("x.png", b"x")]))
+        with FakeImapServer(store) as server, \
+                FakeApi(latency=0.01, fail_tag="fail_me") as api:
+            with handler_for(server) as handler, \
+                    imap_handler.Uploader(api.url, concurrency=4) as uploader:
+                imap_handler.process_batched(handler, uploader, batch_size=8)
+
+            self.assertEqual(40, len(api.stored))
+            self.assertLessEqual(len(api.connections), 4,
+                                 "Connections weren't reused")
+        self.assertListEqual([], store.uids("receipts"))
+        self.assertEqual(20, len(store.uids("receipts/archived")))
+        # Moved in bulk, once per destination and flush
+        self.assertLessEqual(server.commands.count("UID MOVE"), 6)
+        self.assertEqual(1, len(store.uids("receipts/errors")))
+
+    def test_process_messages(self):
+        store = fill_store(3)
+        with FakeImapServer(store) as server, FakeApi() as api:
+            with handler_for(server) as handler:
+                imap_handler.process_messages(handler, api.url)
+            self.assertEqual(3, len(api.stored))
+        self.assertEqual(3, len(store.uids("receipts/archived")))
+
+    def test_malformed_messages(self):
+        def malformed_store() -> tuple:
+            store = fill_store(2)
+            bad_uid = store.append("receipts", make_message(
+                    "shop_bad", [("bad.png", b"bad")], date="not a date"))
+            unnamed = email.message_from_bytes(make_message("shop_unnamed",
+                                                            []))
+            unnamed.attach(MIMEImage(b"unnamed", "png"))
+            store.append("receipts", unnamed.as_bytes())
+            return store, bad_uid
+
+        for kwargs in ({}, {"fetch_parts": True}):
+            store, bad_uid = malformed_store()
+            with FakeImapServer(store) as server, FakeApi() as api:
+                with handler_for(server, **kwargs) as handler, \
+                        imap_handler.Uploader(api.url) as uploader:
+                    imap_handler.process_batched(handler, uploader,
+                                                 batch_size=2)
+                self.assertEqual(3, len(api.stored))
+                self.assertIn(hashlib.sha256(b"unnamed").hexdigest(),
+                              api.stored)
+            # The malformed message is skipped and left in place
+            self.assertListEqual([bad_uid], store.uids("receipts"))
+
+        store, bad_uid = malformed_store()
+        with FakeImapServer(store) as server, FakeApi() as api:
+            with handler_for(server) as handler:
+                imap_handler.process_messages(handler, api.url)
+            self.assertEqual(3, len(api.stored))
+        self.assertListEqual([bad_uid], store.uids("receipts"))
+
+    def test_metrics(self):
+        metrics_file = "test_imap_handler.prom"
+        store = fill_store(3)
+        imap_handler.registry.enabled = True
+        try:
+            with FakeImapServer(store) as server, FakeApi() as api:
+                with handler_for(server) as handler:
+                    imap_handler.process_messages(handler, api.url)
+            imap_handler.registry.write_textfile(metrics_file)
+        finally:
+            imap_handler.registry.enabled = False
+        with open(metrics_file) as f:
+            text = f.read()
+        os.unlink(metrics_file)
+        for stage in ("fetch", "parse", "decode", "exists", "upload"):
+            self.assertIn(f'imap_handler_stage_seconds_count{{stage="{stage}"}} 3',
+                          text)
+        self.assertIn('imap_handler_uploads_total{result="stored"} 3', text)
+
+    def test_fetch_parts(self):
+        store = fill_store(3, images_per_message=2)
+        raw = email.message_from_bytes(make_message("shop_pdf 2020-03-01",
+                                                    [("big.png",
+                                                      os.urandom(5000))]))
+        raw.attach(MIMEApplication(b"%PDF" + b"x" * 100000, "pdf"))
+        store.append("receipts", raw.as_bytes())
+        with FakeImapServer(store) as server:
+            with handler_for(server) as handler:
+                full = list(handler.yield_messages_batched(batch_size=2))
+            start = len(server.commands)
+            with handler_for(server, fetch_parts=True,
+                             part_chunk_size=1000) as handler:
+                parts = list(handler.yield_messages_batched(batch_size=2))
+            fetches = server.commands[start:].count("UID FETCH")
+
+        self.assertEqual(7, len(parts))
+        key = lambda m: (m["msg_uid"], m["fname"], m["sha256"], m["tags"],
+                         m["arrival_time"])
+        self.assertListEqual(sorted(map(key, full)), sorted(map(key, parts)))
+        payloads = {m["sha256"]: m["payload"] for m in full}
+        for msg in parts:
+            self.assertEqual(payloads[msg["sha256"]], msg["payload"].read())
+            msg["payload"].close()
+        # 2 structure fetches, 1 per small image and 7 chunks of the big
+        # one, but none for the PDF
+        self.assertEqual(2 + 6 + 7, fetches)
+
+    def test_compress_uids(self):
+        self.assertListEqual(["1:3,5,7:9"],
+                             imap_handler.compress_uids(["9", 1, 2, 3, 5,
+                                                         8, 7, 3]))
+        self.assertListEqual([], imap_handler.compress_uids([]))
+        sets = imap_handler.compress_uids(range(1, 2000, 2), max_length=100)
+        self.assertTrue(all(len(i) <= 100 for i in sets))
+        self.assertEqual(1000, sum(len(i.split(",")) for i in sets))
+
+    def test_move_messages(self):
+        for capabilities, expected in (
+                (("IMAP4rev1", "UIDPLUS", "MOVE"), ["UID MOVE"]),
+                (("IMAP4rev1", "UIDPLUS"),
+                 ["UID COPY", "UID STORE", "UID EXPUNGE"]),
+                (("IMAP4rev1",), ["UID COPY", "UID STORE", "EXPUNGE"])):
+            store = fill_store(10)
+            with FakeImapServer(store, capabilities) as server:
+                with handler_for(server) as handler:
+                    handler.select_folder()
+                    start = len(server.commands)
+                    self.assertTrue(handler.move_messages(
+                            ["2", "3", "4", "7"], "receipts/archived"))
+                    commands = server.commands[start:]
+            self.assertListEqual(expected, commands)
+            self.assertListEqual([1, 5, 6, 8, 9, 10], store.uids("receipts"))
+            self.assertEqual(4, len(store.uids("receipts/archived")))
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint(3)
+        for uid in (4, 5, 6):
+            checkpoint.fetched(uid)
+            checkpoint.open(uid)
+        checkpoint.close(5)
+        self.assertFalse(checkpoint.advance())
+        self.assertEqual(3, checkpoint.last_uid)
+        checkpoint.close(4)
+        self.assertTrue(checkpoint.advance())
+        self.assertEqual(5, checkpoint.last_uid, "Open UID 6 was skipped")
+        # Fetched but never opened, i.e. no attachments
+        checkpoint.fetched(7)
+        checkpoint.close(6)
+        checkpoint.advance()
+        self.assertEqual(7, checkpoint.last_uid)
+
+    def test_incremental_sync(self):
+        state_file = "test_sync_state.json"
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+        # Messages without attachments stay in the folder
+        store = fill_store(4)
+        for i in range(3):
+            store.append("receipts", make_message(f"note_{i}", []))
+
+        def sync(server, api):
+            start = len(server.commands)
+            with handler_for(server) as handler, \
+                    imap_handler.Uploader(api.url, concurrency=2) as uploader:
+                imap_handler.process_batched(handler, uploader, batch_size=2,
+                                             sync_state=SyncState(state_file))
+            return server.commands[start:].count("UID FETCH")
+
+        with FakeImapServer(store) as server, FakeApi() as api:
+            self.assertEqual(4, sync(server, api))
+            self.assertEqual(4, len(api.stored))
+            self.assertEqual(3, len(store.uids("receipts")))
+
+            self.assertEqual(0, sync(server, api),
+                             "Already processed messages were fetched")
+
+            store.append("receipts", make_message("shop_new 2020-02-01",
+                                                  [("new.png", b"new")]))
+            self.assertEqual(1, sync(server, api))
+            self.assertEqual(5, len(api.stored))
+            self.assertEqual(5, len(store.uids("receipts/archived")))
+
+            key = f"receipt@{server.address[0]}/receipts"
+            uidvalidity = store.folder("receipts").uidvalidity
+            self.assertEqual(8, SyncState(state_file).since_uid(key,
+                                                                uidvalidity))
+
+            # Old UIDs are meaningless after UIDVALIDITY changes
+            store.reset_uidvalidity("receipts")
+            self.assertEqual(2, sync(server, api))
+            self.assertEqual(0, SyncState(state_file).since_uid(key,
+                                                                uidvalidity))
+        os.remove(state_file)
+
+    def test_incremental_sync_sequential(self):
+        state_file = "test_sync_state.json"
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+        store = fill_store(3)
+        store.append("receipts", make_message("note", []))
+
+        def sync(server, api):
+            start = len(server.commands)
+            with handler_for(server) as handler:
+                imap_handler.process_messages(handler, api.url,
+                                              SyncState(state_file))
+            return server.commands[start:].count("UID FETCH")
+
+        with FakeImapServer(store) as server, FakeApi() as api:
+            self.assertEqual(4, sync(server, api))
+            self.assertEqual(3, len(api.stored))
+            self.assertEqual(0, sync(server, api),
+                             "Already processed messages were fetched")
+
+            store.append("receipts", make_message("shop_new 2020-02-01",
+                                                  [("new.png", b"new")]))
+            self.assertEqual(1, sync(server, api))
+            self.assertEqual(4, len(api.stored))
+            self.assertEqual(4, len(store.uids("receipts/archived")))
+            self.assertEqual(1, len(store.uids("receipts")))
+        os.remove(state_file)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import base64
+import binascii
+import hashlib
+import os
+import unittest
+
+import mimeparts
+
+
+class MimePartsTests(unittest.TestCase):
+    def test_image_parts(self):
+        data = [(b'1 (UID 7 BODYSTRUCTURE (((("TEXT" "PLAIN" ("CHARSET" "UTF-8") '
+                 + b'NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)("TEXT" "HTML" '
+                 + b'("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 200 4 NIL '
+                 + b'NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL)'
+                 + b'("IMAGE" "JPEG" ("NAME" "r.JPG") "<id@x>" NIL "BASE64" 1000 '
+                 + b'NIL ("INLINE" ("FILENAME" "r.JPG")) NIL NIL) "RELATED" '
+                 + b'("BOUNDARY" "b3") NIL NIL)'
+                 + b'("APPLICATION" "PDF" ("NAME" "x.pdf") NIL NIL "BASE64" 5000 '
+                 + b'NIL ("ATTACHMENT" ("FILENAME" "x.pdf")) NIL NIL)'
+                 + b'("IMAGE" "PNG" NIL NIL NIL "BASE64" 80 NIL NIL NIL NIL) '
+                 + b'"MIXED" ("BOUNDARY" "b1") NIL NIL) '
+                 + b'BODY[HEADER.FIELDS (SUBJECT FROM DATE)] {18}',
+                 b'Subject: a "b"\r\n\r\n'),
+                b')']
+        fields = mimeparts.parse_fetch(data)
+        self.assertEqual(1, len(fields))
+        self.assertEqual(b"7", fields[0]["UID"])
+        self.assertEqual(b'Subject: a "b"\r\n\r\n',
+                         fields[0]["BODY[HEADER.FIELDS (SUBJECT FROM DATE)]"])
+        parts = mimeparts.image_parts(fields[0]["BODYSTRUCTURE"])
+        self.assertListEqual([{"section": "1.2", "subtype": "jpeg",
+                               "encoding": "base64", "size": 1000,
+                               "filename": "r.JPG"},
+                              {"section": "3", "subtype": "png",
+                               "encoding": "base64", "size": 80,
+                               "filename": None}], parts)
+
+    def test_single_part(self):
+        data = [b'3 (BODYSTRUCTURE ("IMAGE" "GIF" ("NAME" "a.gif") NIL NIL '
+                + b'"BASE64" 12) UID 9)']
+        fields = mimeparts.parse_fetch(data)[0]
+        self.assertEqual("1", mimeparts.image_parts(
+                fields["BODYSTRUCTURE"])[0]["section"])
+
+    def test_decoder(self):
+        content = os.urandom(10000)
+        for encoding, encoded in (
+                ("base64", base64.encodebytes(content)),
+                ("quoted-printable", binascii.b2a_qp(content, istext=False)),
+                ("binary", content)):
+            for chunk_size in (1, 7, 1000, 100000):
+                writer = mimeparts.HashingWriter(max_size=100)
+                decoder = mimeparts.Decoder(encoding, writer)
+                for i in range(0, len(encoded), chunk_size):
+                    decoder.feed(encoded[i:i + chunk_size])
+                decoder.close()
+                self.assertEqual(hashlib.sha256(content).hexdigest(),
+                                 writer.hexdigest())
+                self.assertEqual(len(content), writer.size)
+                self.assertEqual(content, writer.finish().read(),
+                                 f"{encoding} in {chunk_size} byte chunks")
+
+if __name__ == '__main__':
+    unittest.main()
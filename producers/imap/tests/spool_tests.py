@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import hashlib
+import os
+import shutil
+import time
+import unittest
+
+import imap_handler
+from fake_api import FakeApi
+from fake_imap import FakeImapServer
+from imap_handler_tests import fill_store, handler_for
+from spool import Spool, SpoolUploader
+from syncstate import SyncState
+
+
+def spool_item(i: int) -> dict:
+    payload = f"image {i}".encode()
+    sha256 = hashlib.sha256(payload).hexdigest()
+    return {"fname": sha256 + ".png",
+            "sha256": sha256,
+            "msg_uid": str(i),
+            "tags": f"shop_{i} 2020-01-01",
+            "payload": payload}
+
+def wait_for(predicate, timeout: float=5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+class SpoolTests(unittest.TestCase):
+    spool_dir = "test_spool"
+
+    def setUp(self):
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        self.spool = Spool(self.spool_dir)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def test_api_outage(self):
+        store = fill_store(5)
+        with FakeImapServer(store) as server, FakeApi() as api:
+            api.unavailable = True
+            with handler_for(server) as handler:
+                imap_handler.process_batched(handler, self.spool, batch_size=2)
+            # Archived once spooled, even though the API is down
+            self.assertEqual(5, len(store.uids("receipts/archived")))
+            self.assertEqual(0, len(store.uids("receipts/errors")))
+            self.assertEqual(5, len(self.spool))
+
+            with imap_handler.Uploader(api.url, concurrency=2) as uploader:
+                spool_uploader = SpoolUploader(self.spool, uploader,
+                                               retry_backoff=0.05)
+                self.assertEqual(5, spool_uploader.drain())
+                self.assertEqual(5, len(self.spool))
+                self.assertEqual(0, spool_uploader.drain(),
+                                 "Retried before the backoff")
+                self.assertEqual(5, api.failures)
+
+                api.unavailable = False
+                time.sleep(0.06)
+                self.assertEqual(5, spool_uploader.drain())
+            self.assertEqual(5, len(api.stored))
+            self.assertEqual(0, len(self.spool))
+        self.assertListEqual(["spool.db"], [i for i in os.listdir(self.spool_dir)
+                                            if not i.startswith("spool.db-")])
+
+    def test_spool_write_failure(self):
+        store = fill_store(5)
+        put = self.spool.put
+        def failing_put(msg):
+            if msg["msg_uid"] == failing_uid:
+                raise OSError(28, "No space left on device")
+            return put(msg)
+        self.spool.put = failing_put
+        sync_state = SyncState(os.path.join(self.spool_dir, "sync.json"))
+        with FakeImapServer(store) as server:
+            failing_uid = str(store.uids("receipts")[1])
+            with handler_for(server) as handler:
+                imap_handler.process_batched(handler, self.spool, batch_size=2,
+                                             sync_state=sync_state)
+                since_uid = sync_state.since_uid(handler.sync_key,
+                                                 handler.uidvalidity)
+        # The failed message stays in the inbox to be retried
+        self.assertListEqual([int(failing_uid)], store.uids("receipts"))
+        self.assertEqual(4, len(store.uids("receipts/archived")))
+        self.assertEqual(0, len(store.uids("receipts/errors")))
+        self.assertEqual(4, len(self.spool))
+        self.assertEqual(int(failing_uid) - 1, since_uid)
+
+    def test_background_upload(self):
+        with FakeApi() as api, \
+                imap_handler.Uploader(api.url, concurrency=2) as uploader:
+            spool_uploader = SpoolUploader(self.spool, uploader)
+            spool_uploader.start()
+            for i in range(10):
+                self.spool.submit(spool_item(i)).result()
+                spool_uploader.notify()
+            self.assertTrue(wait_for(lambda: len(api.stored) == 10))
+            spool_uploader.stop()
+        self.assertEqual(10, spool_uploader.uploaded)
+        self.assertEqual(0, len(self.spool))
+        tags, content = api.stored[spool_item(3)["sha256"]]
+        self.assertEqual("shop_3 2020-01-01", tags)
+        self.assertEqual(b"image 3", content)
+
+    def test_give_up(self):
+        self.spool.put(spool_item(1))
+        with FakeApi() as api, \
+                imap_handler.Uploader(api.url, concurrency=2) as uploader:
+            api.unavailable = True
+            spool_uploader = SpoolUploader(self.spool, uploader,
+                                           max_attempts=2, retry_backoff=0)
+            spool_uploader.drain()
+            spool_uploader.drain()
+            self.assertEqual(0, spool_uploader.drain())
+        self.assertEqual(1, spool_uploader.failed)
+        self.assertEqual({"pending": 0, "failed": 1},
+                         {k: v for k, v in self.spool.stats().items()
+                          if k != "oldest"})
+
+    def test_reopen(self):
+        self.assertTrue(self.spool.put(spool_item(1)))
+        self.assertFalse(self.spool.put(spool_item(1)))
+        self.spool.close()
+        # Left behind by a crash before indexing
+        with open(os.path.join(self.spool_dir, "orphan.png.tmp"), "wb") as f:
+            f.write(b"x")
+
+        self.spool = Spool(self.spool_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.spool_dir,
+                                                     "orphan.png.tmp")))
+        due = self.spool.due(10, time.time())
+        self.assertEqual(1, len(due))
+        with open(self.spool.file_path(due[0]["fname"]), "rb") as f:
+            self.assertEqual(b"image 1", f.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import sys
+sys.path.append("..")
+
+import json
+import os
+import threading
+import time
+import unittest
+
+import imap_handler
+from fake_api import FakeApi
+from fake_imap import FakeImapServer, make_message
+from imap_handler_tests import fill_store, handler_for
+from syncstate import SyncState
+from watcher import Watcher
+
+
+def wait_for(predicate, timeout: float=5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+class WatcherTests(unittest.TestCase):
+    heartbeat_file = "test_heartbeat.json"
+    state_file = "test_watcher_state.json"
+
+    def setUp(self):
+        for path in (self.heartbeat_file, self.state_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def tearDown(self):
+        self.setUp()
+
+    def start_watcher(self, server, api, **kwargs) -> tuple:
+        uploader = imap_handler.Uploader(api.url, concurrency=2)
+        sync_state = SyncState(self.state_file)
+
+        def process(handler):
+            imap_handler.process_batched(handler, uploader, 10, sync_state)
+
+        watcher = Watcher(lambda: handler_for(server), process,
+                          heartbeat_file=self.heartbeat_file, **kwargs)
+        thread = threading.Thread(target=watcher.run, daemon=True)
+        thread.start()
+        self.addCleanup(uploader.close)
+        return watcher, thread
+
+    def stop_watcher(self, watcher, thread) -> None:
+        watcher.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "Watcher didn't stop")
+        with open(self.heartbeat_file) as f:
+            self.assertEqual("stopped", json.load(f)["state"])
+
+    def test_idle(self):
+        store = fill_store(2)
+        with FakeImapServer(store) as server, FakeApi() as api:
+            watcher, thread = self.start_watcher(server, api)
+            self.assertTrue(wait_for(lambda: len(api.stored) == 2))
+            self.assertTrue(wait_for(lambda: watcher.stats()["state"] == "idle"))
+
+            start = time.monotonic()
+            store.append("receipts", make_message("shop_new 2020-02-01",
+                                                  [("new.png", b"new")]))
+            self.assertTrue(wait_for(lambda: len(api.stored) == 3))
+            self.assertLess(time.monotonic() - start, 1.0,
+                            "New mail wasn't picked up right away")
+            self.stop_watcher(watcher, thread)
+
+            self.assertEqual(1, server.commands.count("LOGIN"))
+            self.assertIn("IDLE", server.commands)
+            self.assertNotIn("NOOP", server.commands)
+        stats = watcher.stats()
+        self.assertEqual("idle", stats["mode"])
+        self.assertEqual(2, stats["syncs"])
+        self.assertEqual(3, len(store.uids("receipts/archived")))
+
+    def test_mail_during_sync(self):
+        store = fill_store(2)
+        new_mail = make_message("shop_new 2020-02-01", [("new.png", b"new")])
+        with FakeImapServer(store) as server, FakeApi() as api:
+            def connect():
+                handler = handler_for(server)
+                move_messages = handler.move_messages
+
+                def deliver_and_move(msg_uids, dest_folder):
+                    # Reported in the reply to the UID MOVE, not in IDLE
+                    handler.move_messages = move_messages
+                    store.append("receipts", new_mail)
+                    return move_messages(msg_uids, dest_folder)
+                handler.move_messages = deliver_and_move
+                return handler
+
+            uploader = imap_handler.Uploader(api.url, concurrency=2)
+            self.addCleanup(uploader.close)
+            sync_state = SyncState(self.state_file)
+            watcher = Watcher(connect, lambda handler: imap_handler
+                              .process_batched(handler, uploader, 10,
+                                               sync_state),
+                              heartbeat_file=self.heartbeat_file)
+            thread = threading.Thread(target=watcher.run, daemon=True)
+            thread.start()
+            self.assertTrue(wait_for(lambda: len(api.stored) == 3, 2.0),
+                            "Mail delivered while syncing was missed")
+            self.assertTrue(wait_for(lambda: watcher.stats()["state"] == "idle"))
+            self.stop_watcher(watcher, thread)
+        self.assertEqual(2, watcher.stats()["syncs"])
+        self.assertEqual(3, len(store.uids("receipts/archived")))
+
+    def test_unexpected_error(self):
+        store = fill_store(1)
+        calls = []
+
+        def process(handler):
+            calls.append(handler)
+            if len(calls) == 1:
+                raise ValueError("Unexpected")
+
+        with FakeImapServer(store) as server:
+            watcher = Watcher(lambda: handler_for(server), process,
+                              heartbeat_file=self.heartbeat_file,
+                              min_backoff=0.05)
+            thread = threading.Thread(target=watcher.run, daemon=True)
+            thread.start()
+            self.assertTrue(wait_for(lambda: watcher.stats()["state"] == "idle"))
+            self.stop_watcher(watcher, thread)
+        stats = watcher.stats()
+        self.assertEqual(2, stats["connects"])
+        self.assertEqual(1, stats["errors"])
+        self.assertEqual("Unexpected", stats["last_error"])
+
+    def test_poll_and_reconnect(self):
+        store = fill_store(1)
+        capabilities = ("IMAP4rev1", "UIDPLUS", "MOVE")
+        with FakeImapServer(store, capabilities) as server, FakeApi() as api:
+            watcher, thread = self.start_watcher(server, api,
+                                                 poll_interval=0.05,
+                                                 min_backoff=0.05)
+            self.assertTrue(wait_for(lambda: len(api.stored) == 1))
+            self.assertTrue(wait_for(lambda: "NOOP" in server.commands))
+
+            server.drop_connections()
+            store.append("receipts", make_message("shop_new 2020-02-01",
+                                                  [("new.png", b"new")]))
+            self.assertTrue(wait_for(lambda: len(api.stored) == 2))
+            self.assertTrue(wait_for(lambda: watcher.stats()["connects"] == 2))
+            self.stop_watcher(watcher, thread)
+
+            self.assertNotIn("IDLE", server.commands)
+        stats = watcher.stats()
+        self.assertEqual("poll", stats["mode"])
+        self.assertEqual(1, stats["errors"])
+        self.assertIsNotNone(stats["last_error"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import imaplib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Watcher(object):
+    """
+    Keeps one authenticated IMAP connection open and processes the folder
+    whenever new mail arrives. Waits with IDLE when the server supports it
+    and polls with NOOP otherwise. Lost connections are reopened with
+    exponential backoff.
+
+    connect returns a new, not yet logged in ImapHandler and process is
+    called with the logged in handler, once after connecting and again on
+    every new message.
+
+    The state and counters are written to heartbeat_file as JSON after
+    every wait, so a stale file means the watcher is stuck or dead.
+    """
+    def __init__(self, connect, process, heartbeat_file: str=None,
+                 idle_timeout: float=300.0, poll_interval: float=60.0,
+                 min_backoff: float=1.0, max_backoff: float=300.0):
+        self.connect = connect
+        self.process = process
+        self.heartbeat_file = heartbeat_file
+        # Servers may drop IDLE after 30 minutes, RFC 2177
+        self.idle_timeout = min(idle_timeout, 29 * 60)
+        self.poll_interval = poll_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.metrics = {"pid": os.getpid(),
+                        "state": "starting",
+                        "mode": None,
+                        "heartbeat": None,
+                        "connected_since": None,
+                        "last_sync": None,
+                        "last_sync_seconds": None,
+                        "syncs": 0,
+                        "connects": 0,
+                        "errors": 0,
+                        "last_error": None}
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.metrics)
+
+    def run(self) -> None:
+        backoff = self.min_backoff
+        while not self.stopping.is_set():
+            self.__update(state="connecting")
+            try:
+                with self.connect() as handler:
+                    self.__update(connects=self.metrics["connects"] + 1,
+                                  connected_since=time.time())
+                    backoff = self.min_backoff
+                    self.__watch(handler)
+                continue
+            except (imaplib.IMAP4.error, OSError, EOFError) as e:
+                logging.error(f"Watcher: Connection failed: {e}")
+                error = e
+            except Exception as e:
+                # Anything else mustn't stop the daemon for good either
+                logging.exception(f"Watcher: Processing failed: {e}")
+                error = e
+            self.__update(state="backoff", connected_since=None,
+                          errors=self.metrics["errors"] + 1,
+                          last_error=str(error))
+            self.stopping.wait(backoff)
+            backoff = min(self.max_backoff, backoff * 2)
+        self.__update(state="stopped", connected_since=None)
+
+    def __watch(self, handler) -> None:
+        use_idle = "IDLE" in handler.capabilities
+        self.__update(mode="idle" if use_idle else "poll")
+        logging.info("Watcher: Waiting for new mail with "
+                     + ("IDLE" if use_idle else "NOOP polling"))
+        self.__sync(handler)
+        while not self.stopping.is_set():
+            if handler.mail_arrived():
+                # Reported while syncing, so waiting would miss it
+                changed = True
+            elif use_idle:
+                self.__update(state="idle")
+                responses = handler.idle(self.idle_timeout, self.stopping)
+                changed = any(i.endswith(b"EXISTS") for i in responses)
+            else:
+                self.__update(state="polling")
+                if self.stopping.wait(self.poll_interval):
+                    break
+                changed = len(handler.poll()) > 0
+            if changed:
+                self.__sync(handler)
+
+    def __sync(self, handler) -> None:
+        self.__update(state="processing")
+        start = time.time()
+        self.process(handler)
+        self.__update(syncs=self.metrics["syncs"] + 1, last_sync=time.time(),
+                      last_sync_seconds=time.time() - start)
+
+    def __update(self, **values) -> None:
+        with self.lock:
+            self.metrics.update(values)
+            self.metrics["heartbeat"] = time.time()
+            metrics = dict(self.metrics)
+        if self.heartbeat_file is None:
+            return
+        tmp_path = self.heartbeat_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metrics, f, indent=2)
+        os.replace(tmp_path, self.heartbeat_file)